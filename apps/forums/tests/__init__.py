@@ -5,6 +5,7 @@ from nose.tools import eq_
 
 from forums.models import Thread, Post, ThreadLockedError
 from forums.views import sort_threads
+from sumo.paginator import KeysetPaginator
 from sumo.tests import get, LocalizingClient, TestCase
 
 
@@ -99,6 +100,22 @@ class PostTestCase(ForumTestCase):
         self.assert_(threads[0].last_post.created >=
                      threads[1].last_post.created)
 
+    def test_keyset_paging_threads(self):
+        """Paging through threads visits each once, even threads without a
+        last post."""
+        threads = Thread.objects.all()
+        assert threads.filter(last_post=None)
+        paginator = KeysetPaginator(threads, 2)
+        pages = [paginator.page()]
+        while pages[-1].has_next():
+            pages.append(paginator.page(pages[-1].next_token))
+        eq_(list(threads), [t for p in pages for t in p])
+
+        page = pages[-1]
+        for previous in reversed(pages[:-1]):
+            page = paginator.page(page.previous_token, before=True)
+            eq_(previous.object_list, page.object_list)
+
     def test_thread_last_page(self):
         """Thread's last_page property is accurate."""
         thread = Thread.objects.all()[0]
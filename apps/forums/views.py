@@ -17,7 +17,7 @@ from forums.feeds import ThreadsFeed, PostsFeed
 from forums.forms import ReplyForm, NewThreadForm, EditThreadForm, EditPostForm
 from forums.models import Forum, Thread, Post
 from sumo.urlresolvers import reverse
-from sumo.utils import paginate
+from sumo.utils import paginate, keyset_paginate
 
 log = logging.getLogger('k.forums')
 
@@ -68,11 +68,10 @@ def threads(request, forum_slug):
     desc_toggle = 0 if desc else 1
 
     threads_ = sort_threads(forum.thread_set, sort, desc)
-    count = threads_.count()
     threads_ = threads_.select_related('creator', 'last_post',
                                        'last_post__author')
-    threads_ = paginate(request, threads_,
-                        per_page=constants.THREADS_PER_PAGE, count=count)
+    threads_ = keyset_paginate(request, threads_,
+                               per_page=constants.THREADS_PER_PAGE)
 
     feed_urls = ((reverse('forums.threads.feed', args=[forum_slug]),
                   ThreadsFeed().title(forum)),)
@@ -1,5 +1,4 @@
 from datetime import datetime
-from itertools import islice
 import json
 import logging
 
@@ -9,7 +8,7 @@ from django.contrib.auth.forms import AuthenticationForm
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.sites.models import Site
 from django.core.cache import cache
-from django.core.exceptions import PermissionDenied, ObjectDoesNotExist
+from django.core.exceptions import PermissionDenied
 from django.db.models import Q
 from django.http import (HttpResponseRedirect, HttpResponse, Http404,
                          HttpResponseBadRequest, HttpResponseForbidden)
@@ -38,7 +37,7 @@ from search.clients import WikiClient, QuestionsClient, SearchError
 from search.utils import locale_or_default, sphinx_locale
 from sumo.helpers import urlparams
 from sumo.urlresolvers import reverse
-from sumo.utils import paginate
+from sumo.utils import paginate, keyset_paginate
 from tags.utils import add_existing_tag
 from upload.models import ImageAttachment
 from upload.views import upload_imageattachment
@@ -101,8 +100,8 @@ def questions(request):
             question_qs = Question.objects.get_empty_query_set()
 
     question_qs = question_qs.order_by(order)
-    questions_ = paginate(request, question_qs,
-                          per_page=constants.QUESTIONS_PER_PAGE)
+    questions_ = keyset_paginate(request, question_qs,
+                                 per_page=constants.QUESTIONS_PER_PAGE)
 
     return jingo.render(request, 'questions/questions.html',
                         {'questions': questions_, 'feeds': feed_urls,
@@ -730,19 +729,21 @@ def _search_suggestions(query, locale):
           provide an internal API. Seriously.
 
     """
-    def prepare(result, model, attr, searcher, result_to_id):
-        """Turn a search result from a Sphinx client into a dict for templates.
+    def prepare(raw_results, model, attr, searcher, result_to_id, limit):
+        """Turn search results from a Sphinx client into dicts for templates.
 
-        Return {} if an object corresponding to the result cannot be found.
+        Results whose objects cannot be found are skipped. At most `limit`
+        dicts are returned, and their excerpts are built in one request.
 
         """
-        try:
-            obj = model.objects.get(pk=result_to_id(result))
-        except ObjectDoesNotExist:
-            return {}
-        return {'url': obj.get_absolute_url(),
-                'title': obj.title,
-                'excerpt_html': searcher.excerpt(getattr(obj, attr), query)}
+        ids = [result_to_id(r) for r in raw_results]
+        objects = model.objects.in_bulk(ids) if ids else {}
+        found = [objects[id] for id in ids if id in objects][:limit]
+        excerpts = searcher.excerpts([getattr(o, attr) for o in found], query)
+        return [{'url': obj.get_absolute_url(),
+                 'title': obj.title,
+                 'excerpt_html': excerpt}
+                for obj, excerpt in zip(found, excerpts)]
 
     max_suggestions = settings.QUESTIONS_MAX_SUGGESTIONS
     query_limit = max_suggestions + settings.QUESTIONS_SUGGESTION_SLOP
@@ -760,13 +761,8 @@ def _search_suggestions(query, locale):
                           if x < 0]}]
     raw_results = wiki_searcher.query(query, filters=filters,
                                       limit=query_limit)
-    # Lazily build excerpts from results. Stop when we have enough:
-    results = islice((p for p in
-                       (prepare(r, Document, 'html', wiki_searcher,
-                                lambda x: x['id'])
-                        for r in raw_results) if p),
-                     max_suggestions)
-    results = list(results)
+    results = prepare(raw_results, Document, 'html', wiki_searcher,
+                      lambda x: x['id'], max_suggestions)
 
     # If we didn't find enough wiki pages to fill the page, pad it out with
     # other questions:
@@ -775,12 +771,10 @@ def _search_suggestions(query, locale):
         # questions app is en-US only.
         raw_results = question_searcher.query(query,
                                               limit=query_limit - len(results))
-        results.extend(islice((p for p in
-                               (prepare(r, Question, 'content',
-                                        question_searcher,
-                                        lambda x: x['attrs']['question_id'])
-                                for r in raw_results) if p),
-                              max_suggestions - len(results)))
+        results.extend(prepare(raw_results, Question, 'content',
+                               question_searcher,
+                               lambda x: x['attrs']['question_id'],
+                               max_suggestions - len(results)))
 
     return results
 
@@ -0,0 +1,23 @@
+import json
+
+from django import http
+from django.contrib import admin
+
+from search.metrics import metrics
+from search.pool import pool
+from search.utils import search_cache_stats
+
+
+def search_stats(request):
+    """Admin view that returns this process's search metrics as JSON.
+
+    Timings are per index and per operation (query or excerpts). The result
+    cache counts are shared by all processes.
+
+    """
+    data = {'indexes': metrics.as_dict(),
+            'pool': pool.stats(),
+            'cache': search_cache_stats()}
+    return http.HttpResponse(json.dumps(data), mimetype='application/json')
+
+admin.site.register_view('search-stats', search_stats, 'Search Statistics')
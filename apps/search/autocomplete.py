@@ -0,0 +1,299 @@
+"""In-memory prefix indexes of titles, for OpenSearch suggestions.
+
+Each process keeps one index of approved KB article titles per locale and one
+of solved question titles. Indexes are built from the database on first use
+and kept up to date by the signal handlers connected by register().
+
+Changes that affect an index are numbered by a counter in the cache, one per
+index, and each is kept in the cache under its number. Other processes
+replay the changes they missed on their next lookup, and only rebuild an
+index when they're too far behind or a change fell out of the cache.
+
+"""
+from bisect import bisect_left, insort
+import re
+import threading
+import time
+
+from django.core.cache import cache
+from django.db.models.signals import post_init, post_save, post_delete
+
+from questions.models import Question
+from sumo.urlresolvers import reverse
+from wiki.models import Document, REDIRECT_HTML
+
+
+COUNTER_KEY = 'sumo:search:autocomplete:%s:%s'  # kind, locale
+CHANGE_KEY = 'sumo:search:autocomplete:%s:%s:%s'  # kind, locale, number
+# Memcached's longest relative timeout:
+COUNTER_TIMEOUT = 60 * 60 * 24 * 30
+# Seconds changes are kept for replaying, and how many a process replays
+# before it rebuilds instead:
+CHANGE_TIMEOUT = 60 * 60
+MAX_REPLAY = 500
+# Stop looking after this many matching keys; plenty to pick `limit` from.
+MAX_SCAN = 200
+
+WORD = re.compile(r'\w+', re.UNICODE)
+
+
+def _normalize(text):
+    """Lowercase and collapse whitespace."""
+    return u' '.join(text.lower().split())
+
+
+class PrefixIndex(object):
+    """A sorted array of titles for prefix lookups.
+
+    Every title is entered once for each word in it, keyed on the rest of
+    the title from that word on, so "Firefox crashes" is found by "fire" as
+    well as by "cra".
+
+    """
+
+    def __init__(self, entries=()):
+        self._titles = {}  # id -> (title, url args)
+        keys = []
+        for id, title, args in entries:
+            self._titles[id] = (title, args)
+            keys.extend(self._keys(id, title))
+        keys.sort()
+        self._keys_ = keys  # sorted (key, id) pairs
+
+    @staticmethod
+    def _keys(id, title):
+        normalized = _normalize(title)
+        return [(normalized[m.start():], id)
+                for m in WORD.finditer(normalized)]
+
+    def add(self, id, title, args):
+        """Add an entry, replacing any existing one with the same id."""
+        self.remove(id)
+        self._titles[id] = (title, args)
+        for key in self._keys(id, title):
+            insort(self._keys_, key)
+
+    def remove(self, id):
+        """Remove the entry with the given id, if there is one."""
+        if id not in self._titles:
+            return
+        title, args = self._titles.pop(id)
+        for key in self._keys(id, title):
+            i = bisect_left(self._keys_, key)
+            if i < len(self._keys_) and self._keys_[i] == key:
+                del self._keys_[i]
+
+    def search(self, prefix, limit):
+        """Return up to `limit` (title, url args) pairs matching `prefix`.
+
+        Titles starting with the prefix come before titles with a later word
+        starting with it.
+
+        """
+        prefix = _normalize(prefix)
+        if not prefix:
+            return []
+        found = {}  # id -> whether the match is at the start of the title
+        i = bisect_left(self._keys_, (prefix,))
+        for key, id in self._keys_[i:i + MAX_SCAN]:
+            if not key.startswith(prefix):
+                break
+            at_start = _normalize(self._titles[id][0]) == key
+            found[id] = found.get(id, False) or at_start
+        ranked = sorted(found, key=lambda id: (not found[id],
+                                               self._titles[id][0].lower()))
+        return [self._titles[id] for id in ranked[:limit]]
+
+    def __len__(self):
+        return len(self._titles)
+
+
+def _load_documents(locale):
+    docs = (Document.uncached.filter(locale=locale, is_template=False,
+                                     current_revision__isnull=False)
+            .exclude(html__startswith=REDIRECT_HTML)
+            .values_list('id', 'title', 'slug'))
+    return [(id, title, (locale, slug)) for id, title, slug in docs]
+
+
+def _load_questions(locale):
+    questions = (Question.uncached.filter(solution__isnull=False)
+                 .values_list('id', 'title'))
+    return [(id, title, (id,)) for id, title in questions]
+
+
+# kind -> (loader, function turning url args into a URL)
+KINDS = {
+    'document': (_load_documents,
+                 lambda args: reverse('wiki.document', locale=args[0],
+                                      args=[args[1]])),
+    'question': (_load_questions,
+                 lambda args: reverse('questions.answers',
+                                      kwargs={'question_id': args[0]})),
+}
+
+# (kind, locale) -> (number of the last change applied, PrefixIndex).
+# Questions are all in one index.
+_indexes = {}
+# Guards _indexes and the indexes in it, which request threads share:
+_lock = threading.RLock()
+
+
+def _counter(kind, locale):
+    """Return the number of the last change to the index."""
+    key = COUNTER_KEY % (kind, locale)
+    number = cache.get(key)
+    if number is None:
+        # Start from the time, so a counter that falls out of the cache
+        # comes back well past the numbers indexes were built at.
+        cache.add(key, int(time.time()) * 1000, COUNTER_TIMEOUT)
+        number = cache.get(key, int(time.time()) * 1000)
+    return number
+
+
+def _apply(index, change):
+    id, entry = change
+    if entry:
+        index.add(id, *entry)
+    else:
+        index.remove(id)
+
+
+def get_index(kind, locale=None):
+    """Return the up-to-date prefix index for `kind` and `locale`.
+
+    Call this with _lock held.
+
+    """
+    number = _counter(kind, locale)
+    current = _indexes.get((kind, locale))
+    if current:
+        applied, index = current
+        if applied == number:
+            return index
+        if applied < number <= applied + MAX_REPLAY:
+            keys = [CHANGE_KEY % (kind, locale, n)
+                    for n in xrange(applied + 1, number + 1)]
+            changes = cache.get_many(keys)
+            if len(changes) == len(keys):
+                for key in keys:
+                    _apply(index, changes[key])
+                _indexes[(kind, locale)] = (number, index)
+                return index
+
+    # Changes made while this loads are numbered past `number`, so they're
+    # replayed next time; replaying them twice does no harm.
+    index = PrefixIndex(KINDS[kind][0](locale))
+    _indexes[(kind, locale)] = (number, index)
+    return index
+
+
+def suggest(term, locale, limit=5):
+    """Return up to `limit` (title, URL) pairs each of KB articles in
+    `locale` and of solved questions that match `term`."""
+    results = []
+    for kind, index_locale in (('document', locale), ('question', None)):
+        url = KINDS[kind][1]
+        with _lock:
+            found = get_index(kind, index_locale).search(term, limit)
+        results.extend((title, url(args)) for title, args in found)
+    return results
+
+
+def _update(kind, locale, id, entry=None):
+    """Record a change to an index and apply it to this process's copy.
+
+    entry -- (title, url args) to add or replace, or None to remove
+
+    """
+    try:
+        number = cache.incr(COUNTER_KEY % (kind, locale))
+    except ValueError:
+        # The counter fell out of the cache. Restarting it makes every
+        # process rebuild, which picks this change up from the database.
+        _counter(kind, locale)
+        return
+    change = (id, entry)
+    cache.set(CHANGE_KEY % (kind, locale, number), change, CHANGE_TIMEOUT)
+
+    with _lock:
+        current = _indexes.get((kind, locale))
+        if current and current[0] == number - 1:
+            _apply(current[1], change)
+            _indexes[(kind, locale)] = (number, current[1])
+
+
+def _document_state(document):
+    """Return a document's locale and its index entry, or None if it isn't
+    indexed."""
+    if (document.current_revision_id and not document.is_template and
+        not document.html.startswith(REDIRECT_HTML)):
+        entry = (document.title, (document.locale, document.slug))
+    else:
+        entry = None
+    return document.locale, entry
+
+
+def _question_entry(question):
+    if question.solution_id:
+        return question.title, (question.id,)
+
+
+def _document_initialized(sender, instance, **kwargs):
+    instance._autocomplete_state = _document_state(instance)
+
+
+def _document_saved(sender, instance, **kwargs):
+    old_locale, old_entry = getattr(instance, '_autocomplete_state',
+                                    (None, None))
+    locale, entry = state = _document_state(instance)
+    instance._autocomplete_state = state
+    if old_entry and old_locale != locale:
+        _update('document', old_locale, instance.id)
+    if entry != old_entry:
+        _update('document', locale, instance.id, entry)
+
+
+def _document_deleted(sender, instance, **kwargs):
+    old_locale, old_entry = getattr(instance, '_autocomplete_state',
+                                    (instance.locale, True))
+    if old_entry:
+        _update('document', old_locale, instance.id)
+
+
+def _question_initialized(sender, instance, **kwargs):
+    instance._autocomplete_entry = _question_entry(instance)
+
+
+def _question_saved(sender, instance, **kwargs):
+    # Saving an answer saves its question, so most saves change nothing:
+    entry = _question_entry(instance)
+    if entry != getattr(instance, '_autocomplete_entry', None):
+        _update('question', None, instance.id, entry)
+    instance._autocomplete_entry = entry
+
+
+def _question_deleted(sender, instance, **kwargs):
+    if getattr(instance, '_autocomplete_entry', True):
+        _update('question', None, instance.id)
+
+
+def register():
+    """Connect the signal handlers that keep the indexes up to date.
+
+    manage.py calls this, so it runs once in every web, cron and celery
+    process.
+
+    """
+    post_init.connect(_document_initialized, sender=Document,
+                      dispatch_uid='search_autocomplete_document_init')
+    post_save.connect(_document_saved, sender=Document,
+                      dispatch_uid='search_autocomplete_document_saved')
+    post_delete.connect(_document_deleted, sender=Document,
+                        dispatch_uid='search_autocomplete_document_deleted')
+    post_init.connect(_question_initialized, sender=Question,
+                      dispatch_uid='search_autocomplete_question_init')
+    post_save.connect(_question_saved, sender=Question,
+                      dispatch_uid='search_autocomplete_question_saved')
+    post_delete.connect(_question_deleted, sender=Question,
+                        dispatch_uid='search_autocomplete_question_deleted')
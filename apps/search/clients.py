@@ -1,13 +1,19 @@
 import logging
 import socket
 import os
+import threading
+import time
 
 from django.conf import settings
 from django.utils.encoding import smart_unicode
 
 import bleach
+import jinja2
 
 from search import sphinxapi
+from search.metrics import metrics
+from search.pool import pool
+from search.utils import DELTA_SUFFIX
 
 
 log = logging.getLogger('k.search')
@@ -17,6 +23,16 @@ class SearchError(Exception):
     """An error occurred executing a search."""
 
 
+def _unhighlighted(content):
+    """Return content as plain text, cut to about SEARCH_SUMMARY_LENGTH.
+
+    Used in place of an excerpt when Sphinx can't build one.
+
+    """
+    text = jinja2.Markup(smart_unicode(content)).striptags()
+    return text[:settings.SEARCH_SUMMARY_LENGTH]
+
+
 class SearchClient(object):
     """
     Base-class for search clients
@@ -25,6 +41,8 @@ class SearchClient(object):
     match_mode = sphinxapi.SPH_MATCH_EXTENDED2
     rank_mode = sphinxapi.SPH_RANK_PROXIMITY_BM25
     sort_mode = (sphinxapi.SPH_SORT_RELEVANCE, '')
+    # Seconds query_all() waits for this index before giving up:
+    timeout = settings.SEARCH_INDEX_TIMEOUT
 
     def __init__(self):
         self.sphinx = sphinxapi.SphinxClient()
@@ -38,6 +56,9 @@ class SearchClient(object):
         self.sphinx.SetRankingMode(self.rank_mode)
         self.sphinx.SetSortMode(*self.sort_mode)
 
+        # Number of matches for the last query, regardless of its limits:
+        self.total_found = 0
+
     def _prepare_filters(self, filters=None):
         """Process filters and filter ranges."""
         sc = self.sphinx
@@ -59,6 +80,37 @@ class SearchClient(object):
     def _prepare(self):
         """Override to twiddle `self.sphinx` before the query gets sent."""
 
+    def _call(self, method, *args):
+        """Call SphinxClient method `method` over a pooled connection.
+
+        If a pooled connection turns out to be broken, retries once over a
+        fresh, unpooled one. Raises socket.error if no connection can be
+        opened at all, rather than waiting out another connect timeout.
+
+        """
+        fn = getattr(self.sphinx, method)
+        if not pool.size:
+            return fn(*args)
+
+        pooled = pool.acquire(self.sphinx)
+        try:
+            result = fn(*args)
+        except socket.timeout:
+            pool.discard(self.sphinx)
+            raise
+        except socket.error:
+            pool.discard(self.sphinx)
+            if not pooled:
+                raise
+            log.info('Pooled searchd connection failed, reconnecting.')
+            return fn(*args)
+        except Exception:
+            pool.discard(self.sphinx)
+            raise
+
+        pool.release(self.sphinx)
+        return result
+
     def _sanitize_query(self, query):
         """Strip control characters that cause problems."""
         return query.replace('^', '').replace('$', '')
@@ -72,21 +124,37 @@ class SearchClient(object):
 
         query = self._sanitize_query(query)
 
+        start = time.time()
         try:
-            result = self.sphinx.Query(query, self.index)
+            # The delta index comes last, so its copies of changed rows
+            # replace the main index's.
+            result = self._call('Query', query, '%s %s%s' % (
+                self.index, self.index, DELTA_SUFFIX))
         except socket.timeout:
+            metrics.record_error(self.index, 'query', timeout=True)
             log.error('Query has timed out!')
             raise SearchError('Query has timed out!')
         except socket.error, msg:
+            metrics.record_error(self.index, 'query')
             log.error('Query socket error: %s' % msg)
             raise SearchError('Could not execute your search!')
         except Exception, e:
+            metrics.record_error(self.index, 'query')
             log.error('Sphinx threw an unknown exception: %s' % e)
             raise SearchError('Sphinx threw an unknown exception!')
 
         if result:
+            metrics.record(self.index, 'query', (time.time() - start) * 1000,
+                           matches=len(result['matches']),
+                           total_found=result['total_found'],
+                           searchd_time=float(result['time']))
+            self.total_found = result['total_found']
             return result['matches']
         else:
+            # sphinxapi returns None rather than raising for errors searchd
+            # reports.
+            metrics.record_error(self.index, 'query')
+            self.total_found = 0
             return []
 
     def query(self, query, filters=None, offset=0,
@@ -109,24 +177,49 @@ class SearchClient(object):
         Length of the final excerpt is roughly determined by
         SEARCH_SUMMARY_LENGTH in settings.py.
         """
-        if not isinstance(result, basestring):
-            return ''
-        documents = [result]
+        return self.excerpts([result], query)[0]
+
+    def excerpts(self, results, query):
+        """
+        Like excerpt(), but builds the excerpts for a list of document
+        contents in a single request to Sphinx.
 
+        Returns a list of excerpts in the same order as `results`. If Sphinx
+        can't be reached, falls back to the unhighlighted, truncated text.
+        """
+        excerpts = [''] * len(results)
+        positions = [i for i, r in enumerate(results)
+                     if isinstance(r, basestring) and r]
+        if not positions:
+            return excerpts
+        documents = [results[i] for i in positions]
+
+        start = time.time()
         try:
-            # build excerpts that are longer and truncate
-            # see multiplier constant definition for details
-            excerpt = self.sphinx.BuildExcerpts(
-                documents, self.index, query,
-                {'limit': settings.SEARCH_SUMMARY_LENGTH})[0]
-        except socket.error:
-            log.error('Socket error building excerpt!')
-            excerpt = ''
+            built = self._call(
+                'BuildExcerpts', documents, self.index, query,
+                {'limit': settings.SEARCH_SUMMARY_LENGTH})
         except socket.timeout:
-            log.error('Building excerpt timed out!')
-            excerpt = ''
+            log.error('Building excerpts timed out!')
+            metrics.record_error(self.index, 'excerpts', timeout=True)
+            built = None
+        except socket.error:
+            log.error('Socket error building excerpts!')
+            metrics.record_error(self.index, 'excerpts')
+            built = None
+        else:
+            if built and len(built) == len(documents):
+                metrics.record(self.index, 'excerpts',
+                               (time.time() - start) * 1000)
+            else:
+                metrics.record_error(self.index, 'excerpts')
 
-        return bleach.clean(smart_unicode(excerpt))
+        if not built or len(built) != len(documents):
+            built = [_unhighlighted(d) for d in documents]
+
+        for i, excerpt in zip(positions, built):
+            excerpts[i] = bleach.clean(smart_unicode(excerpt))
+        return excerpts
 
     def set_sort_mode(self, mode, clause=''):
         self.sphinx.SetSortMode(mode, clause)
@@ -170,3 +263,92 @@ class DiscussionClient(SearchClient):
         self.sphinx.SetGroupBy('thread_id', sphinxapi.SPH_GROUPBY_ATTR,
                                self.groupsort)
         self.sphinx.SetSortMode(*self.sort_mode)
+
+
+def query_all(searches):
+    """Query several indexes at the same time.
+
+    searches -- a list of (client, query[, filters[, offset[, limit]]])
+        tuples, one per index. All but the client are passed on to
+        client.query().
+
+    Each query runs on its own connection in its own thread, so the total
+    latency is that of the slowest index rather than the sum of all of them.
+    Returns a list of match lists in the same order as `searches`.
+
+    Raises SearchError if any query fails or if an index doesn't answer
+    within its client's `timeout`.
+
+    """
+    results = [None] * len(searches)
+    errors = []
+
+    def run(i, client, args):
+        try:
+            results[i] = client.query(*args)
+        except SearchError, e:
+            errors.append(e)
+
+    threads = []
+    for i, search in enumerate(searches):
+        client, args = search[0], search[1:]
+        t = threading.Thread(target=run, args=(i, client, args))
+        t.daemon = True  # Don't hold up shutdown for a hung searchd.
+        t.start()
+        threads.append((t, client))
+
+    start = time.time()
+    for t, client in threads:
+        t.join(max(start + client.timeout - time.time(), 0))
+        if t.is_alive():
+            log.error('Query on %s has timed out!' % client.index)
+            raise SearchError('Query has timed out!')
+
+    if errors:
+        raise errors[0]
+    return results
+
+
+def query_page(searches, offset, limit):
+    """Fetch one page of matches from several indexes at once.
+
+    searches -- a list of (client, query, filters) tuples
+
+    The indexes' matches are treated as one list, in the order of `searches`,
+    and only the `limit` matches starting at `offset` are fetched from
+    searchd. Each index can contribute at most SEARCH_MAX_RESULTS matches.
+
+    Returns (matches, total number of matches in all indexes).
+
+    """
+    max_results = settings.SEARCH_MAX_RESULTS
+    # Sphinx can't page past max_matches, so fetch the last full window if
+    # asked for more:
+    fetched_offset = max(min(offset, max_results - limit), 0)
+    first = query_all([s + (fetched_offset, limit) for s in searches])
+
+    pieces = []
+    refetch = []
+    start = 0  # Where the current index's matches begin in the whole list
+    for search, matches in zip(searches, first):
+        total = min(search[0].total_found, max_results)
+        lo = max(offset - start, 0)
+        hi = min(offset + limit - start, total)
+        if lo >= hi:
+            pieces.append([])
+        elif lo >= fetched_offset:
+            # The first round already got these.
+            pieces.append(matches[lo - fetched_offset:hi - fetched_offset])
+        else:
+            # Earlier indexes pushed this one's share of the page further
+            # up its own result list than the first round asked for.
+            refetch.append((len(pieces), search + (lo, hi - lo)))
+            pieces.append(None)
+        start += total
+
+    if refetch:
+        positions, again = zip(*refetch)
+        for i, matches in zip(positions, query_all(list(again))):
+            pieces[i] = matches
+
+    return [m for piece in pieces for m in piece], start
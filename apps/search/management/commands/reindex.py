@@ -2,7 +2,7 @@ from optparse import make_option
 
 from django.core.management.base import BaseCommand
 
-from search.utils import reindex
+from search.utils import reindex, merge_deltas
 
 
 class Command(BaseCommand):
@@ -10,7 +10,16 @@ class Command(BaseCommand):
     option_list = BaseCommand.option_list + (
         make_option('--rotate', dest='rotate', action='store_true',
                     default=False, help='Rotate indexes for running server.'),
+        make_option('--delta', dest='delta', action='store_true',
+                    default=False,
+                    help='Only index rows changed since the last merge.'),
+        make_option('--merge', dest='merge', action='store_true',
+                    default=False,
+                    help='Merge the delta indexes into the main ones.'),
     )
 
     def handle(self, *args, **options):
-        reindex(options['rotate'])
+        if options['merge']:
+            merge_deltas(options['rotate'])
+        else:
+            reindex(options['rotate'], options['delta'])
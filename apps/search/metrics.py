@@ -0,0 +1,137 @@
+"""Timings and error counts for the queries we send to searchd.
+
+Each process keeps its own histograms, per index and operation, which the
+search stats admin view shows. If STATSD_HOST is set, every measurement is
+also sent to statsd, which sums them up across processes.
+
+"""
+import socket
+import threading
+
+from django.conf import settings
+
+
+# Upper bounds, in milliseconds, of the histogram buckets. A last bucket
+# catches everything slower.
+BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+
+
+class Histogram(object):
+    """Counts of measurements in fixed buckets, plus their count and sum."""
+
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, value):
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                break
+        else:
+            i = len(BUCKETS)
+        self.buckets[i] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def as_dict(self):
+        bounds = [str(b) for b in BUCKETS] + ['inf']
+        return {'count': self.count, 'total': self.total, 'max': self.max,
+                'mean': float(self.total) / self.count if self.count else 0,
+                'buckets': dict(zip(bounds, self.buckets))}
+
+
+class StatsdClient(object):
+    """Sends counters and timers to statsd over UDP.
+
+    Sending is fire-and-forget: a missing statsd never breaks a search.
+
+    """
+
+    def __init__(self, host, port, prefix):
+        self.addr = (host, port)
+        self.prefix = prefix
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def _send(self, stat, value, kind):
+        data = '%s.%s:%s|%s' % (self.prefix, stat, value, kind)
+        try:
+            self._sock.sendto(data, self.addr)
+        except socket.error:
+            pass
+
+    def incr(self, stat, count=1):
+        self._send(stat, count, 'c')
+
+    def timing(self, stat, ms):
+        self._send(stat, int(ms), 'ms')
+
+
+class Metrics(object):
+    """Per-process search metrics, keyed on index and operation."""
+
+    def __init__(self, statsd=None):
+        self.statsd = statsd
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._stats = {}
+
+    def _stats_for(self, index, op):
+        key = (index, op)
+        if key not in self._stats:
+            self._stats[key] = {'latency': Histogram(),
+                                'searchd_time': Histogram(),
+                                'matches': Histogram(),
+                                'total_found': Histogram(),
+                                'errors': 0, 'timeouts': 0}
+        return self._stats[key]
+
+    def record(self, index, op, ms, matches=None, total_found=None,
+               searchd_time=None):
+        """Record a successful call that took `ms` milliseconds.
+
+        searchd_time -- seconds searchd says the query took
+
+        """
+        with self._lock:
+            stats = self._stats_for(index, op)
+            stats['latency'].add(ms)
+            if matches is not None:
+                stats['matches'].add(matches)
+            if total_found is not None:
+                stats['total_found'].add(total_found)
+            if searchd_time is not None:
+                stats['searchd_time'].add(searchd_time * 1000)
+        if self.statsd:
+            self.statsd.timing('%s.%s' % (index, op), ms)
+            if searchd_time is not None:
+                self.statsd.timing('%s.%s.searchd' % (index, op),
+                                   searchd_time * 1000)
+
+    def record_error(self, index, op, timeout=False):
+        """Record a failed call."""
+        kind = 'timeouts' if timeout else 'errors'
+        with self._lock:
+            self._stats_for(index, op)[kind] += 1
+        if self.statsd:
+            self.statsd.incr('%s.%s.%s' % (index, op, kind))
+
+    def as_dict(self):
+        """Return the metrics as a dict of {index: {operation: stats}}."""
+        data = {}
+        with self._lock:
+            for (index, op), stats in self._stats.iteritems():
+                data.setdefault(index, {})[op] = dict(
+                    (k, v.as_dict() if isinstance(v, Histogram) else v)
+                    for k, v in stats.iteritems())
+        return data
+
+
+metrics = Metrics(StatsdClient(settings.STATSD_HOST, settings.STATSD_PORT,
+                               settings.STATSD_PREFIX)
+                  if settings.STATSD_HOST else None)
@@ -0,0 +1,16 @@
+from django.db import models
+
+from sumo.models import ModelBase
+
+
+class SphinxCounter(ModelBase):
+    """Where delta indexing of a Sphinx source picks up.
+
+    The indexer keeps these up to date; see configs/sphinx/sphinx.conf.
+
+    """
+    source = models.CharField(max_length=50, primary_key=True)
+    # Rows changed since main_mark aren't in the main index yet:
+    main_mark = models.DateTimeField()
+    # When the delta index was last built:
+    delta_mark = models.DateTimeField()
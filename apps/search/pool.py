@@ -0,0 +1,118 @@
+import logging
+import os
+import select
+import socket
+import threading
+
+from django.conf import settings
+
+
+log = logging.getLogger('k.search')
+
+
+def _is_alive(sock):
+    """Return whether an idle persistent connection can still be used.
+
+    An idle connection has nothing to read and can be written to. If it's
+    readable, searchd has closed it (or sent junk we'd choke on).
+
+    """
+    try:
+        readable, writable, errored = select.select([sock], [sock], [sock], 0)
+    except (select.error, socket.error):
+        return False
+    return not readable and not errored and bool(writable)
+
+
+class ConnectionPool(object):
+    """A per-process pool of persistent connections to searchd.
+
+    Idle sockets are kept per (host, port) and lent to SphinxClients, which
+    use them like connections they opened themselves with Open(). The pool
+    counts how often it could hand out an existing connection (hits) and how
+    often it had to open a new one (misses).
+
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._idle = {}
+        self._pid = os.getpid()
+        self.hits = self.misses = self.discards = 0
+
+    def _check_pid(self):
+        """Forget connections inherited from a parent process.
+
+        Sharing a socket between processes would interleave their requests.
+
+        """
+        if self._pid != os.getpid():
+            self._reset()
+
+    def acquire(self, sphinx):
+        """Give SphinxClient `sphinx` an open persistent connection.
+
+        Returns True if it was a pooled connection, False if a new one was
+        opened. Raises socket.error if searchd can't be reached.
+
+        """
+        key = (sphinx._host, sphinx._port)
+        sock = None
+        with self._lock:
+            self._check_pid()
+            idle = self._idle.get(key, [])
+            while idle:
+                candidate = idle.pop()
+                if _is_alive(candidate):
+                    sock = candidate
+                    break
+                candidate.close()
+                self.discards += 1
+            if sock:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+        if sock:
+            sphinx._socket = sock
+            return True
+
+        sphinx.Open()
+        if not sphinx._socket:
+            raise socket.error(sphinx.GetLastError())
+        return False
+
+    def release(self, sphinx):
+        """Take `sphinx`'s connection back, keeping it if there's room."""
+        sock, sphinx._socket = sphinx._socket, None
+        if sock is None:
+            return
+        with self._lock:
+            self._check_pid()
+            idle = self._idle.setdefault((sphinx._host, sphinx._port), [])
+            if len(idle) < self.size:
+                idle.append(sock)
+                return
+        sock.close()
+
+    def discard(self, sphinx):
+        """Close `sphinx`'s connection instead of returning it to the pool."""
+        sock, sphinx._socket = sphinx._socket, None
+        if sock is not None:
+            sock.close()
+            with self._lock:
+                self.discards += 1
+
+    def stats(self):
+        """Return the pool's counters as a dict."""
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'discards': self.discards,
+                    'idle': sum(len(v) for v in self._idle.itervalues())}
+
+
+pool = ConnectionPool(settings.SEARCH_POOL_SIZE)
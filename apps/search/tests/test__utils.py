@@ -1,6 +1,16 @@
+from datetime import datetime
+
+from django.conf import settings
+from django.core.cache import cache
+
+import mock
 from nose.tools import eq_
 
-from search.utils import crc32
+from search.models import SphinxCounter
+from search.utils import (crc32, search_cache_key, get_cached_results,
+                          cache_results, bump_search_cache_generation,
+                          search_cache_stats, reindex, merge_deltas)
+from sumo.tests import TestCase
 
 
 def test_crc32_ascii():
@@ -16,3 +26,57 @@ def test_crc32_fr():
 def test_crc32_ja():
     """crc32 works for japanese. Integer value taken from mysql's CRC32."""
     eq_(696255294, crc32(u'\u6709\u52b9'))
+
+
+class TestSearchCache(object):
+    def setUp(self):
+        cache.clear()
+
+    def test_normalized_key(self):
+        """The order of list values doesn't change the key."""
+        eq_(search_cache_key({'q': u'audio', 'fx': [1, 2], 'page': 1}),
+            search_cache_key({'page': 1, 'fx': [2, 1], 'q': u'audio'}))
+        assert (search_cache_key({'q': u'audio', 'page': 1}) !=
+                search_cache_key({'q': u'audio', 'page': 2}))
+
+    def test_hit_and_miss(self):
+        key = search_cache_key({'q': u'audio'})
+        eq_(None, get_cached_results(key))
+        cache_results(key, ([{'title': u'Audio'}], 1))
+        eq_(([{'title': u'Audio'}], 1), get_cached_results(key))
+        eq_({'hits': 1, 'misses': 1}, search_cache_stats())
+
+    def test_generation(self):
+        """Bumping the generation (as reindex does) invalidates results."""
+        key = search_cache_key({'q': u'audio'})
+        cache_results(key, ([], 0))
+        bump_search_cache_generation()
+        new_key = search_cache_key({'q': u'audio'})
+        assert key != new_key
+        eq_(None, get_cached_results(new_key))
+
+
+@mock.patch('search.utils.call')
+def test_reindex_delta(call):
+    """Delta reindexing only builds the delta indexes."""
+    reindex(rotate=True, delta=True)
+    eq_([settings.SPHINX_INDEXER, 'questions_delta',
+         'discussion_forums_delta', 'wiki_pages_delta',
+         '--config', settings.SPHINX_CONFIG_PATH, '--rotate'],
+        call.call_args[0][0])
+
+
+class MergeDeltasTest(TestCase):
+    @mock.patch('search.utils.call')
+    def test_merge(self, call):
+        """Merging moves the main mark up to the delta's."""
+        delta_mark = datetime(2011, 3, 1, 12, 0)
+        SphinxCounter.objects.create(source='questions',
+                                     main_mark=datetime(2011, 3, 1),
+                                     delta_mark=delta_mark)
+        merge_deltas()
+        eq_(delta_mark,
+            SphinxCounter.uncached.get(source='questions').main_mark)
+        eq_([settings.SPHINX_INDEXER, '--merge', 'questions',
+             'questions_delta', '--config', settings.SPHINX_CONFIG_PATH],
+            call.call_args_list[0][0][0])
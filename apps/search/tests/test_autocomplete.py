@@ -0,0 +1,94 @@
+from nose.tools import eq_
+
+from questions.models import Question, Answer
+from search import autocomplete
+from search.autocomplete import PrefixIndex, suggest
+from sumo.tests import TestCase
+from wiki.models import Document
+
+
+def test_prefix_index():
+    """Titles are found by the start of any of their words."""
+    index = PrefixIndex([(1, u'Firefox crashes', 'a'),
+                         (2, u'Clearing cookies', 'b'),
+                         (3, u'How to fix crashes', 'c')])
+    eq_([(u'Firefox crashes', 'a')], index.search(u'FIRE', 5))
+    eq_([u'Firefox crashes', u'How to fix crashes'],
+        [t for t, _ in index.search(u'crash', 5)])
+    eq_([u'How to fix crashes'], [t for t, _ in index.search(u'fix cr', 5)])
+    eq_([], index.search(u'xyz', 5))
+    eq_([], index.search(u'  ', 5))
+
+
+def test_prefix_index_ranking():
+    """Titles starting with the prefix come first, then by title."""
+    index = PrefixIndex([(1, u'Clear the cache', 'a'),
+                         (2, u'Cache settings', 'b'),
+                         (3, u'Broken cache', 'c')])
+    eq_([u'Cache settings', u'Broken cache', u'Clear the cache'],
+        [t for t, _ in index.search(u'cache', 5)])
+    eq_(1, len(index.search(u'cache', 1)))
+
+
+def test_prefix_index_update():
+    index = PrefixIndex([(1, u'Old title', 'a')])
+    index.add(1, u'New title', 'a')
+    eq_([], index.search(u'old', 5))
+    eq_([(u'New title', 'a')], index.search(u'new', 5))
+    index.remove(1)
+    eq_([], index.search(u'new', 5))
+    eq_(0, len(index))
+    index.remove(1)  # Removing a missing entry is fine.
+
+
+class SuggestTestCase(TestCase):
+    fixtures = ['users.json', 'search/documents.json', 'questions.json']
+
+    def setUp(self):
+        super(SuggestTestCase, self).setUp()
+        autocomplete._indexes.clear()
+
+    def test_locale(self):
+        """Only documents in the requested locale are suggested."""
+        eq_([u'lorem ipsum', u'redirect lorem ipsum'],
+            [t for t, _ in suggest(u'lorem', 'en-US')])
+        eq_([(u'le title', u'/fr/kb/le-title')], suggest(u'le', 'fr'))
+
+    def test_document_saved(self):
+        """Saving a document updates the index."""
+        suggest(u'lorem', 'en-US')  # Build the index.
+        doc = Document.objects.get(pk=1)
+        doc.title = u'Lorem dolor'
+        doc.save()
+        eq_(3, len(suggest(u'lorem', 'en-US')))
+        doc.delete()
+        eq_(2, len(suggest(u'lorem', 'en-US')))
+
+    def test_solved_questions(self):
+        """Only questions with a solution are suggested."""
+        eq_([], suggest(u'lolrus', 'en-US'))
+        question = Question.objects.get(pk=4)
+        question.solution = Answer.objects.get(pk=2)
+        question.save()
+        eq_([u'lolrus too?'], [t for t, _ in suggest(u'lolrus', 'en-US')])
+
+    def test_unchanged_question_saved(self):
+        """Saves that don't change an indexed field aren't recorded."""
+        suggest(u'lolrus', 'en-US')
+        question = Question.objects.get(pk=4)
+        number = autocomplete._counter('question', None)
+        question.num_answers += 1
+        question.save()
+        eq_(number, autocomplete._counter('question', None))
+
+    def test_replay(self):
+        """Changes made by other processes are replayed, not rebuilt."""
+        suggest(u'lorem', 'en-US')
+        # Hide this process's index while another "process" saves.
+        stale = autocomplete._indexes.pop(('document', 'en-US'))
+        doc = Document.objects.get(pk=1)
+        doc.title = u'Lorem dolor'
+        doc.save()
+        autocomplete._indexes[('document', 'en-US')] = stale
+        eq_(3, len(suggest(u'lorem', 'en-US')))
+        assert autocomplete.get_index('document', 'en-US') is stale[1]
@@ -0,0 +1,59 @@
+import mock
+from nose.tools import eq_
+
+from search.clients import WikiClient
+from search.metrics import Histogram, Metrics, metrics
+from search.pool import pool
+from sumo.tests import TestCase
+
+
+def test_histogram():
+    h = Histogram()
+    for value in (3, 7, 7, 3000):
+        h.add(value)
+    d = h.as_dict()
+    eq_(4, d['count'])
+    eq_(3000, d['max'])
+    eq_(2, d['buckets']['10'])
+    eq_(1, d['buckets']['inf'])
+
+
+def test_statsd():
+    """Measurements are sent to statsd too."""
+    statsd = mock.Mock()
+    m = Metrics(statsd)
+    m.record('wiki_pages', 'query', 12.5, searchd_time=0.004)
+    m.record_error('wiki_pages', 'query', timeout=True)
+    statsd.timing.assert_any_call('wiki_pages.query', 12.5)
+    statsd.timing.assert_any_call('wiki_pages.query.searchd', 4.0)
+    statsd.incr.assert_called_with('wiki_pages.query.timeouts')
+
+
+class ClientMetricsTest(TestCase):
+    def setUp(self):
+        super(ClientMetricsTest, self).setUp()
+        metrics.reset()
+
+    @mock.patch.object(pool, 'size', 0)
+    def test_query(self):
+        """Queries record their latency, match counts and searchd time."""
+        wc = WikiClient()
+        result = {'matches': [{'id': 1}], 'total_found': 40, 'time': '0.012'}
+        with mock.patch.object(wc.sphinx, 'Query') as query:
+            query.return_value = result
+            wc.query('firefox')
+        stats = metrics.as_dict()['wiki_pages']['query']
+        eq_(1, stats['latency']['count'])
+        eq_(1, stats['matches']['total'])
+        eq_(40, stats['total_found']['total'])
+        eq_(12, round(stats['searchd_time']['total']))
+        eq_(0, stats['errors'])
+
+    @mock.patch.object(pool, 'size', 0)
+    def test_query_error(self):
+        """Errors searchd reports are counted."""
+        wc = WikiClient()
+        with mock.patch.object(wc.sphinx, 'Query') as query:
+            query.return_value = None
+            eq_([], wc.query('firefox'))
+        eq_(1, metrics.as_dict()['wiki_pages']['query']['errors'])
@@ -0,0 +1,76 @@
+import socket
+
+import mock
+from nose.tools import eq_
+
+from search.pool import ConnectionPool
+
+
+def fake_sphinx(sock=None):
+    """Return a stand-in SphinxClient whose Open() "connects" to `sock`."""
+    sphinx = mock.Mock()
+    sphinx._host, sphinx._port = 'localhost', 3416
+    sphinx._socket = None
+
+    def open_():
+        sphinx._socket = sock
+    sphinx.Open.side_effect = open_
+    return sphinx
+
+
+def test_reuse():
+    """A released connection is handed out again."""
+    ours, theirs = socket.socketpair()
+    pool = ConnectionPool(2)
+
+    sphinx = fake_sphinx(ours)
+    eq_(False, pool.acquire(sphinx))
+    pool.release(sphinx)
+    eq_(None, sphinx._socket)
+
+    other = fake_sphinx()
+    eq_(True, pool.acquire(other))
+    eq_(ours, other._socket)
+    eq_({'hits': 1, 'misses': 1, 'discards': 0, 'idle': 0}, pool.stats())
+
+
+def test_dead_connection():
+    """Connections searchd has closed are dropped, not handed out."""
+    ours, theirs = socket.socketpair()
+    fresh, fresh_theirs = socket.socketpair()
+    pool = ConnectionPool(2)
+
+    sphinx = fake_sphinx(ours)
+    pool.acquire(sphinx)
+    pool.release(sphinx)
+    theirs.close()
+
+    other = fake_sphinx(fresh)
+    eq_(False, pool.acquire(other))
+    eq_(fresh, other._socket)
+    eq_(1, pool.stats()['discards'])
+
+
+def test_full_pool():
+    """Connections beyond the pool's size are closed on release."""
+    pool = ConnectionPool(1)
+    first, second = fake_sphinx(mock.Mock()), fake_sphinx(mock.Mock())
+    pool.acquire(first)
+    pool.acquire(second)
+    sock = second._socket
+    pool.release(first)
+    pool.release(second)
+    assert sock.close.called
+    eq_(1, pool.stats()['idle'])
+
+
+def test_cannot_connect():
+    """acquire() raises socket.error if no connection can be opened."""
+    pool = ConnectionPool(1)
+    sphinx = fake_sphinx(None)
+    try:
+        pool.acquire(sphinx)
+    except socket.error:
+        pass
+    else:
+        raise AssertionError('socket.error not raised')
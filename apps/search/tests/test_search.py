@@ -20,9 +20,12 @@ import test_utils
 from forums.models import Post
 import search as constants
 from search.clients import (WikiClient, QuestionsClient,
-                            DiscussionClient, SearchError)
+                            DiscussionClient, SearchError, query_all,
+                            query_page)
+from search.pool import pool
 from search.utils import start_sphinx, stop_sphinx, reindex, crc32
-from sumo.tests import LocalizingClient
+from search.views import _hydrate_results
+from sumo.tests import LocalizingClient, TestCase
 from sumo.urlresolvers import reverse
 from wiki.models import Document
 
@@ -579,11 +582,11 @@ class SearchTest(SphinxTestCase):
 
         response = self.client.get(reverse('search.suggestions',
                                            locale='en-US'),
-                                   {'q': 'audio'})
+                                   {'q': 'lorem'})
         eq_(200, response.status_code)
         eq_('application/x-suggestions+json', response['content-type'])
         results = json.loads(response.content)
-        eq_('audio', results[0])
+        eq_('lorem', results[0])
         eq_(2, len(results[1]))
         eq_(0, len(results[2]))
         eq_(2, len(results[3]))
@@ -611,3 +614,140 @@ def test_excerpt_timeout(sphinx_mock):
 
     sphinx_mock.query.side_effect = lambda *a: sphinx_error(Exception)
     assert_raises(SearchError, query, 'xxx')
+
+
+class HydrateResultsTest(TestCase):
+    fixtures = ['users.json', 'search/documents.json']
+
+    def test_order_and_missing(self):
+        """Results keep the Sphinx order and skip deleted objects."""
+        matches = [{'id': 2, 'attrs': {'category': 10}},
+                   {'id': 999, 'attrs': {'category': 10}},
+                   {'id': 1, 'attrs': {'category': 10}}]
+        results = _hydrate_results(matches, 'audio')
+        eq_(2, len(results))
+        eq_([Document.objects.get(pk=2).title,
+             Document.objects.get(pk=1).title],
+            [r['title'] for r in results])
+        eq_('document', results[0]['type'])
+
+    def test_empty(self):
+        eq_([], _hydrate_results([], 'audio'))
+
+
+@mock.patch.object(pool, 'size', 0)
+def test_excerpts_socket_error():
+    """Excerpts fall back to unhighlighted text if Sphinx is down."""
+    wc = WikiClient()
+    with mock.patch.object(wc.sphinx, 'BuildExcerpts') as build:
+        build.side_effect = socket.error
+        excerpts = wc.excerpts(['<p>audio <b>stuff</b></p>', None, ''],
+                               'audio')
+    eq_(1, build.call_count)
+    eq_([u'audio stuff', '', ''], excerpts)
+
+
+@mock.patch('search.clients.pool')
+def test_excerpts_cannot_connect(pool):
+    """If searchd can't be reached, sphinxapi isn't left to try again."""
+    pool.acquire.side_effect = socket.error
+    wc = WikiClient()
+    with mock.patch.object(wc.sphinx, 'BuildExcerpts') as build:
+        eq_([u'audio stuff'], wc.excerpts(['<p>audio <b>stuff</b></p>'],
+                                          'audio'))
+    assert not build.called
+
+
+@mock.patch.object(pool, 'size', 0)
+def test_excerpts_single_request():
+    """All excerpts on a page are built with one BuildExcerpts call."""
+    qc = QuestionsClient()
+    with mock.patch.object(qc.sphinx, 'BuildExcerpts') as build:
+        build.return_value = ['<b>one</b>', 'two <div>x</div>']
+        excerpts = qc.excerpts(['one', 'two <div>x</div>'], 'one')
+    eq_(1, build.call_count)
+    eq_([u'<b>one</b>', u'two &lt;div&gt;x&lt;/div&gt;'], excerpts)
+
+
+def test_query_all_order():
+    """query_all() returns each index's matches in the order asked for."""
+    wc, qc = WikiClient(), QuestionsClient()
+    with mock.patch.object(wc, 'query') as wq:
+        with mock.patch.object(qc, 'query') as qq:
+            wq.return_value = [{'id': 1}]
+            qq.return_value = [{'id': 2}]
+            results = query_all([(wc, 'a', []), (qc, 'a', [])])
+    eq_([[{'id': 1}], [{'id': 2}]], results)
+
+
+def test_query_all_error():
+    """A failure on any index is a SearchError for the whole search."""
+    wc, qc = WikiClient(), QuestionsClient()
+    with mock.patch.object(qc, 'query') as qq:
+        qq.side_effect = SearchError
+        wc.sphinx.SetServer('localhost', 65535)
+        assert_raises(SearchError, query_all, [(wc, 'a', []), (qc, 'a', [])])
+
+
+def test_query_all_timeout():
+    """An index slower than its timeout is a SearchError."""
+    wc = WikiClient()
+    wc.timeout = 0.01
+    with mock.patch.object(wc, 'query') as wq:
+        wq.side_effect = lambda *a: time.sleep(0.5)
+        assert_raises(SearchError, query_all, [(wc, 'a', [])])
+
+
+class FakeClient(object):
+    """Stands in for a SearchClient whose index holds `matches`."""
+    index = 'fake'
+    timeout = 1
+
+    def __init__(self, matches):
+        self.matches = matches
+        self.calls = []
+
+    def query(self, query, filters=None, offset=0, limit=10):
+        self.calls.append((offset, limit))
+        self.total_found = len(self.matches)
+        return self.matches[offset:offset + limit]
+
+
+def test_query_page_first_page():
+    """The first page never needs more than one request per index."""
+    a, b = FakeClient(range(5)), FakeClient(range(100, 130))
+    matches, total = query_page([(a, 'q', []), (b, 'q', [])], 0, 10)
+    eq_(range(5) + range(100, 105), matches)
+    eq_(35, total)
+    eq_([(0, 10)], b.calls)
+
+
+def test_query_page_straddle():
+    """A page spanning two indexes takes the right part of each."""
+    a, b = FakeClient(range(15)), FakeClient(range(100, 130))
+    matches, total = query_page([(a, 'q', []), (b, 'q', [])], 10, 10)
+    eq_(range(10, 15) + range(100, 105), matches)
+    eq_(45, total)
+    eq_([(10, 10), (0, 5)], b.calls)
+
+
+def test_query_page_deep():
+    """Deep pages only fetch a page's worth of matches."""
+    a, b = FakeClient(range(15)), FakeClient(range(100, 130))
+    matches, total = query_page([(a, 'q', []), (b, 'q', [])], 40, 10)
+    eq_(range(125, 130), matches)
+    eq_([(40, 10), (25, 5)], b.calls)
+
+
+def test_query_page_max_results():
+    """Each index contributes at most SEARCH_MAX_RESULTS matches."""
+    old_max = settings.SEARCH_MAX_RESULTS
+    settings.SEARCH_MAX_RESULTS = 20
+    try:
+        a = FakeClient(range(50))
+        matches, total = query_page([(a, 'q', [])], 15, 10)
+    finally:
+        settings.SEARCH_MAX_RESULTS = old_max
+    eq_(range(15, 20), matches)
+    eq_(20, total)
+    eq_([(10, 10)], a.calls)
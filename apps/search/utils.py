@@ -1,8 +1,13 @@
+import hashlib
 import subprocess
+import time
 import zlib
 
 from django.conf import settings
+from django.core.cache import cache
+from django.db.models import F
 
+from search.models import SphinxCounter
 from sumo_locales import LOCALES
 
 
@@ -12,18 +17,62 @@ crc32 = lambda x: zlib.crc32(x.encode('utf-8')) & 0xffffffff
 call = lambda x: subprocess.Popen(x, stdout=subprocess.PIPE).communicate()
 
 
-def reindex(rotate=False):
+RESULTS_KEY = 'sumo:search:results:%s:%s'  # generation, query hash
+GENERATION_KEY = 'sumo:search:generation'
+HITS_KEY = 'sumo:search:cache-hits'
+MISSES_KEY = 'sumo:search:cache-misses'
+# Memcached's longest relative timeout:
+LONG_TIMEOUT = 60 * 60 * 24 * 30
+
+
+# Main indexes, each with a delta index holding rows changed since it was
+# built. See configs/sphinx/sphinx.conf.
+INDEXES = ('questions', 'discussion_forums', 'wiki_pages')
+DELTA_SUFFIX = '_delta'
+
+
+def reindex(rotate=False, delta=False):
     """Reindex sphinx.
 
+    With `delta`, only rebuild the delta indexes, which hold rows changed
+    since their main index was built or last merged.
+
     Note this is only to be used in dev and test environments.
 
     """
-    calls = [settings.SPHINX_INDEXER, '--all', '--config',
-             settings.SPHINX_CONFIG_PATH]
+    if delta:
+        indexes = [i + DELTA_SUFFIX for i in INDEXES]
+    else:
+        indexes = ['--all']
+    calls = [settings.SPHINX_INDEXER] + indexes + [
+             '--config', settings.SPHINX_CONFIG_PATH]
     if rotate:
         calls.append('--rotate')
 
     call(calls)
+    bump_search_cache_generation()
+
+
+def merge_deltas(rotate=False):
+    """Merge each delta index into its main index and start a new delta.
+
+    Merging keeps the deltas small, so rebuilding them stays cheap, without
+    rebuilding the main indexes from scratch.
+
+    Note this is only to be used in dev and test environments.
+
+    """
+    for index in INDEXES:
+        calls = [settings.SPHINX_INDEXER, '--merge', index,
+                 index + DELTA_SUFFIX, '--config',
+                 settings.SPHINX_CONFIG_PATH]
+        if rotate:
+            calls.append('--rotate')
+        call(calls)
+
+    # The main indexes now hold everything up to when the deltas started.
+    SphinxCounter.uncached.update(main_mark=F('delta_mark'))
+    reindex(rotate=rotate, delta=True)
 
 
 def start_sphinx():
@@ -60,3 +109,61 @@ def locale_or_default(locale):
 def sphinx_locale(locale):
     """Given a locale string like 'en-US', return a Sphinx-ready locale."""
     return crc32(locale)
+
+
+def _incr(key):
+    """Increment a counter in the cache, creating it if needed."""
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.add(key, 1, LONG_TIMEOUT)
+
+
+def search_cache_generation():
+    """Return the current generation of cached search results."""
+    generation = cache.get(GENERATION_KEY)
+    if generation is None:
+        # Start from the time rather than 1, so a generation key that falls
+        # out of the cache can't bring back results cached under it.
+        cache.add(GENERATION_KEY, int(time.time()), LONG_TIMEOUT)
+        generation = cache.get(GENERATION_KEY, int(time.time()))
+    return generation
+
+
+def bump_search_cache_generation():
+    """Invalidate all cached search results."""
+    try:
+        cache.incr(GENERATION_KEY)
+    except ValueError:
+        cache.set(GENERATION_KEY, int(time.time()), LONG_TIMEOUT)
+
+
+def search_cache_key(params):
+    """Return the cache key for search results for a dict of parameters.
+
+    List values are sorted, so equivalent searches share a key.
+
+    """
+    normalized = sorted((k, sorted(v) if isinstance(v, (list, tuple)) else v)
+                        for k, v in params.iteritems())
+    digest = hashlib.md5(repr(normalized)).hexdigest()
+    return RESULTS_KEY % (search_cache_generation(), digest)
+
+
+def get_cached_results(key):
+    """Return cached search results for `key`, or None, counting hits and
+    misses."""
+    results = cache.get(key)
+    _incr(MISSES_KEY if results is None else HITS_KEY)
+    return results
+
+
+def cache_results(key, results):
+    """Cache search results for SEARCH_CACHE_PERIOD minutes."""
+    cache.set(key, results, settings.SEARCH_CACHE_PERIOD * 60)
+
+
+def search_cache_stats():
+    """Return the search result cache's hit and miss counts."""
+    return {'hits': cache.get(HITS_KEY, 0),
+            'misses': cache.get(MISSES_KEY, 0)}
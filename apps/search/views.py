@@ -5,7 +5,6 @@ from datetime import datetime, timedelta
 
 from django.conf import settings
 from django.contrib.sites.models import Site
-from django.db.models import ObjectDoesNotExist
 from django.http import HttpResponse, HttpResponseBadRequest
 from django.utils.http import urlencode
 from django.views.decorators.cache import cache_page
@@ -15,9 +14,12 @@ import jinja2
 from mobility.decorators import mobile_template
 from tower import ugettext as _
 
+from search.autocomplete import suggest
 from search.clients import (QuestionsClient, WikiClient,
-                            DiscussionClient, SearchError)
-from search.utils import crc32, locale_or_default, sphinx_locale
+                            DiscussionClient, SearchError, query_page)
+from search.utils import (crc32, locale_or_default, sphinx_locale,
+                          search_cache_key, get_cached_results,
+                          cache_results)
 from forums.models import Thread, Post
 from questions.models import Question
 import search as constants
@@ -117,7 +119,6 @@ def search(request, template=None):
     else:
         lang_name = ''
 
-    documents = []
     filters_w = []
     filters_q = []
     filters_f = []
@@ -157,7 +158,7 @@ def search(request, template=None):
     })
 
     # Tags filter
-    tags = [crc32(t.strip()) for t in cleaned['tags'].split()]
+    tags = [crc32(tag.strip()) for tag in cleaned['tags'].split()]
     if tags:
         for t in tags:
             filters_w.append({
@@ -200,7 +201,7 @@ def search(request, template=None):
                 'value': (crc32(cleaned['answered_by']),),
             })
 
-        q_tags = [crc32(t.strip()) for t in cleaned['q_tags'].split()]
+        q_tags = [crc32(tag.strip()) for tag in cleaned['q_tags'].split()]
         if q_tags:
             for t in q_tags:
                 filters_q.append({
@@ -265,87 +266,31 @@ def search(request, template=None):
             filters_q.append(after)
 
     sortby = smart_int(request.GET.get('sortby'))
-    try:
-        if cleaned['w'] & constants.WHERE_WIKI:
-            wc = WikiClient()  # Wiki SearchClient instance
-            # Execute the query and append to documents
-            documents += wc.query(cleaned['q'], filters_w)
-
-        if cleaned['w'] & constants.WHERE_SUPPORT:
-            qc = QuestionsClient()  # Support question SearchClient instance
-
-            # Sort results by
-            try:
-                qc.set_sort_mode(constants.SORT_QUESTIONS[sortby][0],
-                                 constants.SORT_QUESTIONS[sortby][1])
-            except IndexError:
-                pass
-
-            documents += qc.query(cleaned['q'], filters_q)
-
-        if cleaned['w'] & constants.WHERE_DISCUSSION:
-            dc = DiscussionClient()  # Discussion forums SearchClient instance
-
-            # Sort results by
-            try:
-                dc.groupsort = constants.GROUPSORT[sortby]
-            except IndexError:
-                pass
-
-            documents += dc.query(cleaned['q'], filters_f)
-
-    except SearchError:
-        if is_json:
-            return HttpResponse(json.dumps({'error':
-                                             _('Search Unavailable')}),
-                                mimetype=mimetype, status=503)
-
-        t = 'search/mobile/down.html' if request.MOBILE else 'search/down.html'
-        return jingo.render(request, t, {'q': cleaned['q']}, status=503)
-
-    pages = paginate(request, documents, settings.SEARCH_RESULTS_PER_PAGE)
-
-    results = []
-    for i in range(offset, offset + settings.SEARCH_RESULTS_PER_PAGE):
-        try:
-            if documents[i]['attrs'].get('category', False) != False:
-                wiki_page = Document.objects.get(pk=documents[i]['id'])
-                summary = wiki_page.current_revision.summary
-
-                result = {'search_summary': summary,
-                          'url': wiki_page.get_absolute_url(),
-                          'title': wiki_page.title,
-                          'type': 'document', }
-                results.append(result)
-            elif documents[i]['attrs'].get('question_creator', False) != False:
-                question = Question.objects.get(
-                    pk=documents[i]['attrs']['question_id'])
-
-                excerpt = qc.excerpt(question.content, cleaned['q'])
-                summary = jinja2.Markup(excerpt)
-
-                result = {'search_summary': summary,
-                          'url': question.get_absolute_url(),
-                          'title': question.title,
-                          'type': 'question', }
-                results.append(result)
-            else:
-                thread = Thread.objects.get(
-                    pk=documents[i]['attrs']['thread_id'])
-                post = Post.objects.get(pk=documents[i]['id'])
-
-                excerpt = dc.excerpt(post.content, cleaned['q'])
-                summary = jinja2.Markup(excerpt)
-
-                result = {'search_summary': summary,
-                          'url': thread.get_absolute_url(),
-                          'title': thread.title,
-                          'type': 'thread', }
-                results.append(result)
-        except IndexError:
-            break
-        except ObjectDoesNotExist:
-            continue
+    # Look in the cache before setting up any search clients, which hits
+    # don't need.
+    cache_key = search_cache_key(dict(cleaned, language=language, page=page,
+                                      sortby=sortby,
+                                      exclude_category=exclude_category))
+    cached = get_cached_results(cache_key)
+    if cached is not None:
+        results, num_results = cached
+    else:
+        results, num_results = _search(cleaned, sortby, offset, filters_w,
+                                       filters_q, filters_f)
+        if results is None:
+            if is_json:
+                return HttpResponse(json.dumps({'error':
+                                                 _('Search Unavailable')}),
+                                    mimetype=mimetype, status=503)
+
+            t = ('search/mobile/down.html' if request.MOBILE else
+                 'search/down.html')
+            return jingo.render(request, t, {'q': cleaned['q']}, status=503)
+        cache_results(cache_key, (results, num_results))
+
+    # Only the current page was fetched, so page counts come from the total.
+    pages = paginate(request, results, settings.SEARCH_RESULTS_PER_PAGE,
+                     count=num_results)
 
     items = [(k, v) for k in search_form.fields for
              v in r.getlist(k) if v and k != 'a']
@@ -367,7 +312,7 @@ def search(request, template=None):
         return HttpResponse(json_data, mimetype=mimetype)
 
     results_ = jingo.render(request, template,
-        {'num_results': len(documents), 'results': results, 'q': cleaned['q'],
+        {'num_results': num_results, 'results': results, 'q': cleaned['q'],
          'pages': pages, 'w': cleaned['w'], 'refine_query': refine_query,
          'search_form': search_form, 'lang_name': lang_name, })
     results_['Cache-Control'] = 'max-age=%s' % \
@@ -378,6 +323,134 @@ def search(request, template=None):
     return results_
 
 
+def _result_type(match):
+    """Return which index a Sphinx match came from: 'document', 'question' or
+    'thread'."""
+    attrs = match['attrs']
+    if attrs.get('category', False) != False:
+        return 'document'
+    elif attrs.get('question_creator', False) != False:
+        return 'question'
+    return 'thread'
+
+
+def _search(cleaned, sortby, offset, filters_w, filters_q, filters_f):
+    """Query the indexes the form asks for and return the requested page of
+    results and the total number of matches, or (None, 0) if Sphinx is
+    unavailable."""
+    qc = dc = None
+    searches = []
+    if cleaned['w'] & constants.WHERE_WIKI:
+        wc = WikiClient()  # Wiki SearchClient instance
+        searches.append((wc, cleaned['q'], filters_w))
+
+    if cleaned['w'] & constants.WHERE_SUPPORT:
+        qc = QuestionsClient()  # Support question SearchClient instance
+
+        # Sort results by
+        try:
+            qc.set_sort_mode(constants.SORT_QUESTIONS[sortby][0],
+                             constants.SORT_QUESTIONS[sortby][1])
+        except IndexError:
+            pass
+
+        searches.append((qc, cleaned['q'], filters_q))
+
+    if cleaned['w'] & constants.WHERE_DISCUSSION:
+        dc = DiscussionClient()  # Discussion forums SearchClient instance
+
+        # Sort results by
+        try:
+            dc.groupsort = constants.GROUPSORT[sortby]
+        except IndexError:
+            pass
+
+        searches.append((dc, cleaned['q'], filters_f))
+
+    try:
+        # Query every index at once, fetching only the requested page
+        documents, num_results = query_page(
+            searches, offset, settings.SEARCH_RESULTS_PER_PAGE)
+    except SearchError:
+        return None, 0
+    return (_hydrate_results(documents, cleaned['q'], qc=qc, dc=dc),
+            num_results)
+
+
+def _hydrate_results(matches, query, qc=None, dc=None):
+    """Turn a page of Sphinx matches into result dicts for the templates.
+
+    The objects behind the matches are fetched with one query per model,
+    rather than one (or two) per match. Matches whose objects no longer exist
+    are skipped.
+
+    qc, dc -- the QuestionsClient and DiscussionClient that produced the
+        matches, used to build excerpts
+
+    """
+    ids = {'document': [], 'question': [], 'thread': [], 'post': []}
+    for match in matches:
+        type_ = _result_type(match)
+        if type_ == 'document':
+            ids['document'].append(match['id'])
+        elif type_ == 'question':
+            ids['question'].append(match['attrs']['question_id'])
+        else:
+            ids['thread'].append(match['attrs']['thread_id'])
+            ids['post'].append(match['id'])
+
+    documents = (Document.objects.select_related('current_revision')
+                 .in_bulk(ids['document']) if ids['document'] else {})
+    questions = (Question.objects.in_bulk(ids['question'])
+                 if ids['question'] else {})
+    threads = Thread.objects.in_bulk(ids['thread']) if ids['thread'] else {}
+    posts = Post.objects.in_bulk(ids['post']) if ids['post'] else {}
+
+    results = []
+    # (result, content) pairs still needing an excerpt, per client:
+    pending = {'question': [], 'thread': []}
+    for match in matches:
+        type_ = _result_type(match)
+        if type_ == 'document':
+            wiki_page = documents.get(match['id'])
+            if not wiki_page or not wiki_page.current_revision:
+                continue
+            results.append({
+                'search_summary': wiki_page.current_revision.summary,
+                'url': wiki_page.get_absolute_url(),
+                'title': wiki_page.title,
+                'type': 'document', })
+        elif type_ == 'question':
+            question = questions.get(match['attrs']['question_id'])
+            if not question:
+                continue
+            result = {'url': question.get_absolute_url(),
+                      'title': question.title,
+                      'type': 'question', }
+            pending['question'].append((result, question.content))
+            results.append(result)
+        else:
+            thread = threads.get(match['attrs']['thread_id'])
+            post = posts.get(match['id'])
+            if not thread or not post:
+                continue
+            result = {'url': thread.get_absolute_url(),
+                      'title': thread.title,
+                      'type': 'thread', }
+            pending['thread'].append((result, post.content))
+            results.append(result)
+
+    # Build each client's excerpts in one request:
+    for client, type_ in ((qc, 'question'), (dc, 'thread')):
+        if not pending[type_]:
+            continue
+        excerpts = client.excerpts([c for r, c in pending[type_]], query)
+        for (result, content), excerpt in zip(pending[type_], excerpts):
+            result['search_summary'] = jinja2.Markup(excerpt)
+
+    return results
+
+
 @cache_page(60 * 15)  # 15 minutes.
 def suggestions(request):
     """A simple search view that returns OpenSearch suggestions."""
@@ -389,26 +462,12 @@ def suggestions(request):
     if not term:
         return HttpResponseBadRequest(mimetype=mimetype)
 
-    wc = WikiClient()
-    qc = QuestionsClient()
     site = Site.objects.get_current()
-    locale = sphinx_locale(locale_or_default(request.locale))
-
-    results = []
-    filters_w = [{'filter': 'locale', 'value': (locale,)}]
-    filters_q = [{'filter': 'has_helpful', 'value': (True,)}]
-
-    for client, filter, cls in [(wc, filters_w, Document),
-                                (qc, filters_q, Question)]:
-        for result in client.query(term, filter, limit=5):
-            try:
-                result = cls.objects.get(pk=result['id'])
-            except cls.DoesNotExist:
-                continue
-            results.append(result)
+    locale = locale_or_default(request.locale)
+    results = suggest(term, locale, limit=5)
 
-    urlize = lambda obj: u'https://%s%s' % (site, obj.get_absolute_url())
-    data = [term, [r.title for r in results], [], [urlize(r) for r in results]]
+    data = [term, [title for title, url in results], [],
+            [u'https://%s%s' % (site, url) for title, url in results]]
     return HttpResponse(json.dumps(data), mimetype=mimetype)
 
 
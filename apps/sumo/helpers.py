@@ -19,6 +19,7 @@ from pytz import timezone
 from tower import ugettext_lazy as _lazy, ungettext
 
 import sumo.parser
+from sumo.paginator import KeysetPage
 from sumo.urlresolvers import reverse
 
 
@@ -30,6 +31,11 @@ class DateTimeFormatError(Exception):
 @register.filter
 def paginator(pager):
     """Render list of pages."""
+    if isinstance(pager, KeysetPage):
+        t = env.get_template('layout/keyset_paginator.html')
+        # The count is approximate, so the last page may be past it:
+        num_pages = max(pager.paginator.num_pages, pager.number)
+        return jinja2.Markup(t.render(pager=pager, num_pages=num_pages))
     return Paginator(pager).render()
 
 
@@ -1,8 +1,23 @@
+import base64
+import hashlib
+import json
+import math
+
+from django.conf import settings
+from django.core.cache import cache
 from django.core.paginator import (Paginator as DjPaginator, EmptyPage,
                                    InvalidPage)
+from django.db.models import Q
+from django.db.models.sql.datastructures import EmptyResultSet
+from django.utils.encoding import smart_str
+
 
+__all__ = ['Paginator', 'EmptyPage', 'InvalidPage', 'KeysetPaginator',
+           'KeysetPage']
 
-__all__ = ['Paginator', 'EmptyPage', 'InvalidPage']
+
+# Counts of the rows of keyset-paginated querysets, by hash of the SQL:
+COUNT_KEY = 'sumo:paginator:count:%s'
 
 
 class Paginator(DjPaginator):
@@ -14,3 +29,179 @@ class Paginator(DjPaginator):
             allow_empty_first_page=allow_empty_first_page)
         if count:
             self._count = count
+
+
+def _value(obj, field):
+    """Follow a field lookup like 'last_post__created' from `obj`, giving
+    None if a foreign key along the way is NULL."""
+    for name in field.split('__'):
+        if obj is None:
+            return None
+        obj = getattr(obj, name)
+    return obj
+
+
+def _nullable(model, field):
+    """Return whether a lookup like 'last_post__created' can be NULL."""
+    if field == 'pk':
+        return False
+    for name in field.split('__'):
+        f = model._meta.get_field(name)
+        if f.null:
+            return True
+        if f.rel:
+            model = f.rel.to
+    return False
+
+
+class KeysetPaginator(object):
+    """Pages through a queryset by the values of its ordering columns, so
+    each page is an index seek rather than a scan past an OFFSET.
+
+    Pages are found by opaque tokens holding the ordering values of the
+    row before or after them, and the page number, which is only shown. The
+    primary key is added to the ordering to break ties. NULLs in the
+    ordering columns sort before everything else, as MySQL sorts them.
+
+    The count is cached for PAGINATOR_COUNT_CACHE_TIMEOUT, so it's
+    approximate.
+
+    """
+
+    def __init__(self, queryset, per_page, count=None):
+        ordering = (queryset.query.order_by or
+                    queryset.model._meta.ordering)
+        self.keys = [(f.lstrip('-'), f.startswith('-')) for f in ordering]
+        if not self.keys or self.keys[-1][0] not in ('pk', 'id'):
+            self.keys.append(('pk', self.keys[-1][1] if self.keys else False))
+        self.nullable = set(f for f, _ in self.keys
+                            if _nullable(queryset.model, f))
+        self.queryset = queryset
+        self.per_page = per_page
+        self._count = count
+
+    @property
+    def count(self):
+        if self._count is None:
+            try:
+                sql = smart_str(self.queryset.query)
+            except EmptyResultSet:
+                self._count = 0
+                return self._count
+            key = COUNT_KEY % hashlib.md5(sql).hexdigest()
+            self._count = cache.get(key)
+            if self._count is None:
+                self._count = self.queryset.count()
+                cache.set(key, self._count,
+                          settings.PAGINATOR_COUNT_CACHE_TIMEOUT)
+        return self._count
+
+    @property
+    def num_pages(self):
+        return max(1, int(math.ceil(float(self.count) / self.per_page)))
+
+    def _token(self, number, obj):
+        values = [_value(obj, field) for field, desc in self.keys]
+        # Dates go as strings that date fields' lookups parse back:
+        values = [v if v is None or
+                  isinstance(v, (basestring, int, long, float, bool))
+                  else unicode(v) for v in values]
+        return base64.urlsafe_b64encode(
+            json.dumps([number, values])).rstrip('=')
+
+    def _parse(self, token):
+        """Return the page number and key values in a token, or (1, None)
+        if it's not a valid one."""
+        try:
+            number, values = json.loads(base64.urlsafe_b64decode(
+                smart_str(token) + '=' * (-len(token) % 4)))
+            number = int(number)
+        except (TypeError, ValueError):
+            return 1, None
+        if not isinstance(values, list) or len(values) != len(self.keys):
+            return 1, None
+        if not all(v is None or
+                   isinstance(v, (basestring, int, long, float, bool))
+                   for v in values):
+            return 1, None
+        return max(number, 1), values
+
+    def _seek(self, values, before):
+        """Return the condition for rows after (or before) `values`."""
+        q = None
+        for i, (field, desc) in enumerate(self.keys):
+            equal = dict(('%s__isnull' % f, True) if v is None else (f, v)
+                         for (f, _), v in zip(self.keys[:i], values[:i]))
+            value = values[i]
+            if desc != before:  # Lesser values, including NULL.
+                if value is None:
+                    continue
+                beyond = Q(**{'%s__lt' % field: value})
+                if field in self.nullable:
+                    beyond |= Q(**{'%s__isnull' % field: True})
+            elif value is None:  # Greater values: any but NULL.
+                beyond = Q(**{'%s__isnull' % field: False})
+            else:
+                beyond = Q(**{'%s__gt' % field: value})
+            if equal:
+                beyond = Q(**equal) & beyond
+            q = beyond if q is None else q | beyond
+        return q
+
+    def page(self, token=None, before=False):
+        """Return the page after the row in `token`, or before it if
+        `before` is True, or the first page if there's no valid token."""
+        number, values = self._parse(token) if token else (1, None)
+        if values is None:
+            before = False
+        ordering = ['-' + f if desc != before else f
+                    for f, desc in self.keys]
+        qs = self.queryset.order_by(*ordering)
+        if values is not None:
+            qs = qs.filter(self._seek(values, before))
+        object_list = list(qs[:self.per_page + 1])
+        more = len(object_list) > self.per_page
+        object_list = object_list[:self.per_page]
+
+        if before:
+            object_list.reverse()
+            has_previous, has_next = more, True
+        else:
+            has_previous, has_next = values is not None, more
+        return KeysetPage(object_list, number, self, has_previous, has_next)
+
+
+class KeysetPage(object):
+    """A page of a KeysetPaginator, with tokens for its neighbors."""
+
+    def __init__(self, object_list, number, paginator, has_previous,
+                 has_next):
+        self.object_list = object_list
+        self.number = number
+        self.paginator = paginator
+        self._has_previous = has_previous and bool(object_list)
+        self._has_next = has_next and bool(object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def has_previous(self):
+        return self._has_previous
+
+    def has_next(self):
+        return self._has_next
+
+    @property
+    def previous_token(self):
+        if self.has_previous():
+            return self.paginator._token(self.number - 1,
+                                         self.object_list[0])
+
+    @property
+    def next_token(self):
+        if self.has_next():
+            return self.paginator._token(self.number + 1,
+                                         self.object_list[-1])
@@ -1,3 +1,5 @@
+import re
+
 from django.conf import settings
 
 import jingo
@@ -33,6 +35,8 @@ IMAGE_PARAM_VALUES = {
     'valign': ('baseline', 'sub', 'super', 'top', 'text-top', 'middle',
               'bottom', 'text-bottom'),
 }
+# The inside of [[...]] markup:
+LINK_REGEX = re.compile(r'\[\[(.+?)\]\]')
 
 
 def wiki_to_html(wiki_markup, locale=settings.WIKI_DEFAULT_LANGUAGE,
@@ -42,6 +46,38 @@ def wiki_to_html(wiki_markup, locale=settings.WIKI_DEFAULT_LANGUAGE,
                               nofollow=nofollow)
 
 
+def _fallback(default_lang_doc, locale, translate):
+    """Return what to use for an item in the default locale when asked for
+    `locale`: its translation, the translation of its redirect target, or the
+    item itself.
+
+    translate -- a function returning the translation of an item to `locale`,
+        or None
+
+    """
+    # Return the translation of this English item:
+    if hasattr(default_lang_doc, 'translated_to'):
+        trans = translate(default_lang_doc)
+        if trans and trans.current_revision:
+            return trans
+
+    # Follow redirects internally in an attempt to find a translation of
+    # the final redirect target in the requested locale. This happens a lot
+    # when an English article is renamed and a redirect is left in its
+    # wake: we wouldn't want the non-English user to be linked to the
+    # English redirect, which would happily redirect them to the English
+    # final article.
+    if hasattr(default_lang_doc, 'redirect_document'):
+        target = default_lang_doc.redirect_document(follow=True)
+        if target:
+            trans = translate(target)
+            if trans and trans.current_revision:
+                return trans
+
+    # Return the English item:
+    return default_lang_doc
+
+
 def get_object_fallback(cls, title, locale, default=None, **kwargs):
     """Return an instance of cls matching title and locale, or fall back to the
     default locale.
@@ -63,47 +99,120 @@ def get_object_fallback(cls, title, locale, default=None, **kwargs):
     try:
         default_lang_doc = cls.objects.get(
             title=title, locale=settings.WIKI_DEFAULT_LANGUAGE, **kwargs)
-
-        # Return the translation of this English item:
-        if hasattr(default_lang_doc, 'translated_to'):
-            trans = default_lang_doc.translated_to(locale)
-            if trans and trans.current_revision:
-                return trans
-
-        # Follow redirects internally in an attempt to find a translation of
-        # the final redirect target in the requested locale. This happens a lot
-        # when an English article is renamed and a redirect is left in its
-        # wake: we wouldn't want the non-English user to be linked to the
-        # English redirect, which would happily redirect them to the English
-        # final article.
-        if hasattr(default_lang_doc, 'redirect_document'):
-            target = default_lang_doc.redirect_document()
-            if target:
-                trans = target.translated_to(locale)
-                if trans and trans.current_revision:
-                    return trans
-
-        # Return the English item:
-        return default_lang_doc
     # Okay, all else failed
     except cls.DoesNotExist:
         return default
+    return _fallback(default_lang_doc, locale,
+                     lambda doc: doc.translated_to(locale))
+
+
+def _title_key(title):
+    """Return `title` as MySQL compares it: ignoring case and trailing
+    spaces."""
+    return title.rstrip().lower()
+
+
+class ObjectResolver(object):
+    """Looks up the objects a piece of wiki markup refers to, in bulk.
+
+    Tell it about every title you will need with want(), then call get() for
+    each: the first get() fetches all wanted titles of a class with one query
+    across both locales, plus one for the translations of default-locale
+    fallbacks. get() answers like get_object_fallback() and falls back to it
+    for titles nobody wanted.
+
+    """
+
+    def __init__(self, locale):
+        self.locale = locale
+        self._wanted = {}  # cls -> set of title keys not fetched yet
+        self._objects = {}  # (cls, title key) -> [objects in either locale]
+        self._translations = {}  # (cls, default-locale id) -> translation
+
+    def want(self, cls, title):
+        key = _title_key(title)
+        if key and (cls, key) not in self._objects:
+            self._wanted.setdefault(cls, set()).add(key)
+
+    def _fetch(self):
+        for cls, keys in self._wanted.items():
+            locales = set([self.locale, settings.WIKI_DEFAULT_LANGUAGE])
+            objects = cls.objects.filter(title__in=keys, locale__in=locales)
+            if hasattr(cls, 'current_revision'):
+                objects = objects.select_related('current_revision')
+            objects = list(objects)
+            for key in keys:
+                self._objects[(cls, key)] = []
+            for obj in objects:
+                self._objects.setdefault((cls, _title_key(obj.title)),
+                                         []).append(obj)
+
+            if (hasattr(cls, 'translated_to') and
+                self.locale != settings.WIKI_DEFAULT_LANGUAGE):
+                default_ids = [o.id for o in objects
+                               if o.locale == settings.WIKI_DEFAULT_LANGUAGE]
+                for default_id in default_ids:
+                    self._translations[(cls, default_id)] = None
+                if default_ids:
+                    for trans in (cls.objects
+                                  .filter(locale=self.locale,
+                                          parent__in=default_ids)
+                                  .select_related('current_revision')):
+                        self._translations[(cls, trans.parent_id)] = trans
+        self._wanted = {}
+
+    def _translate(self, obj):
+        try:
+            return self._translations[(obj.__class__, obj.id)]
+        except KeyError:
+            return obj.translated_to(self.locale)
+
+    def get(self, cls, title, default=None, **kwargs):
+        """Return what get_object_fallback() would for `title`.
+
+        kwargs -- attribute values the object must have
+
+        """
+        if self._wanted:
+            self._fetch()
+        try:
+            candidates = self._objects[(cls, _title_key(title))]
+        except KeyError:
+            return get_object_fallback(cls, title, self.locale, default,
+                                       **kwargs)
+
+        candidates = [o for o in candidates if
+                      all(getattr(o, k) == v for k, v in kwargs.items())]
+        # Prefer exact title matches, like the database does in practice.
+        candidates.sort(key=lambda o: o.title != title)
+        for locale in (self.locale, settings.WIKI_DEFAULT_LANGUAGE):
+            for obj in candidates:
+                if obj.locale == locale:
+                    if locale == self.locale:
+                        return obj
+                    return _fallback(obj, self.locale, self._translate)
+        return default
 
 
-def _get_wiki_link(title, locale):
+def _get_wiki_link(title, locale, resolver=None):
     """Checks the page exists, and returns its URL or the URL to create it.
 
     Return value is a dict: {'found': boolean, 'url': string}.
     found is False if the document does not exist.
 
+    resolver -- an ObjectResolver to look the page up with
+
     """
     # Prevent circular import. sumo is conceptually a utils apps and shouldn't
     # have import-time (or really, any, but that's not going to happen)
     # dependencies on client apps.
     from wiki.models import Document
 
-    d = get_object_fallback(Document, locale=locale, title=title,
-                            is_template=False)
+    if resolver:
+        d = resolver.get(Document, title, is_template=False)
+    else:
+        d = get_object_fallback(Document, locale=locale, title=title,
+                                is_template=False)
     if d:
         return {'found': True, 'url': d.get_absolute_url(), 'text': d.title}
 
@@ -116,11 +225,13 @@ def _get_wiki_link(title, locale):
 
 
 def build_hook_params(string, locale, allowed_params=[],
-                      allowed_param_values={}):
+                      allowed_param_values={}, resolver=None):
     """Parses a string of the form 'some-title|opt1|opt2=arg2|opt3...'
 
     Builds a list of items and returns relevant parameters in a dict.
 
+    resolver -- an ObjectResolver to look up any linked page with
+
     """
     if not '|' in string:  # No params? Simple and easy.
         string = string.strip()
@@ -160,7 +271,7 @@ def build_hook_params(string, locale, allowed_params=[],
 
     # Handle page as a special case
     if 'page' in params and params['page'] is not True:
-        link = _get_wiki_link(params['page'], locale)
+        link = _get_wiki_link(params['page'], locale, resolver)
         params['link'] = link['url']
         params['found'] = link['found']
 
@@ -174,6 +285,9 @@ class WikiParser(Parser):
     def __init__(self, base_url=None):
         super(WikiParser, self).__init__(base_url)
 
+        # Looks up what the markup being parsed refers to; see parse().
+        self.resolver = None
+
         # Register default hooks
         self.registerInternalLinkHook(None, self._hook_internal_link)
         self.registerInternalLinkHook('Image', self._hook_image_tag)
@@ -188,14 +302,68 @@ class WikiParser(Parser):
         so both are required to identify it for a e.g. link.
 
         Since py-wikimarkup's hooks don't offer custom paramters for callbacks,
-        we're using self.locale to keep things simple."""
+        we're using self.locale to keep things simple.
+
+        Everything the text refers to is looked up in bulk by self.resolver
+        before the hooks need it. Nested calls, for inclusions, add their
+        references to the same resolver."""
         self.locale = locale
 
+        outermost = self.resolver is None
+        if outermost or self.resolver.locale != locale:
+            self.resolver = ObjectResolver(locale)
+        for cls, title in self._references(text):
+            self.resolver.want(cls, title)
+
         parser_kwargs = {'tags': tags} if tags else {}
-        return super(WikiParser, self).parse(text, show_toc=show_toc,
-            attributes=attributes or ALLOWED_ATTRIBUTES,
-            styles=styles or ALLOWED_STYLES, nofollow=nofollow,
-            **parser_kwargs)
+        try:
+            return super(WikiParser, self).parse(text, show_toc=show_toc,
+                attributes=attributes or ALLOWED_ATTRIBUTES,
+                styles=styles or ALLOWED_STYLES, nofollow=nofollow,
+                **parser_kwargs)
+        finally:
+            if outermost:
+                self.resolver = None
+
+    def _references(self, text):
+        """Yield a (class, title) pair for each object `text` refers to."""
+        from wiki.models import Document  # Circular import, see above.
+
+        for match in LINK_REGEX.finditer(text):
+            name = match.group(1)
+            space, _, rest = name.partition(':')
+            if rest and space in self.namespaces:
+                for reference in self.namespaces[space](rest):
+                    yield reference
+            else:
+                title = name.split('|', 1)[0].split('#', 1)[0]
+                yield Document, title
+
+    def _media_references(self, cls):
+        """Return a function yielding the references of [[Image:]]-style
+        markup."""
+        from wiki.models import Document  # Circular import, see above.
+
+        def references(name):
+            items = [i.strip() for i in name.split('|')]
+            yield cls, items[0]
+            for item in items[1:]:
+                if item.startswith('page='):
+                    yield Document, item[len('page='):]
+        return references
+
+    def _get_object(self, cls, title, default=None, **kwargs):
+        """Like get_object_fallback(), but using the resolver if we're
+        parsing."""
+        if self.resolver:
+            return self.resolver.get(cls, title, default, **kwargs)
+        return get_object_fallback(cls, title, self.locale, default, **kwargs)
+
+    @property
+    def namespaces(self):
+        """Map of namespace to a function yielding the references of markup
+        in it."""
+        return {'Image': self._media_references(Image)}
 
     def _hook_internal_link(self, parser, space, name):
         """Parses text and returns internal link."""
@@ -220,7 +388,7 @@ class WikiParser(Parser):
                 text = hash.replace('_', ' ')
             return u'<a href="%s">%s</a>' % (hash, text)
 
-        link = _get_wiki_link(title, self.locale)
+        link = _get_wiki_link(title, self.locale, self.resolver)
         a_cls = ''
         if not link['found']:
             a_cls = ' class="new"'
@@ -231,10 +399,10 @@ class WikiParser(Parser):
     def _hook_image_tag(self, parser, space, name):
         """Adds syntax for inserting images."""
         title, params = build_hook_params(name, self.locale, IMAGE_PARAMS,
-                                          IMAGE_PARAM_VALUES)
+                                          IMAGE_PARAM_VALUES, self.resolver)
 
         message = _lazy(u'The image "%s" does not exist.') % title
-        image = get_object_fallback(Image, title, self.locale, message)
+        image = self._get_object(Image, title, message)
         if isinstance(image, basestring):
             return image
 
@@ -1,10 +1,16 @@
+import base64
+import json
+
+from django.contrib.auth.models import User
+
 from nose.tools import eq_
 import test_utils
 import pyquery
 
+from sumo.tests import TestCase
 from sumo.urlresolvers import reverse
-from sumo.utils import paginate
-from sumo.helpers import paginator
+from sumo.utils import paginate, keyset_paginate
+from sumo.helpers import paginator, urlparams
 
 
 def test_paginated_url():
@@ -43,3 +49,44 @@ def test_paginator_filter():
     html = paginator(pager)
     doc = pyquery.PyQuery(html)
     eq_(13, len(doc('li')))
+
+
+class KeysetPaginateTests(TestCase):
+    fixtures = ['users.json']
+
+    def _page(self, **query):
+        request = test_utils.RequestFactory().get(reverse('search'), query)
+        return keyset_paginate(request, User.objects.order_by('-username'),
+                               per_page=2)
+
+    def test_walk(self):
+        """Following next and previous tokens visits every row once."""
+        usernames = [u.username for u in User.objects.order_by('-username')]
+        pages = [self._page()]
+        while pages[-1].has_next():
+            pages.append(self._page(after=pages[-1].next_token))
+        eq_(usernames, [u.username for p in pages for u in p])
+        eq_(range(1, len(pages) + 1), [p.number for p in pages])
+        assert not pages[0].has_previous()
+        assert pages[-1].has_previous()
+
+        page = pages[-1]
+        for previous in reversed(pages[:-1]):
+            page = self._page(before=page.previous_token)
+            eq_(previous.object_list, page.object_list)
+            eq_(previous.number, page.number)
+        assert not page.has_previous()
+
+    def test_invalid_token(self):
+        """A bad token gets the first page."""
+        eq_(self._page().object_list,
+            self._page(after='nonsense', page=3).object_list)
+        token = base64.urlsafe_b64encode(json.dumps([2, [{'a': 1}, 3]]))
+        eq_(self._page().object_list, self._page(after=token).object_list)
+
+    def test_paginator_filter(self):
+        page = self._page()
+        doc = pyquery.PyQuery(paginator(page))
+        eq_(urlparams(page.url, after=page.next_token),
+            doc('li.next a').attr('href'))
+        eq_(0, len(doc('li.prev')))
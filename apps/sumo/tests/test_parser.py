@@ -2,12 +2,14 @@ from functools import partial
 
 from django.conf import settings
 
+import mock
 from nose.tools import eq_
 from pyquery import PyQuery as pq
 
 from gallery.tests import image
 from sumo.parser import (WikiParser, build_hook_params, _get_wiki_link,
-                         get_object_fallback, IMAGE_PARAMS, IMAGE_PARAM_VALUES)
+                         get_object_fallback, ObjectResolver, IMAGE_PARAMS,
+                         IMAGE_PARAM_VALUES)
 from sumo.tests import TestCase
 from wiki.models import Document
 from wiki.tests import document, revision
@@ -141,6 +143,66 @@ class GetObjectFallbackTests(TestCase):
                                 redirect_rev.document.locale))
 
 
+class ObjectResolverTests(TestCase):
+    fixtures = ['users.json']
+
+    def _resolver(self, locale, *titles):
+        resolver = ObjectResolver(locale)
+        for title in titles:
+            resolver.want(Document, title)
+        return resolver
+
+    def test_fallbacks(self):
+        """The resolver answers like get_object_fallback."""
+        en_d = document(title='A doc', save=True)
+        revision(document=en_d, is_approved=True, save=True)
+        fr_d = document(parent=en_d, title='Une doc', locale='fr', save=True)
+        revision(document=fr_d, is_approved=True, save=True)
+        other = document(title='Other doc', save=True)
+
+        resolver = self._resolver('fr', 'A doc', 'Other doc', 'Une doc',
+                                  'Missing')
+        eq_(fr_d, resolver.get(Document, 'A doc'))
+        eq_(fr_d, resolver.get(Document, 'Une doc'))
+        eq_(other, resolver.get(Document, 'other doc'))
+        eq_('!', resolver.get(Document, 'Missing', '!'))
+        eq_('!', resolver.get(Document, 'Other doc', '!', is_template=True))
+
+    def test_redirect(self):
+        """The resolver follows wiki redirects."""
+        target_rev = revision(
+            document=document(title='target', save=True),
+            is_approved=True,
+            save=True)
+        translated_target_rev = revision(
+            document=document(parent=target_rev.document, locale='de',
+                              save=True),
+            is_approved=True,
+            save=True)
+        revision(
+            document=document(title='redirect', save=True),
+            content='REDIRECT [[target]]',
+            is_approved=True).save()
+
+        eq_(translated_target_rev.document,
+            self._resolver('de', 'redirect').get(Document, 'redirect'))
+
+    @mock.patch('sumo.parser.get_object_fallback')
+    def test_unwanted(self, get_object_fallback):
+        """Titles nobody asked for are looked up one by one."""
+        get_object_fallback.return_value = '!'
+        eq_('!', self._resolver('fr').get(Document, 'A doc'))
+        get_object_fallback.assert_called_with(Document, 'A doc', 'fr', None)
+
+    @mock.patch('sumo.parser.get_object_fallback')
+    def test_parse(self, get_object_fallback):
+        """Parsing looks up every link through the resolver."""
+        document(title='A doc', save=True)
+        html = WikiParser().parse('[[A doc]] [[A doc#s|text]] [[Missing]]')
+        assert not get_object_fallback.called
+        eq_(2, html.count('href="/en-US/kb/a-doc'))
+
+
 class TestWikiParser(TestCase):
     fixtures = ['users.json']
 
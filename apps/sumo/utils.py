@@ -36,6 +36,26 @@ def paginate(request, queryset, per_page=20, count=None):
     return paginated
 
 
+def keyset_paginate(request, queryset, per_page=20, count=None):
+    """Like paginate(), but seek to the page by the values of the ordering
+    columns in an "after" or "before" token instead of counting rows up to
+    a page number. Deep pages cost no more than the first."""
+    p = paginator.KeysetPaginator(queryset, per_page, count=count)
+    if request.GET.get('before'):
+        page = p.page(request.GET['before'], before=True)
+    else:
+        page = p.page(request.GET.get('after'))
+
+    base = request.build_absolute_uri(request.path)
+
+    items = [(k, v) for k in request.GET
+             if k not in ('page', 'after', 'before')
+             for v in request.GET.getlist(k) if v]
+
+    page.url = u'%s?%s' % (base, urlencode(items))
+    return page
+
+
 # By Ned Batchelder.
 def chunked(seq, n):
     """
@@ -1,3 +1,8 @@
-DIFF_WRAP_COLUMN = 40
+# Lines of context around the changes in revision diffs:
+DIFF_CONTEXT_LINES = 5
+# Characters of each revision compared in diffs:
+DIFF_MAX_CHARS = 100000
 TEMPLATE_TITLE_PREFIX = 'Template:'
 DOCUMENTS_PER_PAGE = 100
+# Titles, slugs and IDs one request to the bulk JSON view may look up:
+BULK_JSON_MAX_LOOKUPS = 100
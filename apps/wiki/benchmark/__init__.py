@@ -0,0 +1,140 @@
+"""Timings of each stage of the wiki parser over a corpus of markup.
+
+The corpus is the .txt files in corpus/: KB-style articles with heavily
+nested {for}s, many links and templates, large tables and image and video
+hooks, and a forum post. Each is run through the stages of
+wiki.parser.WikiParser.parse() one by one, and through both wiki_to_html()s
+whole. Results can be saved as JSON and compared with a later run; see the
+benchmark_parser management command.
+
+Python 2 has no allocation tracing, so "allocations" are the net number of
+objects the garbage collector started tracking during a stage, counted with
+collection turned off. That misses strings and numbers but follows the
+lists, dicts and tree nodes the parser builds.
+
+"""
+import gc
+import os
+import time
+
+from django.conf import settings
+
+import sumo.parser
+import wiki.parser
+from wiki.parser import ForParser, WikiParser, parse_simple_syntax
+
+
+CORPUS_DIR = os.path.join(os.path.dirname(__file__), 'corpus')
+
+STAGES = ('strip_fors', 'parse_simple_syntax', 'wikimarkup', 'unstrip_fors',
+          'ForParser', 'wiki.parser.wiki_to_html',
+          'sumo.parser.wiki_to_html')
+
+
+def load_corpus(path=CORPUS_DIR):
+    """Return a dict of {name: markup} of the .txt files in `path`."""
+    corpus = {}
+    for filename in sorted(os.listdir(path)):
+        name, ext = os.path.splitext(filename)
+        if ext == '.txt':
+            with open(os.path.join(path, filename)) as f:
+                corpus[name] = f.read().decode('utf-8')
+    return corpus
+
+
+def _median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+class _Meter(object):
+    """Collects the time and allocations of each call, per stage."""
+
+    def __init__(self):
+        self.samples = {}  # stage -> [(ms, objects), ...]
+
+    def __call__(self, stage, fn, *args, **kwargs):
+        objects = gc.get_count()[0]
+        start = time.time()
+        result = fn(*args, **kwargs)
+        ms = (time.time() - start) * 1000
+        objects = gc.get_count()[0] - objects
+        self.samples.setdefault(stage, []).append((ms, objects))
+        return result
+
+    def medians(self):
+        return dict((stage, {'ms': _median([ms for ms, _ in samples]),
+                             'objects': _median([o for _, o in samples])})
+                    for stage, samples in self.samples.iteritems())
+
+
+def _expand_fors(html):
+    for_parser = ForParser(html)
+    for_parser.expand_fors()
+    return for_parser.to_unicode()
+
+
+def _run(meter, markup, locale):
+    """Parse `markup` once, stage by stage, as WikiParser.parse() does."""
+    parser = WikiParser()
+    text, data = meter('strip_fors', ForParser.strip_fors, markup)
+    text = meter('parse_simple_syntax', parse_simple_syntax, text)
+    html = meter('wikimarkup', sumo.parser.WikiParser.parse, parser, text,
+                 show_toc=False, locale=locale)
+    html = meter('unstrip_fors', ForParser.unstrip_fors, html, data)
+    meter('ForParser', _expand_fors, html)
+    meter('wiki.parser.wiki_to_html', wiki.parser.wiki_to_html, markup,
+          locale)
+    meter('sumo.parser.wiki_to_html', sumo.parser.wiki_to_html, markup,
+          locale)
+
+
+def run(corpus, repeat=5, locale=settings.WIKI_DEFAULT_LANGUAGE):
+    """Time every stage for every document in `corpus`.
+
+    Returns {name: {stage: {'ms': median time, 'objects': median
+    allocations}}}. A first, untimed pass warms up imports and caches.
+
+    """
+    results = {}
+    enabled = gc.isenabled()
+    try:
+        for name, markup in sorted(corpus.iteritems()):
+            _run(_Meter(), markup, locale)
+            meter = _Meter()
+            for i in xrange(repeat):
+                gc.collect()
+                gc.disable()
+                try:
+                    _run(meter, markup, locale)
+                finally:
+                    gc.enable()
+            results[name] = meter.medians()
+    finally:
+        if not enabled:
+            gc.disable()
+    return results
+
+
+def compare(baseline, results, threshold=0.2, min_ms=1):
+    """Return the stages that got more than `threshold` slower than in
+    `baseline`, as (name, stage, baseline ms, ms) tuples.
+
+    Stages that take under `min_ms` in both runs are too noisy to compare.
+
+    """
+    regressions = []
+    for name, stages in sorted(results.iteritems()):
+        for stage, result in sorted(stages.iteritems()):
+            before = baseline.get(name, {}).get(stage)
+            if not before:
+                continue
+            old, new = before['ms'], result['ms']
+            if max(old, new) < min_ms:
+                continue
+            if new > old * (1 + threshold):
+                regressions.append((name, stage, old, new))
+    return regressions
@@ -1,60 +1,143 @@
+import operator
+
 from django.db import connection, transaction
+from django.db.models import Q
 
 import cronjobs
 
+from sumo.utils import chunked
 from wiki import tasks
+from wiki.models import (RelatedDocumentChange, invalidate_all_pages,
+                         invalidate_pages)
+
+
+# Pairs of approved documents in the same locale and category, with the
+# number of tags they have in common. %s is for more conditions on t1.
+RELATED_SQL = """
+    SELECT
+        t1.object_id,
+        t2.object_id,
+        COUNT(*) AS common_tags
+    FROM
+        wiki_document d1 JOIN
+        taggit_taggeditem t1 JOIN
+        taggit_taggeditem t2 JOIN
+        wiki_document d2
+    WHERE
+        d1.id = t1.object_id AND
+        t1.tag_id = t2.tag_id AND
+        t1.object_id <> t2.object_id AND
+        t1.content_type_id = (
+            SELECT
+                id
+            FROM
+                django_content_type
+            WHERE
+                app_label = 'wiki' AND
+                model = 'document'
+            ) AND
+        t2.content_type_id = (
+            SELECT
+                id
+            FROM
+                django_content_type
+            WHERE
+                app_label = 'wiki' AND
+                model = 'document'
+            ) AND
+        d2.id = t2.object_id AND
+        d2.locale = d1.locale AND
+        d2.category = d1.category AND
+        d1.current_revision_id IS NOT NULL AND
+        d2.current_revision_id IS NOT NULL
+        %s
+    GROUP BY
+        t1.object_id,
+        t2.object_id"""
+
+# Documents whose related ones are recalculated per round of queries:
+CHUNK_SIZE = 500
+
+
+def _update_related_documents(ids):
+    """Recalculate the related documents of the given ones, and theirs of
+    them, writing only the rows that changed and invalidating the cached
+    pages that list them."""
+    cursor = connection.cursor()
+    in_ids = ', '.join(['%s'] * len(ids))
+
+    # Relatedness is symmetric, so this gives both directions:
+    cursor.execute(RELATED_SQL % ('AND t1.object_id IN (%s)' % in_ids), ids)
+    new = {}
+    for document_id, related_id, in_common in cursor.fetchall():
+        new[(document_id, related_id)] = in_common
+        new[(related_id, document_id)] = in_common
+
+    cursor.execute('SELECT id, document_id, related_id, in_common '
+                   'FROM wiki_relateddocument '
+                   'WHERE document_id IN (%s) OR related_id IN (%s)' %
+                   (in_ids, in_ids), ids + ids)
+    stale = []
+    changed = set()
+    for id, document_id, related_id, in_common in cursor.fetchall():
+        key = (document_id, related_id)
+        if key not in new:
+            stale.append(id)
+            changed.add(document_id)
+        elif new[key] == in_common:
+            del new[key]
+
+    if stale:
+        cursor.execute('DELETE FROM wiki_relateddocument WHERE id IN (%s)' %
+                       ', '.join(['%s'] * len(stale)), stale)
+    if new:
+        cursor.executemany(
+            'INSERT INTO wiki_relateddocument '
+            '(document_id, related_id, in_common) VALUES (%s, %s, %s) '
+            'ON DUPLICATE KEY UPDATE in_common = VALUES(in_common)',
+            [(d, r, n) for (d, r), n in new.iteritems()])
+        changed.update(d for d, r in new)
+    return changed
 
 
 @cronjobs.register
 def calculate_related_documents():
-    """Calculates all related documents based on common tags."""
+    """Recalculate related documents, based on common tags, for the
+    documents whose tags, locale, category or approval changed since the
+    last run."""
+    changes = list(RelatedDocumentChange.uncached
+                   .values_list('document_id', 'version'))
+    for chunk in chunked(changes, CHUNK_SIZE):
+        changed = _update_related_documents([id for id, version in chunk])
+        # Changes made since we read them have a newer version and stay:
+        RelatedDocumentChange.uncached.filter(reduce(operator.or_, [
+            Q(document_id=id, version=version) for id, version in chunk
+        ])).delete()
+        transaction.commit_unless_managed()
+        invalidate_pages(changed)
 
-    cursor = connection.cursor()
 
-    cursor.execute('DELETE FROM wiki_relateddocument')
-    cursor.execute("""
-        INSERT INTO
-            wiki_relateddocument (document_id, related_id, in_common)
-        SELECT
-            t1.object_id,
-            t2.object_id,
-            COUNT(*) AS common_tags
-        FROM
-            wiki_document d1 JOIN
-            taggit_taggeditem t1 JOIN
-            taggit_taggeditem t2 JOIN
-            wiki_document d2
-        WHERE
-            d1.id = t1.object_id AND
-            t1.tag_id = t2.tag_id AND
-            t1.object_id <> t2.object_id AND
-            t1.content_type_id = (
-                SELECT
-                    id
-                FROM
-                    django_content_type
-                WHERE
-                    app_label = 'wiki' AND
-                    model = 'document'
-                ) AND
-            t2.content_type_id = (
-                SELECT
-                    id
-                FROM
-                    django_content_type
-                WHERE
-                    app_label = 'wiki' AND
-                    model = 'document'
-                ) AND
-            d2.id = t2.object_id AND
-            d2.locale = d1.locale AND
-            d2.category = d1.category AND
-            d1.current_revision_id IS NOT NULL AND
-            d2.current_revision_id IS NOT NULL
-        GROUP BY
-            t1.object_id,
-            t2.object_id""")
+@cronjobs.register
+def rebuild_related_documents():
+    """Recalculate all related documents, based on common tags.
+
+    The new rows are built in a copy of the table, which then replaces the
+    old one in one atomic rename, so readers never see it empty.
+
+    """
+    cursor = connection.cursor()
+    cursor.execute('DELETE FROM wiki_relateddocumentchange')
+    cursor.execute('DROP TABLE IF EXISTS wiki_relateddocument_new')
+    cursor.execute('CREATE TABLE wiki_relateddocument_new '
+                   'LIKE wiki_relateddocument')
+    cursor.execute('INSERT INTO wiki_relateddocument_new '
+                   '(document_id, related_id, in_common)' + RELATED_SQL % '')
+    cursor.execute('RENAME TABLE '
+                   'wiki_relateddocument TO wiki_relateddocument_old, '
+                   'wiki_relateddocument_new TO wiki_relateddocument')
+    cursor.execute('DROP TABLE wiki_relateddocument_old')
     transaction.commit_unless_managed()
+    invalidate_all_pages()
 
 
 @cronjobs.register
@@ -0,0 +1,279 @@
+"""Line diffs of wiki markup, with the changed words of changed lines
+highlighted.
+
+Lines are matched by patience diff: lines that occur exactly once on each
+side anchor the diff, in the longest run that keeps their order, and the
+gaps between anchors are diffed the same way. Gaps with no such lines fall
+back to Myers' diff. Changed lines are paired up in order and diffed the
+same way, word by word.
+
+The table looks like the one difflib.HtmlDiff makes, so it's styled the
+same, but only changed lines and their context are rendered.
+
+"""
+from bisect import bisect_left
+from cgi import escape
+import re
+
+from wiki import DIFF_CONTEXT_LINES, DIFF_MAX_CHARS
+
+
+# Bump this when a change here changes the HTML, so cached diffs made by the
+# old code aren't served.
+VERSION = 1
+
+# Past this many edits, Myers' diff gives up and calls what's left of a gap
+# one change. Its memory grows with the square of the edits.
+MAX_EDITS = 500
+
+WORD = re.compile(r'\w+|\s+|[^\w\s]', re.UNICODE)
+
+ROW = (u'<tr><td class="diff_header">%s</td><td class="diff_text">%s</td>'
+       u'<td class="diff_header">%s</td><td class="diff_text">%s</td></tr>')
+
+
+def truncate(content):
+    """Return `content` cut at the last line break before DIFF_MAX_CHARS
+    characters, and whether it was cut."""
+    if len(content) <= DIFF_MAX_CHARS:
+        return content, False
+    end = content.rfind(u'\n', 0, DIFF_MAX_CHARS)
+    return content[:end if end > 0 else DIFF_MAX_CHARS], True
+
+
+def _longest_increasing(pairs):
+    """Return the longest run of `pairs`, sorted by their first item, whose
+    second items increase too."""
+    tails = []  # The least second item ending a run of each length,
+    tail_indexes = []  # and the index of its pair.
+    previous = [None] * len(pairs)
+    for index, (i, j) in enumerate(pairs):
+        length = bisect_left(tails, j)
+        if length:
+            previous[index] = tail_indexes[length - 1]
+        if length == len(tails):
+            tails.append(j)
+            tail_indexes.append(index)
+        else:
+            tails[length] = j
+            tail_indexes[length] = index
+
+    run = []
+    index = tail_indexes[-1] if tail_indexes else None
+    while index is not None:
+        run.append(pairs[index])
+        index = previous[index]
+    run.reverse()
+    return run
+
+
+def _unique_anchors(a, alo, ahi, b, blo, bhi):
+    """Return the (i, j) pairs of items that occur once in a[alo:ahi] and
+    once in b[blo:bhi], in the longest run that keeps their order."""
+    counts = {}  # item -> [count in a, index in a, count in b, index in b]
+    for i in xrange(alo, ahi):
+        entry = counts.get(a[i])
+        if entry is None:
+            counts[a[i]] = [1, i, 0, None]
+        else:
+            entry[0] += 1
+    for j in xrange(blo, bhi):
+        entry = counts.get(b[j])
+        if entry is not None:
+            entry[2] += 1
+            entry[3] = j
+    return _longest_increasing(sorted(
+        (i, j) for count_a, i, count_b, j in counts.itervalues()
+        if count_a == 1 and count_b == 1))
+
+
+def _myers(a, alo, ahi, b, blo, bhi, matches):
+    """Append the (i, j) pairs of equal items of a shortest edit script
+    from a[alo:ahi] to b[blo:bhi] to `matches`."""
+    n, m = ahi - alo, bhi - blo
+    max_edits = min(n + m, MAX_EDITS)
+    offset = max_edits + 1
+    v = [0] * (2 * max_edits + 3)  # diagonal k + offset -> furthest x
+    trace = []
+    for d in xrange(max_edits + 1):
+        trace.append(v[:])
+        for k in xrange(-d, d + 1, 2):
+            if k == -d or (k != d and v[offset + k - 1] < v[offset + k + 1]):
+                x = v[offset + k + 1]
+            else:
+                x = v[offset + k - 1] + 1
+            y = x - k
+            while x < n and y < m and a[alo + x] == b[blo + y]:
+                x += 1
+                y += 1
+            v[offset + k] = x
+            if x >= n and y >= m:
+                break
+        else:
+            continue
+        break
+    else:
+        return  # Too different to be worth it.
+
+    found = []
+    x, y = n, m
+    for d in xrange(len(trace) - 1, -1, -1):
+        v = trace[d]
+        k = x - y
+        if k == -d or (k != d and v[offset + k - 1] < v[offset + k + 1]):
+            k += 1
+        else:
+            k -= 1
+        prev_x = v[offset + k]
+        prev_y = prev_x - k
+        while x > prev_x and y > prev_y:
+            x -= 1
+            y -= 1
+            found.append((alo + x, blo + y))
+        x, y = prev_x, prev_y
+    found.reverse()
+    matches.extend(found)
+
+
+def _match(a, alo, ahi, b, blo, bhi, matches):
+    """Append the (i, j) pairs of equal items of a[alo:ahi] and b[blo:bhi]
+    to `matches`, in order."""
+    while alo < ahi and blo < bhi and a[alo] == b[blo]:
+        matches.append((alo, blo))
+        alo += 1
+        blo += 1
+    suffix = []
+    while alo < ahi and blo < bhi and a[ahi - 1] == b[bhi - 1]:
+        ahi -= 1
+        bhi -= 1
+        suffix.append((ahi, bhi))
+
+    if alo < ahi and blo < bhi:
+        anchors = _unique_anchors(a, alo, ahi, b, blo, bhi)
+        if anchors:
+            for i, j in anchors:
+                _match(a, alo, i, b, blo, j, matches)
+                matches.append((i, j))
+                alo, blo = i + 1, j + 1
+            _match(a, alo, ahi, b, blo, bhi, matches)
+        else:
+            _myers(a, alo, ahi, b, blo, bhi, matches)
+
+    suffix.reverse()
+    matches.extend(suffix)
+
+
+def opcodes(a, b):
+    """Return how to turn sequence `a` into `b`, as (tag, i1, i2, j1, j2)
+    tuples like difflib.SequenceMatcher.get_opcodes() returns."""
+    matches = []
+    _match(a, 0, len(a), b, 0, len(b), matches)
+    matches.append((len(a), len(b)))
+
+    codes = []
+    i = j = 0
+    for next_i, next_j in matches:
+        if i < next_i or j < next_j:
+            if i < next_i and j < next_j:
+                tag = 'replace'
+            else:
+                tag = 'delete' if i < next_i else 'insert'
+            codes.append((tag, i, next_i, j, next_j))
+        if next_i == len(a):
+            break
+        if codes and codes[-1][0] == 'equal':
+            codes[-1] = ('equal', codes[-1][1], next_i + 1,
+                         codes[-1][3], next_j + 1)
+        else:
+            codes.append(('equal', next_i, next_i + 1, next_j, next_j + 1))
+        i, j = next_i + 1, next_j + 1
+    return codes
+
+
+def _hunks(codes, context):
+    """Group `codes` into hunks of changes with `context` equal lines
+    around them, as difflib.SequenceMatcher.get_grouped_opcodes() does."""
+    if not any(tag != 'equal' for tag, _, _, _, _ in codes):
+        return
+    codes = list(codes)
+    tag, i1, i2, j1, j2 = codes[0]
+    if tag == 'equal':
+        codes[0] = tag, max(i1, i2 - context), i2, max(j1, j2 - context), j2
+    tag, i1, i2, j1, j2 = codes[-1]
+    if tag == 'equal':
+        codes[-1] = tag, i1, min(i2, i1 + context), j1, min(j2, j1 + context)
+
+    hunk = []
+    for tag, i1, i2, j1, j2 in codes:
+        if tag == 'equal' and i2 - i1 > context * 2:
+            hunk.append((tag, i1, i1 + context, j1, j1 + context))
+            yield hunk
+            hunk = []
+            i1, j1 = i2 - context, j2 - context
+        hunk.append((tag, i1, i2, j1, j2))
+    if hunk and not (len(hunk) == 1 and hunk[0][0] == 'equal'):
+        yield hunk
+
+
+def _words(line_from, line_to):
+    """Return the two lines as HTML, with their changed words marked."""
+    words_from, words_to = WORD.findall(line_from), WORD.findall(line_to)
+    html_from, html_to = [], []
+    for tag, i1, i2, j1, j2 in opcodes(words_from, words_to):
+        text_from = escape(u''.join(words_from[i1:i2]))
+        text_to = escape(u''.join(words_to[j1:j2]))
+        if tag == 'equal':
+            html_from.append(text_from)
+            html_to.append(text_to)
+        elif tag == 'delete':
+            html_from.append(u'<span class="diff_sub">%s</span>' % text_from)
+        elif tag == 'insert':
+            html_to.append(u'<span class="diff_add">%s</span>' % text_to)
+        else:
+            html_from.append(u'<span class="diff_chg">%s</span>' % text_from)
+            html_to.append(u'<span class="diff_chg">%s</span>' % text_to)
+    return u''.join(html_from), u''.join(html_to)
+
+
+def _rows(lines_from, lines_to, hunk):
+    """Yield the table rows of a hunk."""
+    for tag, i1, i2, j1, j2 in hunk:
+        if tag == 'equal':
+            for i, j in zip(xrange(i1, i2), xrange(j1, j2)):
+                yield ROW % (i + 1, escape(lines_from[i]),
+                             j + 1, escape(lines_to[j]))
+            continue
+
+        # Pair up changed lines in order; the rest were added or removed.
+        for n in xrange(max(i2 - i1, j2 - j1)):
+            i, j = i1 + n, j1 + n
+            if i < i2 and j < j2:
+                html_from, html_to = _words(lines_from[i], lines_to[j])
+                yield ROW % (i + 1, html_from, j + 1, html_to)
+            elif i < i2:
+                yield ROW % (i + 1, u'<span class="diff_sub">%s</span>' %
+                             escape(lines_from[i]), u'', u'')
+            else:
+                yield ROW % (u'', u'', j + 1,
+                             u'<span class="diff_add">%s</span>' %
+                             escape(lines_to[j]))
+
+
+def table(content_from, content_to, context=DIFF_CONTEXT_LINES):
+    """Return an HTML table of the changed lines of two pieces of content,
+    with `context` lines around them, or '' if there are none.
+
+    Each is compared only up to DIFF_MAX_CHARS characters; see truncate().
+
+    """
+    lines_from = truncate(content_from)[0].splitlines()
+    lines_to = truncate(content_to)[0].splitlines()
+    codes = opcodes(lines_from, lines_to)
+    html = []
+    for hunk in _hunks(codes, context):
+        html.append(u'<tbody>')
+        html.extend(_rows(lines_from, lines_to, hunk))
+        html.append(u'</tbody>')
+    if not html:
+        return u''
+    return u'<table class="diff">%s</table>' % u''.join(html)
@@ -1,19 +1,49 @@
-from difflib import HtmlDiff
+from django.conf import settings
+from django.core.cache import cache
 
 from jingo import register
 import jinja2
+from tower import ugettext as _
 
-from wiki import DIFF_WRAP_COLUMN
+from wiki import diff, DIFF_MAX_CHARS
 from wiki import parser
 
 
+# Rendered diffs of revisions, which don't change, by version of the diff
+# code and revision IDs:
+DIFF_KEY = 'sumo:wiki:diff:%s:%s:%s'
+
+
+def _diff_table(table, content_from, content_to):
+    if not table:
+        return jinja2.Markup(u'<p class="diff-none">%s</p>' %
+                             jinja2.escape(_('No differences found.')))
+    if len(content_from) > DIFF_MAX_CHARS or len(content_to) > DIFF_MAX_CHARS:
+        table += u'<p class="diff-truncated">%s</p>' % jinja2.escape(
+            _('Only the first {n} characters of each revision are '
+              'compared.').format(n=DIFF_MAX_CHARS))
+    return jinja2.Markup(table)
+
+
 @register.function
 def diff_table(content_from, content_to):
     """Creates an HTML diff of the passed in content_from and content_to."""
-    html_diff = HtmlDiff(wrapcolumn=DIFF_WRAP_COLUMN)
-    diff = html_diff.make_table(content_from.splitlines(),
-                                content_to.splitlines(), context=True)
-    return jinja2.Markup(diff)
+    return _diff_table(diff.table(content_from, content_to), content_from,
+                       content_to)
+
+
+@register.function
+def revision_diff_table(revision_from, revision_to):
+    """Like diff_table(), for the content of two revisions, cached."""
+    if not (revision_from.id and revision_to.id):
+        return diff_table(revision_from.content, revision_to.content)
+
+    key = DIFF_KEY % (diff.VERSION, revision_from.id, revision_to.id)
+    table = cache.get(key)
+    if table is None:
+        table = diff.table(revision_from.content, revision_to.content)
+        cache.set(key, table, settings.WIKI_DIFF_CACHE_TIMEOUT)
+    return _diff_table(table, revision_from.content, revision_to.content)
 
 
 @register.function
@@ -0,0 +1,66 @@
+import json
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from wiki import benchmark
+
+
+class Command(BaseCommand):
+    help = ('Time each stage of the wiki parser over a corpus of markup, '
+            'optionally comparing with a saved baseline.')
+    option_list = BaseCommand.option_list + (
+        make_option('--repeat', dest='repeat', type='int', default=5,
+                    help='Parse each document this many times.'),
+        make_option('--corpus', dest='corpus', default=benchmark.CORPUS_DIR,
+                    help='Directory of .txt files of markup to parse.'),
+        make_option('--locale', dest='locale',
+                    default=settings.WIKI_DEFAULT_LANGUAGE,
+                    help='Locale to look up links, images and videos in.'),
+        make_option('--save', dest='save', metavar='FILE',
+                    help='Save the results as a baseline in FILE.'),
+        make_option('--baseline', dest='baseline', metavar='FILE',
+                    help='Compare with the baseline saved in FILE and fail '
+                         'if a stage got slower.'),
+        make_option('--threshold', dest='threshold', type='float',
+                    default=20,
+                    help='Percent slower than the baseline that counts as a '
+                         'regression.'),
+    )
+
+    def handle(self, *args, **options):
+        baseline = {}
+        if options['baseline']:
+            with open(options['baseline']) as f:
+                baseline = json.load(f)
+
+        corpus = benchmark.load_corpus(options['corpus'])
+        if not corpus:
+            raise CommandError('No .txt files in %s.' % options['corpus'])
+        results = benchmark.run(corpus, options['repeat'], options['locale'])
+
+        for name, stages in sorted(results.iteritems()):
+            print '%s (%s characters)' % (name, len(corpus[name]))
+            for stage in benchmark.STAGES:
+                result = stages[stage]
+                line = '  %-26s %9.2f ms %9d objects' % (
+                    stage, result['ms'], result['objects'])
+                before = baseline.get(name, {}).get(stage)
+                if before and before['ms']:
+                    line += '  %+6.1f%%' % (
+                        (result['ms'] - before['ms']) * 100 / before['ms'])
+                print line
+
+        if options['save']:
+            with open(options['save'], 'w') as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+
+        if baseline:
+            regressions = benchmark.compare(baseline, results,
+                                            options['threshold'] / 100)
+            if regressions:
+                raise CommandError('\n'.join(
+                    '%s: %s took %.2f ms, was %.2f ms' % (name, stage, new,
+                                                          old)
+                    for name, stage, old, new in regressions))
@@ -1,19 +1,27 @@
 from collections import namedtuple
 from datetime import datetime
 from itertools import chain
+import re
+import time
 from urlparse import urlparse
+from xml.sax.saxutils import unescape
 
 from django.conf import settings
 from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
 from django.core.exceptions import ValidationError
 from django.core.urlresolvers import resolve
-from django.db import models
+from django.db import connection, models, transaction
+from django.db.models import F
+from django.db.models.signals import post_init, post_save, post_delete
 from django.http import Http404
 
-from pyquery import PyQuery
+from taggit.models import TaggedItem
 from tidings.models import NotificationsMixin
 from tower import ugettext_lazy as _lazy, ugettext as _
 
+from gallery.models import Image, Video
 from sumo import ProgrammingError
 from sumo_locales import LOCALES
 from sumo.models import ModelBase, LocaleField
@@ -93,9 +101,22 @@ OPERATING_SYSTEMS = tuple(chain(*[options for label, options in
 
 REDIRECT_HTML = '<p>REDIRECT <a '  # how a redirect looks as rendered HTML
 REDIRECT_CONTENT = 'REDIRECT [[%s]]'
+# The target of a redirect is the first link in its HTML:
+REDIRECT_HREF = re.compile(r'<p>REDIRECT <a [^>]*?\bhref="([^"]*)"')
 REDIRECT_TITLE = _lazy(u'%(old)s Redirect %(number)i')
 REDIRECT_SLUG = _lazy(u'%(old)s-redirect-%(number)i')
 
+# IDs of the documents a visitor voted on, by user ID or anonymous ID:
+VOTED_KEY = 'sumo:wiki:voted:%s'
+
+# Rendered fragments of document pages, by generation, version of the
+# document's page, locale, slug and mobile flag:
+PAGE_KEY = 'sumo:wiki:page:%s:%s:%s:%s:%s'
+PAGE_GENERATION_KEY = 'sumo:wiki:page-generation'
+PAGE_VERSION_KEY = 'sumo:wiki:page-version:%s'  # document ID
+# Memcached's longest relative timeout:
+PAGE_VERSION_TIMEOUT = 60 * 60 * 24 * 30
+
 
 class TitleCollision(Exception):
     """An attempt to create two pages of the same title in one locale"""
@@ -160,9 +181,23 @@ class Document(NotificationsMixin, ModelBase, BigVocabTaggableMixin):
                                                through='RelatedDocument',
                                                symmetrical=False)
 
+    # Creators of my approved revisions, kept up to date as revisions are
+    # approved and deleted:
+    contributors = models.ManyToManyField(User, editable=False,
+                                          related_name='contributed_documents')
+
     # Cached HTML rendering of approved revision's wiki markup:
     html = models.TextField(editable=False)
 
+    # The Document my html redirects to, if I'm a redirect to one. Set along
+    # with html, so following a redirect is a lookup by primary key.
+    redirect_to = models.ForeignKey('self', related_name='redirects',
+                                    null=True, editable=False)
+
+    # Counts of HelpfulVotes, kept up to date as they're cast:
+    helpful_votes = models.IntegerField(default=0, editable=False)
+    unhelpful_votes = models.IntegerField(default=0, editable=False)
+
     # A document's category much always be that of its parent. If it has no
     # parent, it can do what it wants. This invariant is enforced in save().
     category = models.IntegerField(choices=CATEGORIES, db_index=True)
@@ -238,6 +273,10 @@ class Document(NotificationsMixin, ModelBase, BigVocabTaggableMixin):
         else:  # An article cannot have both a parent and children.
             # Make my children the same as me:
             if self.id:
+                moved = (self.translations.exclude(category=self.category)
+                         .values_list('id', flat=True))
+                for id in moved:
+                    RelatedDocumentChange.mark(id)
                 self.translations.all().update(category=self.category)
 
     def _attr_for_redirect(self, attr, template):
@@ -336,6 +375,30 @@ class Document(NotificationsMixin, ModelBase, BigVocabTaggableMixin):
 
         return self.current_revision.content_parsed
 
+    def set_dependencies(self, ids):
+        """Record that my HTML includes the documents with the given IDs."""
+        ids = set(ids)
+        existing = set(DocumentDependency.uncached.filter(document=self)
+                       .values_list('depends_on', flat=True))
+        if existing - ids:
+            DocumentDependency.uncached.filter(
+                document=self, depends_on__in=existing - ids).delete()
+        for id in ids - existing:
+            DocumentDependency.objects.create(document=self, depends_on_id=id)
+
+    def get_dependents(self):
+        """Return the IDs of the documents whose HTML includes mine, directly
+        or through other documents."""
+        dependents = set()
+        todo = [self.id]
+        while todo:
+            found = set(DocumentDependency.uncached
+                        .filter(depends_on__in=todo)
+                        .values_list('document', flat=True))
+            todo = list(found - dependents - set([self.id]))
+            dependents.update(todo)
+        return dependents
+
     @property
     def language(self):
         return settings.LANGUAGES[self.locale.lower()]
@@ -394,23 +457,57 @@ class Document(NotificationsMixin, ModelBase, BigVocabTaggableMixin):
         Otherwise, return None.
 
         """
-        # If a document starts with REDIRECT_HTML and contains any <a> tags
-        # with hrefs, return the href of the first one. This trick saves us
-        # from having to parse the HTML every time.
+        # If a document starts with REDIRECT_HTML, return the href of the
+        # link that follows. This trick saves us from having to parse the
+        # HTML.
         if self.html.startswith(REDIRECT_HTML):
-            anchors = PyQuery(self.html)('a[href]')
-            if anchors:
-                return anchors[0].get('href')
+            match = REDIRECT_HREF.match(self.html)
+            if match:
+                return unescape(match.group(1), {'&quot;': '"',
+                                                 '&#39;': "'"})
+
+    def find_redirect_target(self):
+        """Return the approved Document my html redirects to, with only its
+        ID fetched, or None if I'm not a redirect to one."""
+        url = self.redirect_url()
+        if url:
+            return self.from_url(url, id_only=True)
 
-    def redirect_document(self):
+    def _redirect_target(self):
+        # redirect_to is only as current as html, so trust it only if html
+        # is still a redirect.
+        url = self.redirect_url()
+        if not url:
+            return None
+        if self.redirect_to_id:
+            try:
+                return self.redirect_to
+            except Document.DoesNotExist:
+                return None
+        # Not known yet, as on redirects saved before redirect_to was, or not
+        # a link to an approved Document:
+        return self.from_url(url)
+
+    def redirect_document(self, follow=False):
         """If I am a redirect to a Document, return that Document.
 
         Otherwise, return None.
 
+        follow -- whether to follow a chain of redirects to the Document at
+            its end. Return None if the chain loops.
+
         """
-        url = self.redirect_url()
-        if url:
-            return self.from_url(url)
+        doc = self._redirect_target()
+        if not follow:
+            return doc
+        seen = set([self.id])
+        while doc and doc.id not in seen:
+            seen.add(doc.id)
+            target = doc._redirect_target()
+            if not target:
+                return doc
+            doc = target
+        return None
 
     def __unicode__(self):
         return '[%s] %s' % (self.locale, self.title)
@@ -461,16 +558,22 @@ class Document(NotificationsMixin, ModelBase, BigVocabTaggableMixin):
     def has_voted(self, request):
         """Did the user already vote for this document?"""
         if request.user.is_authenticated():
-            qs = HelpfulVote.objects.filter(document=self,
-                                            creator=request.user)
+            voter = 'u%s' % request.user.id
+            filters = {'creator': request.user}
         elif request.anonymous.has_id:
-            anon_id = request.anonymous.anonymous_id
-            qs = HelpfulVote.objects.filter(document=self,
-                                            anonymous_id=anon_id)
+            voter = 'a%s' % request.anonymous.anonymous_id
+            filters = {'anonymous_id': request.anonymous.anonymous_id}
         else:
             return False
 
-        return qs.exists()
+        # One query per visitor rather than one per visitor and document:
+        voted = cache.get(VOTED_KEY % voter)
+        if voted is None:
+            voted = frozenset(HelpfulVote.uncached.filter(**filters)
+                              .values_list('document', flat=True))
+            cache.set(VOTED_KEY % voter, voted,
+                      settings.WIKI_VOTED_CACHE_TIMEOUT)
+        return self.id in voted
 
     def is_majorly_outdated(self):
         """Return whether a MAJOR_SIGNIFICANCE-level update has occurred to the
@@ -518,6 +621,10 @@ class Revision(ModelBase):
     # create this revision. Used to determine whether localizations are out of
     # date.
     based_on = models.ForeignKey('self', null=True, blank=True)
+
+    # Counts of HelpfulVotes cast while I was the current revision:
+    helpful_votes = models.IntegerField(default=0, editable=False)
+    unhelpful_votes = models.IntegerField(default=0, editable=False)
     # TODO: limit_choices_to={'document__locale':
     # settings.WIKI_DEFAULT_LANGUAGE} is a start but not sufficient.
 
@@ -577,15 +684,25 @@ class Revision(ModelBase):
                                    'to a revision of the default-'
                                    'language document.')
 
+        became_approved = self.is_approved and not getattr(
+            self, '_was_approved', False)
         super(Revision, self).save(*args, **kwargs)
+        self._was_approved = self.is_approved
+
+        if became_approved:
+            self.document.contributors.add(self.creator)
+            invalidate_pages([self.document_id])
 
         # When a revision is approved, re-cache the document's html content
         if self.is_approved and (
                 not self.document.current_revision or
                 self.document.current_revision.id < self.id):
-            self.document.html = self.content_parsed
+            html, dependencies = self.render()
+            self.document.html = html
+            self.document.redirect_to = self.document.find_redirect_target()
             self.document.current_revision = self
             self.document.save()
+            self.document.set_dependencies(dependencies)
 
     def __unicode__(self):
         return u'[%s] %s #%s: %s' % (self.document.locale,
@@ -594,9 +711,18 @@ class Revision(ModelBase):
 
     @property
     def content_parsed(self):
-        from wiki.parser import wiki_to_html
-        return wiki_to_html(self.content, locale=self.document.locale,
-                            doc_id=self.document.id)
+        from wiki.parser import cached_wiki_to_html
+        return cached_wiki_to_html(self.content, locale=self.document.locale,
+                                   doc_id=self.document.id)
+
+    def render(self):
+        """Return my content parsed, and the set of IDs of the documents it
+        includes or uses as templates."""
+        from wiki.parser import WikiParser
+        parser = WikiParser(doc_id=self.document.id)
+        html = parser.parse(self.content, show_toc=False,
+                            locale=self.document.locale)
+        return html, parser.dependencies
 
 
 # FirefoxVersion and OperatingSystem map many ints to one Document. The
@@ -625,12 +751,30 @@ class OperatingSystem(ModelBase):
 class HelpfulVote(ModelBase):
     """Helpful or Not Helpful vote on Document."""
     document = models.ForeignKey(Document, related_name='poll_votes')
+    # The document's current revision when the vote was cast:
+    revision = models.ForeignKey(Revision, related_name='poll_votes',
+                                 null=True)
     helpful = models.BooleanField(default=False)
     created = models.DateTimeField(default=datetime.now, db_index=True)
     creator = models.ForeignKey(User, related_name='poll_votes', null=True)
     anonymous_id = models.CharField(max_length=40, db_index=True)
     user_agent = models.CharField(max_length=1000)
 
+    def save(self, *args, **kwargs):
+        """Count new votes on the document and revision."""
+        new = not self.pk
+        super(HelpfulVote, self).save(*args, **kwargs)
+        if new:
+            field = 'helpful_votes' if self.helpful else 'unhelpful_votes'
+            counter = {field: F(field) + 1}
+            Document.uncached.filter(pk=self.document_id).update(**counter)
+            if self.revision_id:
+                Revision.uncached.filter(pk=self.revision_id).update(
+                    **counter)
+            voter = ('u%s' % self.creator_id if self.creator_id else
+                     'a%s' % self.anonymous_id)
+            cache.delete(VOTED_KEY % voter)
+
 
 class RelatedDocument(ModelBase):
     document = models.ForeignKey(Document, related_name='related_from')
@@ -639,6 +783,192 @@ class RelatedDocument(ModelBase):
 
     class Meta(object):
         ordering = ['-in_common']
+        unique_together = (('document', 'related'),)
+
+
+class RelatedDocumentChange(ModelBase):
+    """A document whose related documents need recalculating, because its
+    tags, locale, category or approval changed.
+
+    version counts the changes, so one made while the cron job runs isn't
+    lost when the job clears those it handled.
+
+    """
+    document_id = models.IntegerField(primary_key=True)
+    version = models.IntegerField(default=0)
+
+    @staticmethod
+    def mark(document_id):
+        cursor = connection.cursor()
+        cursor.execute('INSERT INTO wiki_relateddocumentchange '
+                       '(document_id, version) VALUES (%s, 0) '
+                       'ON DUPLICATE KEY UPDATE version = version + 1',
+                       [document_id])
+        transaction.commit_unless_managed()
+
+
+class DocumentDependency(ModelBase):
+    """A document whose HTML includes another one or uses it as a template.
+
+    When the other document changes, the first one has to be re-rendered.
+
+    """
+    document = models.ForeignKey(Document, related_name='dependencies')
+    depends_on = models.ForeignKey(Document, related_name='dependents')
+
+    class Meta(object):
+        unique_together = ('document', 'depends_on')
+
+
+def page_cache_key(document, locale, mobile):
+    """Return the key of the rendered fragments of `document`'s page, as
+    shown in `locale` on the mobile or desktop site."""
+    version_key = PAGE_VERSION_KEY % document.id
+    versions = cache.get_many([PAGE_GENERATION_KEY, version_key])
+    for key in (PAGE_GENERATION_KEY, version_key):
+        if key not in versions:
+            # Start from the time, so a version that falls out of the cache
+            # can't bring back fragments cached under it.
+            cache.add(key, int(time.time()), PAGE_VERSION_TIMEOUT)
+            versions[key] = cache.get(key, int(time.time()))
+    return PAGE_KEY % (versions[PAGE_GENERATION_KEY], versions[version_key],
+                       locale, document.slug, int(bool(mobile)))
+
+
+def _bump(key):
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, int(time.time()), PAGE_VERSION_TIMEOUT)
+
+
+def invalidate_pages(document_ids):
+    """Invalidate the cached fragments of the given documents' pages."""
+    for id in set(document_ids):
+        _bump(PAGE_VERSION_KEY % id)
+
+
+def invalidate_all_pages():
+    """Invalidate the cached fragments of every document's page."""
+    _bump(PAGE_GENERATION_KEY)
+
+
+def _parse_state(document):
+    """Return what other documents' parsed HTML shows of a document: where
+    links to it go, which document its title finds, and what including it
+    shows."""
+    return (document.locale, document.slug, document.title,
+            document.parent_id, document.redirect_to_id,
+            document.current_revision_id)
+
+
+def _document_saved_parsed(sender, instance, created, **kwargs):
+    """Invalidate cached parsed HTML, which may link to or include the
+    document, if the change shows there. Vote counts and re-rendered html
+    don't."""
+    state = _parse_state(instance)
+    if created or state != getattr(instance, '_parse_state', None):
+        _parsed_changed(sender)
+    instance._parse_state = state
+
+
+def _parsed_changed(sender, **kwargs):
+    """Invalidate cached parsed HTML, which shows documents, images and
+    videos."""
+    from wiki.parser import bump_parsed_generation
+    bump_parsed_generation()
+
+
+post_save.connect(_document_saved_parsed, sender=Document,
+                  dispatch_uid='wiki_document_saved_parsed')
+post_delete.connect(_parsed_changed, sender=Document,
+                    dispatch_uid='wiki_document_deleted_parsed')
+post_save.connect(_parsed_changed, sender=Image,
+                  dispatch_uid='wiki_image_saved_parsed')
+post_delete.connect(_parsed_changed, sender=Image,
+                    dispatch_uid='wiki_image_deleted_parsed')
+post_save.connect(_parsed_changed, sender=Video,
+                  dispatch_uid='wiki_video_saved_parsed')
+post_delete.connect(_parsed_changed, sender=Video,
+                    dispatch_uid='wiki_video_deleted_parsed')
+
+
+def _related_state(document):
+    """Return what, besides its tags, decides a document's related ones."""
+    return (document.locale, document.category,
+            document.current_revision_id is not None)
+
+
+def _link_state(document):
+    """Return what links to a document show of it."""
+    return (document.locale, document.slug, document.title)
+
+
+def _document_initialized(sender, instance, **kwargs):
+    instance._related_state = _related_state(instance)
+    instance._link_state = _link_state(instance)
+    instance._parse_state = _parse_state(instance)
+
+
+def _document_saved_related(sender, instance, created, **kwargs):
+    state = _related_state(instance)
+    if created or state != getattr(instance, '_related_state', None):
+        instance._related_state = state
+        RelatedDocumentChange.mark(instance.id)
+
+
+def _document_saved_page(sender, instance, created, **kwargs):
+    """Invalidate the cached page of the document (whose content or
+    contributors may have changed with an approval) and, if it was renamed,
+    those listing it as related."""
+    ids = [instance.id]
+    state = _link_state(instance)
+    if state != getattr(instance, '_link_state', state):
+        ids.extend(RelatedDocument.uncached.filter(related=instance)
+                   .values_list('document', flat=True))
+    instance._link_state = state
+    invalidate_pages(ids)
+
+
+def _tagged_item_changed(sender, instance, **kwargs):
+    if (instance.content_type_id ==
+        ContentType.objects.get_for_model(Document).id):
+        RelatedDocumentChange.mark(instance.object_id)
+        invalidate_pages([instance.object_id])
+
+
+post_init.connect(_document_initialized, sender=Document,
+                  dispatch_uid='wiki_document_initialized_related')
+post_save.connect(_document_saved_related, sender=Document,
+                  dispatch_uid='wiki_document_saved_related')
+post_save.connect(_document_saved_page, sender=Document,
+                  dispatch_uid='wiki_document_saved_page')
+post_save.connect(_tagged_item_changed, sender=TaggedItem,
+                  dispatch_uid='wiki_tagged_item_saved_related')
+post_delete.connect(_tagged_item_changed, sender=TaggedItem,
+                    dispatch_uid='wiki_tagged_item_deleted_related')
+
+
+def _revision_initialized(sender, instance, **kwargs):
+    # Revision.save() adds contributors only when a revision becomes approved.
+    instance._was_approved = bool(instance.pk) and instance.is_approved
+
+
+def _revision_deleted(sender, instance, **kwargs):
+    """Remove the creator of a deleted approved revision from the document's
+    contributors, unless they have other approved revisions of it."""
+    if instance.is_approved and not Revision.uncached.filter(
+            document=instance.document_id, creator=instance.creator_id,
+            is_approved=True).exists():
+        Document.contributors.through.objects.filter(
+            document=instance.document_id, user=instance.creator_id).delete()
+        invalidate_pages([instance.document_id])
+
+
+post_init.connect(_revision_initialized, sender=Revision,
+                  dispatch_uid='wiki_revision_initialized_contributors')
+post_delete.connect(_revision_deleted, sender=Revision,
+                    dispatch_uid='wiki_revision_deleted_contributors')
 
 
 def get_current_or_latest_revision(document, reviewed_only=True):
@@ -1,11 +1,17 @@
+import hashlib
 from itertools import count
 from os.path import basename
 import re
+import time
 from xml.sax.saxutils import quoteattr
 
 from django.conf import settings
+from django.core.cache import cache
 
 from html5lib import HTMLParser
+from html5lib.constants import (booleanAttributes, headingElements,
+                                scopingElements, spaceCharacters,
+                                specialElements)
 from html5lib.serializer.htmlserializer import HTMLSerializer
 from html5lib.treebuilders import getTreeBuilder
 from html5lib.treewalkers import getTreeWalker
@@ -16,8 +22,7 @@ from tower import ugettext as _, ugettext_lazy as _lazy
 
 from gallery.models import Video
 import sumo.parser
-from sumo.parser import (ALLOWED_ATTRIBUTES, get_object_fallback,
-                         build_hook_params)
+from sumo.parser import ALLOWED_ATTRIBUTES, build_hook_params
 
 
 BLOCK_LEVEL_ELEMENTS = ['table', 'blockquote', 'h1', 'h2', 'h3', 'h4', 'h5',
@@ -29,6 +34,18 @@ VIDEO_PARAMS = ['height', 'width', 'modal', 'title', 'placeholder']
 TEMPLATE_ARG_REGEX = re.compile('{{{([^{]+?)}}}')
 
 
+def _names(elements):
+    """Return the tag names in one of html5lib's sets of elements."""
+    return frozenset(e[1] if isinstance(e, tuple) else e for e in elements)
+
+# How html5lib treats elements, for the ForParser's fast path:
+BOOLEAN_ATTRIBUTES = booleanAttributes
+HEADINGS = _names(headingElements)
+SCOPING = _names(scopingElements)
+SPECIAL = _names(specialElements) | SCOPING
+SPACE_CHARACTERS = ''.join(spaceCharacters)
+
+
 def wiki_to_html(wiki_markup, locale=settings.WIKI_DEFAULT_LANGUAGE,
                  doc_id=None):
     """Wiki Markup -> HTML with the wiki app's enhanced parser"""
@@ -36,6 +53,60 @@ def wiki_to_html(wiki_markup, locale=settings.WIKI_DEFAULT_LANGUAGE,
                                            locale=locale)
 
 
+# Bump this when a change to the parser changes its output, so HTML cached by
+# the old parser isn't served.
+PARSER_VERSION = 1
+
+PARSED_KEY = 'sumo:wiki:parsed:%s:%s'  # generation, hash of the input
+PARSED_GENERATION_KEY = 'sumo:wiki:parsed-generation'
+# Memcached's longest relative timeout:
+PARSED_GENERATION_TIMEOUT = 60 * 60 * 24 * 30
+
+
+def parsed_generation():
+    """Return the current generation of cached parsed HTML."""
+    generation = cache.get(PARSED_GENERATION_KEY)
+    if generation is None:
+        # Start from the time, so a generation that falls out of the cache
+        # can't bring back HTML cached under it.
+        cache.add(PARSED_GENERATION_KEY, int(time.time()),
+                  PARSED_GENERATION_TIMEOUT)
+        generation = cache.get(PARSED_GENERATION_KEY, int(time.time()))
+    return generation
+
+
+def bump_parsed_generation():
+    """Invalidate all cached parsed HTML.
+
+    What markup renders to depends on the documents it links to and
+    includes, so this is called whenever a document changes.
+
+    """
+    try:
+        cache.incr(PARSED_GENERATION_KEY)
+    except ValueError:
+        cache.set(PARSED_GENERATION_KEY, int(time.time()),
+                  PARSED_GENERATION_TIMEOUT)
+
+
+def cached_wiki_to_html(wiki_markup, locale=settings.WIKI_DEFAULT_LANGUAGE,
+                        doc_id=None):
+    """Like wiki_to_html(), but cache the HTML by a hash of the input.
+
+    Use this for pages that only show the HTML, like previews and reviews,
+    which are often reloaded.
+
+    """
+    digest = hashlib.md5(repr((PARSER_VERSION, locale, doc_id,
+                               wiki_markup))).hexdigest()
+    key = PARSED_KEY % (parsed_generation(), digest)
+    html = cache.get(key)
+    if html is None:
+        html = wiki_to_html(wiki_markup, locale=locale, doc_id=doc_id)
+        cache.set(key, html, settings.WIKI_PARSED_CACHE_TIMEOUT)
+    return html
+
+
 def _format_template_content(content, params):
     """Formats a template's content using passed in arguments"""
 
@@ -107,6 +178,236 @@ def parse_simple_syntax(text):
     return text
 
 
+class _Unsupported(Exception):
+    """Raised by _ForBalancer on markup it can't vouch for."""
+
+
+class _For(object):
+    """A <for> element found by _ForBalancer."""
+
+    def __init__(self, data_for):
+        self.data_for = data_for  # Serialized value of data-for, or None
+        self.tag = 'for'
+        self.has_block_child = False
+
+    def start_tag(self):
+        attrs = ' class="for"' if self.tag != 'for' else ''
+        if self.data_for is not None:
+            attrs += ' data-for="%s"' % self.data_for
+        return u'<%s%s>' % (self.tag, attrs)
+
+    def end_tag(self):
+        return u'</%s>' % self.tag
+
+
+class _ForBalancer(object):
+    """Balances <for> tags in one left-to-right pass over the HTML.
+
+    The rest of the HTML has to be what html5lib would serialize it to,
+    which the wiki formatter's output is. Then the only tags to move are the
+    fors, and we can do what html5lib would do with them without building a
+    tree: an end tag closes the fors left open inside its element, and a
+    </for> closes the innermost for if nothing else is open inside it, or
+    is dropped if a block element is.
+
+    Anything outside of that model, like a for in a table row, an unclosed
+    element or a character reference, raises _Unsupported, and the caller
+    falls back to html5lib.
+
+    """
+    _TAG = re.compile(r'<(/?)([a-z][a-z0-9]*)((?: [a-z][a-z0-9_-]*='
+                      r'"(?:[^"&]|&amp;)*")*)>')
+    _ATTR = re.compile(r' ([a-z][a-z0-9_-]*)="([^"]*)"')
+    _FOR_ATTRS = re.compile(r'^(?: data-for="([^"&<>]*)")?$')
+    _BAD_TEXT = re.compile(r'>|&(?!(?:amp|lt|gt);)')
+    # Characters html5lib may replace or drop:
+    _BAD_CHARS = re.compile(u'[\x00-\x08\x0b-\x1f\x7f-\x9f'
+                            u'\ud800-\udfff\ufdd0-\ufdef\ufffe\uffff]')
+
+    # What html5lib does with the start tags we know about:
+    _CLOSES_P = frozenset(['address', 'article', 'aside', 'blockquote',
+                           'center', 'details', 'dir', 'div', 'dl',
+                           'fieldset', 'figure', 'footer', 'header',
+                           'hgroup', 'menu', 'nav', 'ol', 'p', 'section',
+                           'ul', 'pre', 'hr', 'table'] + list(HEADINGS))
+    _LIST_ITEMS = {'li': ('li',), 'dd': ('dd', 'dt'), 'dt': ('dd', 'dt')}
+    _FORMATTING = frozenset(['b', 'big', 'code', 'em', 'font', 'i', 's',
+                             'small', 'strike', 'strong', 'tt', 'u'])
+    _PLAIN = frozenset(['span', 'sub', 'sup', 'abbr', 'acronym', 'cite',
+                        'kbd', 'samp', 'var', 'q', 'dfn', 'ins', 'del',
+                        'bdo'])
+    _VOID = frozenset(['br', 'img', 'hr', 'col'])
+    # Elements whose children html5lib handles in one of its table modes,
+    # and the children it leaves where they are:
+    _TABLE_CHILDREN = {'table': ('caption', 'colgroup', 'tbody', 'thead',
+                                 'tfoot'),
+                       'tbody': ('tr',), 'thead': ('tr',), 'tfoot': ('tr',),
+                       'tr': ('td', 'th'), 'colgroup': ('col',)}
+    _TABLE_PARTS = frozenset(['caption', 'col', 'colgroup', 'tbody', 'td',
+                              'tfoot', 'th', 'thead', 'tr'])
+
+    def __init__(self, html):
+        self.html = html
+        # Open elements: a tag name, or a _For. The bottom one stands for
+        # the container html5lib parses the fragment in.
+        self.stack = ['html']
+        self.chunks = []
+        self.fresh_pre = False  # Whether a <pre> was just opened
+
+    def balance(self):
+        """Return the balanced HTML as a list of strings and _Fors, each
+        _For standing for its start tag the first time and its end tag the
+        second."""
+        html = self.html
+        if self._BAD_CHARS.search(html):
+            raise _Unsupported
+        pos = 0
+        while True:
+            lt = html.find('<', pos)
+            if lt == -1:
+                self._text(html[pos:])
+                break
+            self._text(html[pos:lt])
+            match = self._TAG.match(html, lt)
+            if not match:
+                raise _Unsupported
+            closing, name, attrs = match.groups()
+            if closing:
+                if attrs:
+                    raise _Unsupported
+                self._end_tag(name)
+            else:
+                self._start_tag(name, attrs)
+            pos = match.end()
+        while len(self.stack) > 1:
+            if not isinstance(self.stack[-1], _For):
+                raise _Unsupported
+            self.chunks.append(self.stack.pop())
+        return self.chunks
+
+    def _current(self):
+        current = self.stack[-1]
+        return 'for' if isinstance(current, _For) else current
+
+    def _in_table(self):
+        return self._current() in self._TABLE_CHILDREN
+
+    def _in_scope(self, name):
+        for node in reversed(self.stack):
+            if node == name:
+                return True
+            if not isinstance(node, _For) and node in SCOPING:
+                return False
+        return False
+
+    def _text(self, text):
+        if not text:
+            return
+        if self._BAD_TEXT.search(text):
+            raise _Unsupported
+        if self._in_table() and text.strip(SPACE_CHARACTERS):
+            raise _Unsupported  # html5lib would move it out of the table.
+        if self.fresh_pre and text.startswith('\n'):
+            # html5lib drops a newline right after <pre>, though not in
+            # every version inside table cells and captions.
+            if [n for n in self.stack if n in ('td', 'th', 'caption')]:
+                raise _Unsupported
+            text = text[1:]
+        self.fresh_pre = False
+        self.chunks.append(text)
+
+    def _start_tag(self, name, attrs):
+        self.fresh_pre = False
+        current = self._current()
+        if current in self._TABLE_CHILDREN:
+            if name not in self._TABLE_CHILDREN[current]:
+                raise _Unsupported
+        elif name in self._TABLE_PARTS:
+            raise _Unsupported
+        elif name in self._CLOSES_P:
+            if self._in_scope('p'):
+                raise _Unsupported
+            if name in HEADINGS and current in HEADINGS:
+                raise _Unsupported
+        elif name in self._LIST_ITEMS:
+            if self._in_scope('p'):
+                raise _Unsupported
+            for node in reversed(self.stack):
+                if node in self._LIST_ITEMS[name]:
+                    raise _Unsupported
+                if (not isinstance(node, _For) and node in SPECIAL and
+                    node not in ('address', 'div', 'p')):
+                    break
+        elif name == 'a':
+            if 'a' in self.stack:
+                raise _Unsupported
+        elif name in self._FORMATTING:
+            # Don't get into html5lib's limit of 3 of a kind:
+            if self.stack.count(name) >= 2:
+                raise _Unsupported
+        elif name != 'for' and name not in self._PLAIN and (
+            name not in self._VOID):
+            raise _Unsupported
+
+        if isinstance(self.stack[-1], _For) and name in BLOCK_LEVEL_ELEMENTS:
+            self.stack[-1].has_block_child = True
+
+        if name == 'for':
+            match = self._FOR_ATTRS.match(attrs)
+            if not match:
+                raise _Unsupported
+            element = _For(match.group(1))
+            self.chunks.append(element)
+            self.stack.append(element)
+            return
+
+        self._check_attrs(name, attrs)
+        self.chunks.append(u'<%s%s>' % (name, attrs))
+        if name not in self._VOID:
+            self.stack.append(name)
+            self.fresh_pre = name == 'pre'
+
+    def _check_attrs(self, name, attrs):
+        """Make sure html5lib would serialize the attributes the same."""
+        boolean = (BOOLEAN_ATTRIBUTES.get(name, frozenset()) |
+                   BOOLEAN_ATTRIBUTES.get('', frozenset()))
+        previous = ''
+        for attr, value in self._ATTR.findall(attrs):
+            # html5lib sorts attributes and drops duplicates:
+            if attr <= previous:
+                raise _Unsupported
+            if attr in boolean and value in ('', attr):
+                raise _Unsupported
+            previous = attr
+
+    def _end_tag(self, name):
+        stack = self.stack
+        if name == 'for':
+            if self._in_table():
+                raise _Unsupported
+            for i in xrange(len(stack) - 1, -1, -1):
+                node = stack[i]
+                if isinstance(node, _For):
+                    if i != len(stack) - 1:
+                        # html5lib would close the elements in between.
+                        raise _Unsupported
+                    self.fresh_pre = False
+                    self.chunks.append(stack.pop())
+                    return
+                if node in SPECIAL:
+                    return  # html5lib ignores the stray </for>.
+            return
+
+        self.fresh_pre = False
+        # Close the fors left open inside the element:
+        while isinstance(stack[-1], _For):
+            self.chunks.append(stack.pop())
+        if stack[-1] != name or len(stack) == 1:
+            raise _Unsupported
+        stack.pop()
+        self.chunks.append(u'</%s>' % name)
+
+
 class ForParser(object):
     """HTML 5 parser which finds <for> tags and translates them into spans and
     divs having the proper data- elements and classes.
@@ -119,7 +420,18 @@ class ForParser(object):
     CONTAINER_TAG = 'div'
 
     def __init__(self, html):
-        """Create a parse tree from the given HTML."""
+        """Balance the for tags in the given HTML.
+
+        Most HTML is balanced in one pass by _ForBalancer. The rest gets an
+        html5lib parse tree.
+
+        """
+        try:
+            self._chunks = _ForBalancer(html).balance()
+            return
+        except _Unsupported:
+            self._chunks = None
+
         def really_parse_fragment(parser, html):
             """Parse a possibly multi-rooted HTML fragment, wrapping it in a
             <div> to make it easy to query later.
@@ -152,6 +464,12 @@ class ForParser(object):
         Otherwise, it turns into a span.
 
         """
+        if self._chunks is not None:
+            for chunk in self._chunks:
+                if isinstance(chunk, _For):
+                    chunk.tag = 'div' if chunk.has_block_child else 'span'
+            return
+
         html_ns = 'http://www.w3.org/1999/xhtml'
         for for_el in self._root.xpath('//html:for',
                                        namespaces={'html': html_ns}):
@@ -163,6 +481,19 @@ class ForParser(object):
 
     def to_unicode(self):
         """Return the unicode serialization of myself."""
+        if self._chunks is not None:
+            opened = set()
+            html = []
+            for chunk in self._chunks:
+                if not isinstance(chunk, _For):
+                    html.append(chunk)
+                elif chunk in opened:
+                    html.append(chunk.end_tag())
+                else:
+                    opened.add(chunk)
+                    html.append(chunk.start_tag())
+            return u''.join(html)
+
         container_len = len(self.CONTAINER_TAG) + 2  # 2 for the <>
         walker = getTreeWalker(self.TREEBUILDER)
         stream = walker(self._root)
@@ -171,7 +502,7 @@ class ForParser(object):
         return serializer.render(stream)[container_len:-container_len - 1]
 
     @staticmethod
-    def _on_own_line(match, postspace):
+    def _on_own_line(match, postspace, last=None):
         """Return (whether the tag is on its own line, whether the tag is at
         the very top of the string, whether the tag is at the very bottom of
         the string).
@@ -179,13 +510,21 @@ class ForParser(object):
         Tolerates whitespace to the right of the tag: a tag with trailing
         whitespace on the line can still be considered to be on its own line.
 
+        last -- the last character output before the match, or '' if there
+            was none, when that differs from what precedes the match in
+            match.string
+
         """
-        pos_before_tag = match.start(2) - 1
-        if pos_before_tag >= 0:
-            at_left = match.string[pos_before_tag] == '\n'
-            at_top = False
+        if last is None or match.group(1):
+            pos_before_tag = match.start(2) - 1
+            if pos_before_tag >= 0:
+                at_left = match.string[pos_before_tag] == '\n'
+                at_top = False
+            else:
+                at_left = at_top = True
         else:
-            at_left = at_top = True
+            at_top = not last
+            at_left = at_top or last == '\n'
         at_bottom_modulo_space = match.end(4) == len(match.string)
         at_right_modulo_space = at_bottom_modulo_space or '\n' in postspace
         return (at_left and at_right_modulo_space,
@@ -214,30 +553,27 @@ class ForParser(object):
                 dehydrated fors for use with unstrip_fors).
 
         """
+        def paragraph_padding(str):
+            """If str doesn't contain at least 2 newlines, return enough
+            such that appending them will cause it to."""
+            return '\n' * max(2 - str.count('\n'), 0)
+
         # Replace {for ...} tags:
         dehydrations = {}  # "attributes" of {for a, b} directives, like
                            # "a, b", keyed by token number
         indexes = count()
 
-        def dehydrate(match):
-            """Close over `dehydrations`, sock the {for}s away therein, and
-            replace {for}s and {/for}s with tokens."""
-            def paragraph_padding(str):
-                """If str doesn't contain at least 2 newlines, return enough
-                such that appending them will cause it to."""
-                return '\n' * max(2 - str.count('\n'), 0)
-
-            def preceding_whitespace(str, pos):
-                """Return all contiguous whitespace preceding str[pos]."""
-                whitespace = []
-                for i in xrange(pos - 1, 0, -1):
-                    if str[i] in '\t \n\r':
-                        whitespace.append(str[i])
-                    else:
-                        break
-                whitespace.reverse()
-                return ''.join(whitespace)
-
+        # Build the output in one pass. Whitespace added for one tag can help
+        # nudge the next, adjacent one into its own paragraph, so each tag
+        # looks at the output so far rather than at the original text. Only
+        # the last chunk matters: text between tags starts and ends with
+        # non-whitespace, since the tags' pre- and postspace soak it up.
+        chunks = []
+        pos = 0
+        for match in cls._FOR_OR_CLOSER.finditer(text):
+            if match.start() > pos:
+                chunks.append(text[pos:match.start()])
+            pos = match.end()
             prespace, tag, attrs, postspace = match.groups()
 
             if tag != '{/for}':
@@ -252,7 +588,9 @@ class ForParser(object):
             # has enough newlines on each side to make it its own paragraph,
             # lest it get sucked into being part of the next or previous
             # paragraph:
-            on_own_line, at_top, at_bottom = cls._on_own_line(match, postspace)
+            last = chunks[-1] if chunks else u''
+            on_own_line, at_top, at_bottom = cls._on_own_line(
+                match, postspace, last[-1:])
             if on_own_line:
                 # If tag (excluding leading whitespace) wasn't at top of
                 # document, space it off from preceding block elements:
@@ -260,31 +598,20 @@ class ForParser(object):
                     # If there are already enough \ns before the tag to
                     # distance it from the preceding paragraph, take them into
                     # account before adding more.
-                    prespace += paragraph_padding(
-                                    preceding_whitespace(match.string,
-                                                         match.start(1))
-                                    + prespace)
+                    preceding = last[len(last.rstrip('\t \n\r')):]
+                    prespace += paragraph_padding(preceding + prespace)
 
                 # If tag (including trailing whitespace) wasn't at the bottom
                 # of the document, space it off from following block elements:
                 if not at_bottom:
                     postspace += paragraph_padding(postspace)
 
-            return prespace + token + postspace
+            chunks.append(prespace + token + postspace)
 
-        # Do single replaces over and over, taking into account the effects of
-        # previous ones so that whitespace added in a previous replacement can
-        # be considered for its role in helping to nudge an adjacent block-
-        # level {for} into its own paragraph. There's no pos arg to replace(),
-        # so we had to write our own.
-        pos = 0
-        while True:
-            m = cls._FOR_OR_CLOSER.search(text, pos)
-            if m is None:
-                return text, dehydrations
-            done = text[:m.start()] + dehydrate(m)  # already been searched
-            pos = len(done)
-            text = done + text[m.end():]
+        if not chunks:
+            return text, dehydrations
+        chunks.append(text[pos:])
+        return u''.join(chunks), dehydrations
 
     # Dratted wiki formatter likes to put <p> tags around my token when it sits
     # on a line by itself, so tolerate and consume that foolishness:
@@ -342,6 +669,9 @@ class WikiParser(sumo.parser.WikiParser):
         # Stack of document IDs to prevent Include or Template recursion:
         self.inclusions = [doc_id] if doc_id else []
 
+        # IDs of the documents included or used as templates, at any depth:
+        self.dependencies = set()
+
         # The wiki has additional hooks not used elsewhere
         self.registerInternalLinkHook('Include', self._hook_include)
         self.registerInternalLinkHook('I', self._hook_include)
@@ -350,6 +680,19 @@ class WikiParser(sumo.parser.WikiParser):
         self.registerInternalLinkHook('Video', self._hook_video)
         self.registerInternalLinkHook('V', self._hook_video)
 
+    @property
+    def namespaces(self):
+        from wiki.models import Document
+        namespaces = super(WikiParser, self).namespaces
+        include = lambda title: [(Document, title)]
+        template = lambda title: [(Document,
+                                   'Template:' + title.split('|', 1)[0])]
+        video = self._media_references(Video)
+        namespaces.update({'Include': include, 'I': include,
+                           'Template': template, 'T': template,
+                           'Video': video, 'V': video})
+        return namespaces
+
     def parse(self, text, **kwargs):
         """Wrap SUMO's parse() to support additional wiki-only features."""
         # Replace fors with inline tokens the wiki formatter will tolerate:
@@ -376,7 +719,7 @@ class WikiParser(sumo.parser.WikiParser):
         """Returns the document's parsed content."""
         from wiki.models import Document
         message = _('The document "%s" does not exist.') % title
-        t = get_object_fallback(Document, title, locale=self.locale)
+        t = self._get_object(Document, title)
         if not t or not t.current_revision:
             return message
 
@@ -384,6 +727,7 @@ class WikiParser(sumo.parser.WikiParser):
             return RECURSION_MESSAGE % title
         else:
             parser.inclusions.append(t.id)
+        self.dependencies.add(t.id)
         ret = parser.parse(t.current_revision.content, show_toc=False,
                            locale=self.locale)
         parser.inclusions.pop()
@@ -405,8 +749,7 @@ class WikiParser(sumo.parser.WikiParser):
 
         message = _('The template "%s" does not exist or has no approved '
                     'revision.') % short_title
-        t = get_object_fallback(Document, template_title,
-                                locale=self.locale, is_template=True)
+        t = self._get_object(Document, template_title, is_template=True)
 
         if not t or not t.current_revision:
             return message
@@ -415,6 +758,7 @@ class WikiParser(sumo.parser.WikiParser):
             return RECURSION_MESSAGE % template_title
         else:
             parser.inclusions.append(t.id)
+        self.dependencies.add(t.id)
         c = t.current_revision.content.rstrip()
         # Note: this completely ignores the allowed attributes passed to the
         # WikiParser.parse() method and defaults to ALLOWED_ATTRIBUTES.
@@ -438,9 +782,10 @@ class WikiParser(sumo.parser.WikiParser):
         message = _lazy(u'The video "%s" does not exist.') % title
 
         # params, only modal supported for now
-        title, params = build_hook_params(title, self.locale, VIDEO_PARAMS)
+        title, params = build_hook_params(title, self.locale, VIDEO_PARAMS,
+                                          resolver=self.resolver)
 
-        v = get_object_fallback(Video, title, self.locale, message)
+        v = self._get_object(Video, title, message)
         if isinstance(v, basestring):
             return v
 
@@ -1,9 +1,9 @@
 import logging
+import time
 
 from django.conf import settings
 from django.contrib.sites.models import Site
 from django.core.cache import cache
-from django.core.exceptions import ValidationError
 from django.core.mail import send_mail, mail_admins
 from django.db import transaction
 from django.template import Context, loader
@@ -15,11 +15,14 @@ from tower import ugettext as _
 
 from sumo.urlresolvers import reverse
 from sumo.utils import chunked
-from wiki.models import Document, SlugCollision, TitleCollision
+from wiki.models import Document
 
 
 log = logging.getLogger('k.task')
 
+# A day, long enough to outlast any rebuild:
+REBUILD_PROGRESS_TIMEOUT = 60 * 60 * 24
+
 
 @task
 def send_reviewed_notification(revision, document, message):
@@ -62,19 +65,89 @@ def schedule_rebuild_kb():
     rebuild_kb.delay()
 
 
+# Progress of the latest KB rebuild: a dict of its document count and start
+# time, and a counter of documents rendered so far.
+REBUILD_PROGRESS_KEY = 'sumo:wiki:rebuild-progress'
+REBUILD_DONE_KEY = 'sumo:wiki:rebuild-done'
+# Set once a full rebuild has recorded what every document includes. Until
+# then, or if it falls out of the cache, changes rebuild the whole KB.
+DEPENDENCIES_KNOWN_KEY = 'sumo:wiki:dependencies-known'
+# Memcached's longest relative timeout:
+DEPENDENCIES_KNOWN_TIMEOUT = 60 * 60 * 24 * 30
+
+
 @task(rate_limit='3/h')
 def rebuild_kb():
-    """Re-render all documents in the KB in chunks."""
+    """Re-render all documents in the KB in chunks.
+
+    The chunks are rendered in parallel by as many celery workers as are
+    free. See rebuild_kb_progress() for how far along a rebuild is.
+
+    """
     cache.delete(settings.WIKI_REBUILD_TOKEN)
 
-    d = (Document.objects.using('default')
-         .filter(current_revision__isnull=False).values_list('id', flat=True))
+    d = list(Document.objects.using('default')
+             .filter(current_revision__isnull=False)
+             .values_list('id', flat=True))
 
-    for chunk in chunked(d, 100):
+    cache.set(REBUILD_PROGRESS_KEY, {'total': len(d), 'started': time.time()},
+              REBUILD_PROGRESS_TIMEOUT)
+    cache.set(REBUILD_DONE_KEY, 0, REBUILD_PROGRESS_TIMEOUT)
+
+    for chunk in chunked(d, settings.WIKI_REBUILD_CHUNK_SIZE):
         _rebuild_kb_chunk.apply_async(args=[chunk])
 
 
-@task(rate_limit='20/m')
+def rebuild_after_change(document_id):
+    """Re-render what a change to a document's HTML affects: the documents
+    that include it if those are known, or else the whole KB."""
+    if not settings.WIKI_REBUILD_ON_DEMAND:
+        return
+    if cache.get(DEPENDENCIES_KNOWN_KEY):
+        rebuild_dependents.delay(document_id)
+    else:
+        schedule_rebuild_kb()
+
+
+def rebuild_kb_progress():
+    """Return how far along the latest KB rebuild is, or None.
+
+    Returns a dict with the number of documents to render ('total') and
+    rendered so far ('done'), and an estimate of the seconds left ('eta').
+
+    """
+    progress = cache.get(REBUILD_PROGRESS_KEY)
+    if not progress:
+        return None
+    done = min(cache.get(REBUILD_DONE_KEY) or 0, progress['total'])
+    elapsed = time.time() - progress['started']
+    if done:
+        eta = elapsed / done * (progress['total'] - done)
+    else:
+        eta = None
+    return {'total': progress['total'], 'done': done, 'eta': eta}
+
+
+def _render(document):
+    """Re-render a document and record what it includes."""
+    html, dependencies = document.current_revision.render()
+    # Only write documents whose HTML changed, and only what changed: most of
+    # a rebuild re-renders documents to what they were.
+    changes = {}
+    if html != document.html:
+        changes['html'] = document.html = html
+    target = document.find_redirect_target()
+    if (target and target.id) != document.redirect_to_id:
+        changes['redirect_to'] = target
+    if changes:
+        document.update(**changes)
+    document.set_dependencies(dependencies)
+
+
+# acks_late: if the worker dies while rendering, the broker hands the chunk
+# to another worker, so a crash doesn't leave part of the KB stale.
+# Rendering a chunk twice is harmless.
+@task(acks_late=True)
 def _rebuild_kb_chunk(data, **kwargs):
     """Re-render a chunk of documents."""
     log.info('Rebuilding %s documents.' % len(data))
@@ -82,24 +155,21 @@ def _rebuild_kb_chunk(data, **kwargs):
     pin_this_thread()  # Stick to master.
 
     messages = []
+    documents = (Document.uncached.select_related('current_revision')
+                 .in_bulk(data))
     for pk in data:
         message = None
-        try:
-            document = Document.objects.get(pk=pk)
-            if document.redirect_url():
-                if not document.redirect_document():
-                    document.delete()
-            else:
-                document.html = document.current_revision.content_parsed
-                document.save()
-        except Document.DoesNotExist:
+        document = documents.get(pk)
+        if not document:
             message = 'Missing document: %d' % pk
-        except ValidationError as e:
-            message = 'ValidationError for %d: %s' % (pk, e.messages[0])
-        except SlugCollision:
-            message = 'SlugCollision: %d' % pk
-        except TitleCollision:
-            message = 'TitleCollision: %d' % pk
+        elif document.redirect_url():
+            target = document.find_redirect_target()
+            if not target:
+                document.delete()
+            elif target.id != document.redirect_to_id:
+                document.update(redirect_to=target)
+        else:
+            _render(document)
 
         if message:
             log.debug(message)
@@ -111,4 +181,37 @@ def _rebuild_kb_chunk(data, **kwargs):
         mail_admins(subject=subject, message='\n'.join(messages))
     transaction.commit_unless_managed()
 
+    try:
+        done = cache.incr(REBUILD_DONE_KEY, len(data))
+    except ValueError:
+        pass  # The progress fell out of the cache.
+    else:
+        progress = cache.get(REBUILD_PROGRESS_KEY)
+        if progress and done >= progress['total']:
+            cache.set(DEPENDENCIES_KNOWN_KEY, True,
+                      DEPENDENCIES_KNOWN_TIMEOUT)
+    progress = rebuild_kb_progress()
+    if progress and progress['eta'] is not None:
+        log.info('Rebuilt %(done)s of %(total)s documents, about %(eta)d '
+                 'seconds left.' % progress)
+
     unpin_this_thread()  # Not all tasks need to do use the master.
+
+
+@task
+def rebuild_dependents(document_id):
+    """Re-render the documents that include a document or use it as a
+    template, directly or through other documents."""
+    pin_this_thread()
+
+    document = Document.uncached.get(pk=document_id)
+    dependents = (Document.uncached.select_related('current_revision')
+                  .filter(pk__in=document.get_dependents(),
+                          current_revision__isnull=False))
+    log.info('Rebuilding %s documents that include %s.' %
+             (len(dependents), document_id))
+    for dependent in dependents:
+        _render(dependent)
+    transaction.commit_unless_managed()
+
+    unpin_this_thread()
@@ -0,0 +1,35 @@
+from nose.tools import eq_
+
+from sumo.tests import TestCase
+from wiki import benchmark
+
+
+class BenchmarkTests(TestCase):
+    def test_run(self):
+        """Every stage is timed for every document."""
+        results = benchmark.run({'doc': u'{for mac}[[Foo]] {key ctrl}{/for}'},
+                                repeat=3)
+        eq_(['doc'], results.keys())
+        eq_(set(benchmark.STAGES), set(results['doc']))
+        assert all(r['ms'] >= 0 for r in results['doc'].values())
+
+    def test_corpus(self):
+        """The shipped corpus loads."""
+        corpus = benchmark.load_corpus()
+        assert 'for_nesting' in corpus
+        assert all(isinstance(m, unicode) for m in corpus.values())
+
+
+def test_compare():
+    """Only stages more than the threshold slower, and not too fast to
+    measure, are regressions."""
+    baseline = {'a': {'strip_fors': {'ms': 10, 'objects': 5},
+                      'ForParser': {'ms': 10, 'objects': 5},
+                      'unstrip_fors': {'ms': 0.1, 'objects': 1}},
+                'b': {'strip_fors': {'ms': 10, 'objects': 5}}}
+    results = {'a': {'strip_fors': {'ms': 11, 'objects': 5},
+                     'ForParser': {'ms': 13, 'objects': 5},
+                     'unstrip_fors': {'ms': 0.5, 'objects': 1}},
+               'c': {'strip_fors': {'ms': 50, 'objects': 5}}}
+    eq_([('a', 'ForParser', 10, 13)],
+        benchmark.compare(baseline, results, threshold=0.2))
@@ -0,0 +1,73 @@
+from nose.tools import eq_
+from pyquery import PyQuery as pq
+
+from wiki import diff, DIFF_MAX_CHARS
+
+
+def _apply(a, b, codes):
+    """Rebuild `b` from `a` and the opcodes, checking they're consistent."""
+    out = []
+    i = j = 0
+    for tag, i1, i2, j1, j2 in codes:
+        eq_((i, j), (i1, j1))
+        if tag == 'equal':
+            eq_(a[i1:i2], b[j1:j2])
+        out.extend(b[j1:j2])
+        i, j = i2, j2
+    eq_((len(a), len(b)), (i, j))
+    return out
+
+
+def test_opcodes():
+    a = ['a', 'b', 'c', 'd', 'b', 'e']
+    b = ['x', 'a', 'c', 'b', 'b', 'e', 'y']
+    codes = diff.opcodes(a, b)
+    eq_(b, _apply(a, b, codes))
+    eq_([('insert', 0, 0, 0, 1), ('equal', 0, 1, 1, 2),
+         ('delete', 1, 2, 2, 2), ('equal', 2, 3, 2, 3),
+         ('replace', 3, 4, 3, 4), ('equal', 4, 6, 4, 6),
+         ('insert', 6, 6, 6, 7)], codes)
+
+
+def test_opcodes_no_unique_lines():
+    """Gaps without unique lines fall back to a shortest edit script."""
+    a = ['}', '}', '{', '}', '{']
+    b = ['{', '}', '}', '{', '{', '}']
+    codes = diff.opcodes(a, b)
+    eq_(b, _apply(a, b, codes))
+    eq_(4, sum(i2 - i1 for tag, i1, i2, _, _ in codes if tag == 'equal'))
+
+
+def test_table_words():
+    """Changed words within a changed line are highlighted."""
+    table = pq(diff.table(u'one\n<b>two three</b>\nfour',
+                          u'one\n<b>two four</b>\nfour\nfive'))
+    eq_(['three', 'four'], [pq(s).text() for s in table('span.diff_chg')])
+    eq_('five', table('span.diff_add').text())
+    eq_(4, len(table('tr')))
+    assert '<b>' not in diff.table(u'a', u'<b>')
+
+
+def test_table_context():
+    """Only changed lines and their context are shown."""
+    lines = [u'line %s' % i for i in xrange(100)]
+    changed = list(lines)
+    changed[10] = u'changed'
+    changed[90] = u'changed too'
+    table = pq(diff.table(u'\n'.join(lines), u'\n'.join(changed),
+                          context=2))
+    eq_(2, len(table('tbody')))
+    eq_(10, len(table('tr')))
+
+
+def test_table_no_differences():
+    eq_(u'', diff.table(u'same\nlines', u'same\nlines'))
+
+
+def test_truncate():
+    content = (u'x' * 10 + u'\n') * (DIFF_MAX_CHARS // 10)
+    truncated, cut = diff.truncate(content)
+    assert cut
+    assert len(truncated) <= DIFF_MAX_CHARS
+    assert truncated.endswith(u'x')
+    eq_((u'short', False), diff.truncate(u'short'))
@@ -1,18 +1,21 @@
 from datetime import datetime, timedelta
 
+import mock
 from nose.tools import eq_
 from taggit.models import TaggedItem
 
 from django.core.exceptions import ValidationError
 
+from gallery.tests import image
 from sumo import ProgrammingError
-from sumo.tests import TestCase
+from sumo.tests import TestCase, get_user
 from wiki.cron import calculate_related_documents
 from wiki.models import (FirefoxVersion, OperatingSystem, Document,
-                         REDIRECT_CONTENT, REDIRECT_SLUG, REDIRECT_TITLE,
-                         REDIRECT_HTML, MAJOR_SIGNIFICANCE, CATEGORIES,
-                         get_current_or_latest_revision)
-from wiki.parser import wiki_to_html
+                         RelatedDocumentChange, REDIRECT_CONTENT,
+                         REDIRECT_SLUG, REDIRECT_TITLE, REDIRECT_HTML,
+                         MAJOR_SIGNIFICANCE, CATEGORIES,
+                         Revision, get_current_or_latest_revision)
+from wiki.parser import parsed_generation, wiki_to_html
 from wiki.tests import document, revision, doc_rev, translated_revision
 
 
@@ -308,6 +311,26 @@ class DocumentTestsWithFixture(TestCase):
             ('A translation was not considered majorly outdated when its '
              "current revision's based_on value was None.")
 
+    def test_parsed_generation(self):
+        """Cached parsed HTML is invalidated by changes that show in other
+        documents, not by vote counts or re-rendered html."""
+        d = revision(is_approved=True, save=True).document
+        generation = parsed_generation()
+        d.update(helpful_votes=3, html=u'<p>Re-rendered</p>')
+        eq_(generation, parsed_generation())
+        d.title = u'Another title'
+        d.save()
+        assert parsed_generation() > generation
+
+    def test_parsed_generation_media(self):
+        """Cached parsed HTML is invalidated when images change."""
+        generation = parsed_generation()
+        img = image()
+        assert parsed_generation() > generation
+        generation = parsed_generation()
+        img.delete()
+        assert parsed_generation() > generation
+
     def test_redirect_document_non_redirect(self):
         """Assert redirect_document on non-redirects returns None."""
         eq_(None, document().redirect_document())
@@ -324,6 +347,35 @@ class DocumentTestsWithFixture(TestCase):
                            is_approved=True,
                            save=True).document.redirect_document())
 
+    def test_redirect_to(self):
+        """Approving a redirect records the document it points to."""
+        target = revision(is_approved=True, save=True).document
+        redirect = redirect_rev('Redirect', target.title).document
+        eq_(target.id, Document.uncached.get(pk=redirect.pk).redirect_to_id)
+        eq_(target, redirect.redirect_document())
+
+    def test_stale_redirect_to(self):
+        """redirect_to is ignored once the html is no longer a redirect."""
+        target = revision(is_approved=True, save=True).document
+        redirect = redirect_rev('Redirect', target.title).document
+        redirect.html = u'<p>Not a redirect any more</p>'
+        eq_(None, redirect.redirect_document())
+
+    def test_redirect_document_follow(self):
+        """Chains of redirects are followed to their end; loops give None."""
+        target = revision(is_approved=True, save=True).document
+        redirect_rev('Second', target.title)
+        first = redirect_rev('First', 'Second').document
+        eq_('Second', first.redirect_document().title)
+        eq_(target, first.redirect_document(follow=True))
+
+        a = redirect_rev('A', 'B').document
+        redirect_rev('B', 'A')
+        revision(document=a, content='REDIRECT [[B]]', is_approved=True,
+                 save=True)
+        eq_(None, Document.uncached.get(pk=a.pk).redirect_document(
+            follow=True))
+
 
 class RedirectCreationTests(TestCase):
     """Tests for automatic creation of redirects when slug or title changes"""
@@ -435,6 +487,40 @@ class RevisionTests(TestCase):
 
         assert 'Here to stay' in d.html, '"Here to stay" not in %s' % d.html
 
+    def test_contributors(self):
+        """Creators of approved revisions are contributors until the last of
+        their approved revisions is deleted."""
+        d, r1 = doc_rev()
+        jsocol = r1.creator
+        pcraciunoiu = get_user('pcraciunoiu')
+        r2 = revision(document=d, is_approved=True, save=True)
+        revision(document=d, creator=pcraciunoiu, save=True)
+        eq_([jsocol], list(d.contributors.all()))
+
+        revision(document=d, creator=pcraciunoiu, is_approved=True,
+                 save=True)
+        eq_(set([jsocol, pcraciunoiu]), set(d.contributors.all()))
+
+        r1.delete()
+        eq_(set([jsocol, pcraciunoiu]), set(d.contributors.all()))
+        r2.delete()
+        eq_([pcraciunoiu], list(d.contributors.all()))
+
+    @mock.patch('wiki.models.invalidate_pages')
+    def test_resave_approved(self, invalidate_pages):
+        """Re-saving an approved revision leaves the page cache alone."""
+        _, r = doc_rev()
+        invalidate_pages.reset_mock()
+        r = Revision.objects.get(pk=r.pk)
+        r.keywords = u'more keywords'
+        r.save()
+        assert not invalidate_pages.called
+
+        r = revision(document=r.document, save=True)
+        r.is_approved = True
+        r.save()
+        invalidate_pages.assert_called_with([r.document_id])
+
     def test_revision_unicode(self):
         """Revision containing unicode characters is saved successfully."""
         str = u' \r\nFirefox informa\xe7\xf5es \u30d8\u30eb'
@@ -505,6 +591,35 @@ class RelatedDocumentTests(TestCase):
         d = Document.uncached.get(pk=3)
         eq_(0, d.related_documents.count())
 
+    def test_tags_changed(self):
+        """Documents whose tags change are recalculated, along with the
+        documents they were related to."""
+        calculate_related_documents()
+        d = Document.uncached.get(pk=1)
+        related = list(d.related_documents.all())
+        assert related
+        d.tags.clear()
+        calculate_related_documents()
+        eq_(0, Document.uncached.get(pk=1).related_documents.count())
+        for r in related:
+            assert d not in Document.uncached.get(
+                pk=r.pk).related_documents.all()
+
+    def test_only_changes_marked(self):
+        """Saves that don't change what decides related documents don't
+        queue a recalculation."""
+        calculate_related_documents()
+        eq_(0, RelatedDocumentChange.uncached.count())
+        d = Document.uncached.get(pk=1)
+        d.html = 'Something else'
+        d.save()
+        eq_(0, RelatedDocumentChange.uncached.count())
+        d.category = CATEGORIES[-1][0]
+        d.save()
+        # Its translation moves with it:
+        eq_(set([1, 4]), set(RelatedDocumentChange.uncached
+                             .values_list('document_id', flat=True)))
+
 
 class GetCurrentOrLatestRevisionTests(TestCase):
     fixtures = ['users.json']
@@ -1,7 +1,9 @@
 from copy import deepcopy
 
 from django.conf import settings
+from django.core.cache import cache
 
+import mock
 from nose.tools import eq_
 from pyquery import PyQuery as pq
 
@@ -9,7 +11,9 @@ from gallery.models import Video
 from gallery.tests import image, video
 from sumo.tests import TestCase
 import sumo.tests.test_parser
+from wiki.models import Document
 from wiki.parser import (WikiParser, ForParser, PATTERNS, RECURSION_MESSAGE,
+                         cached_wiki_to_html,
                          _build_template_params as _btp,
                          _format_template_content as _ftc, _key_split)
 from wiki.tests import document, revision
@@ -138,6 +142,31 @@ class SimpleSyntaxTestCase(TestCase):
         eq_('hi!', doc('em span.menu').text())
 
 
+class CachedWikiToHtmlTests(TestCase):
+    fixtures = ['users.json']
+
+    def setUp(self):
+        super(CachedWikiToHtmlTests, self).setUp()
+        cache.clear()
+
+    @mock.patch.object(WikiParser, 'parse')
+    def test_cached(self, parse):
+        """The same markup in the same locale is only parsed once."""
+        parse.return_value = u'<p>html</p>'
+        eq_(u'<p>html</p>', cached_wiki_to_html(u'markup'))
+        eq_(u'<p>html</p>', cached_wiki_to_html(u'markup'))
+        eq_(1, parse.call_count)
+        cached_wiki_to_html(u'markup', locale='fr')
+        eq_(2, parse.call_count)
+
+    def test_document_saved(self):
+        """Changing a document invalidates the cache."""
+        assert 'does not exist' in cached_wiki_to_html(u'[[Include:Inner]]')
+        revision(document=document(title='Inner', save=True),
+                 content='Included', is_approved=True, save=True)
+        assert 'Included' in cached_wiki_to_html(u'[[Include:Inner]]')
+
+
 class TestWikiTemplate(TestCase):
     fixtures = ['users.json']
 
@@ -172,6 +201,12 @@ class TestWikiTemplate(TestCase):
         eq_('The template "test" does not exist or has no approved revision.',
             doc.text())
 
+    def test_template_dependencies(self):
+        """The parser records the templates it used."""
+        _, p = doc_parse_markup('Test content', '[[Template:test]]')
+        t = Document.objects.get(title='Template:test')
+        eq_(set([t.id]), p.dependencies)
+
     def test_template_locale_fallback(self):
         """If localized template does not exist, fall back to English."""
         _, p = doc_parse_markup('English content', '[[Template:test]]')
@@ -741,6 +776,13 @@ class ForParserTests(TestCase):
                  '{for mac}Fx3{/for}\n'
                  '{/for}')
 
+    def test_tag_after_padding(self):
+        """A tag right after another's postspace sees the newlines added
+        to it, not the original text, when deciding if it's on its own
+        line."""
+        strip_eq('a\n\n\x070\x07\n \n\x071\x07\n\nb\n\x07/sf\x07\x07/sf\x07',
+                 'a\n{for}\n {for}\nb\n{/for}{/for}')
+
     def test_self_closers(self):
         """Make sure self-closing tags aren't balanced as paired ones."""
         balanced_eq('<img src="smoo"><span>g</span>',
@@ -748,6 +790,25 @@ class ForParserTests(TestCase):
         balanced_eq('<img src="smoo"><span>g</span>',
                     '<img src="smoo"/><span>g</span>')
 
+    def test_closed_by_parent(self):
+        """A for left open is closed with the element it's in, and its
+        stray closer dropped."""
+        balanced_eq('<p><for>a</for></p><p>b</p>',
+                    '<p><for>a</p><p>b</for></p>')
+
+    def test_pre_newline(self):
+        """A newline right after <pre> is dropped, as html5lib does."""
+        balanced_eq('<pre><for>x</for></pre>', '<pre>\n<for>x</for></pre>')
+
+    def test_html5lib_fallback(self):
+        """Fors html5lib would move are balanced by html5lib."""
+        html = '<table><tbody><tr><for><td>a</td></for></tr></tbody></table>'
+        eq_(None, ForParser(html)._chunks)
+        balanced_eq('<for></for><table><tbody><tr><td>a</td></tr></tbody>'
+                    '</table>', html)
+        balanced_eq('<p><for><em>a</em></for><em>b</em></p>',
+                    '<p><for><em>a</for>b</em></p>')
+
     def test_leading_text_nodes(self):
         """Make sure the parser handles a leading naked run of text.
 
@@ -15,8 +15,10 @@ from test_utils import RequestFactory
 from sumo.tests import TestCase
 from wiki.models import Document
 from wiki.tasks import (send_reviewed_notification, rebuild_kb,
-                        schedule_rebuild_kb, _rebuild_kb_chunk)
-from wiki.tests import TestCaseBase, revision
+                        schedule_rebuild_kb, _rebuild_kb_chunk,
+                        rebuild_kb_progress, rebuild_dependents,
+                        DEPENDENCIES_KNOWN_KEY)
+from wiki.tests import TestCaseBase, document, revision
 
 
 REVIEWED_EMAIL_CONTENT = """
@@ -88,6 +90,25 @@ class RebuildTestCase(TestCase):
         assert 'args' in apply_async.call_args[1]
         eq_(data, set(apply_async.call_args[1]['args'][0]))
 
+    def test_progress(self):
+        """The rebuild keeps count of the documents it has rendered."""
+        rebuild_kb()
+        progress = rebuild_kb_progress()
+        eq_(4, progress['total'])
+        eq_(4, progress['done'])
+        eq_(0, progress['eta'])
+        assert cache.get(DEPENDENCIES_KNOWN_KEY)
+
+    @mock.patch.object(Document, 'update')
+    def test_unchanged_not_written(self, update):
+        """Documents that render the same as before aren't written."""
+        d = Document.objects.get(pk=1)
+        html = d.current_revision.content_parsed
+        Document.objects.filter(pk=1).update(html=html)
+        Document.objects.filter(pk=2).update(html='stale')
+        _rebuild_kb_chunk([1, 2])
+        eq_(1, update.call_count)
+
     def test_delete_redirects(self):
         """Test that the rebuild deletes redirects that point to deleted
         documents."""
@@ -106,6 +127,49 @@ class RebuildTestCase(TestCase):
         rebuild_kb()
         eq_(0, Document.objects.filter(slug=slug).count())
 
+    def test_redirect_to_filled_in(self):
+        """The rebuild records the targets of redirects that lack them."""
+        d = Document.objects.get(pk=1)
+        slug = d.slug
+        d.slug = slug + '-1'
+        d.save()
+        redirect = Document.uncached.get(slug=slug)
+        Document.uncached.filter(pk=redirect.pk).update(redirect_to=None)
+        rebuild_kb()
+        eq_(d.id, Document.uncached.get(pk=redirect.pk).redirect_to_id)
+
+
+class RebuildDependentsTestCase(TestCase):
+    fixtures = ['users.json']
+
+    def test_rebuild_dependents(self):
+        """Documents that include a changed one, even through another, are
+        re-rendered."""
+        inner = revision(document=document(title='Inner', save=True),
+                         content='Old', is_approved=True, save=True).document
+        outer = revision(document=document(title='Outer', save=True),
+                         content='[[Include:Inner]]', is_approved=True,
+                         save=True).document
+        page = revision(content='[[Include:Outer]]', is_approved=True,
+                        save=True).document
+        eq_(set([outer.id, page.id]), inner.get_dependents())
+
+        revision(document=inner, content='New', is_approved=True, save=True)
+        rebuild_dependents(inner.id)
+        assert 'New' in Document.uncached.get(pk=page.id).html
+        assert 'New' in Document.uncached.get(pk=outer.id).html
+
+    def test_dependencies_replaced(self):
+        """Re-rendering a document forgets what it no longer includes."""
+        revision(document=document(title='Inner', save=True),
+                 is_approved=True, save=True)
+        r = revision(content='[[Include:Inner]]', is_approved=True, save=True)
+        eq_(1, r.document.dependencies.count())
+
+        revision(document=r.document, content='Nothing', is_approved=True,
+                 save=True)
+        eq_(0, r.document.dependencies.count())
+
 
 class ReviewMailTestCase(TestCaseBase):
     """Test that the review mail gets sent."""
@@ -4,6 +4,7 @@ from django.conf import settings
 from django.contrib.auth.models import User
 from django.contrib.sites.models import Site
 from django.core import mail
+from django.core.cache import cache
 
 import mock
 from nose import SkipTest
@@ -18,7 +19,8 @@ from wiki.cron import calculate_related_documents
 from wiki.events import (EditDocumentEvent, ReviewableRevisionInLocaleEvent,
                          ApproveRevisionInLocaleEvent)
 from wiki.models import Document, Revision, HelpfulVote, SIGNIFICANCES
-from wiki.tasks import send_reviewed_notification
+from wiki.tasks import (send_reviewed_notification, rebuild_dependents,
+                        DEPENDENCIES_KNOWN_KEY)
 from wiki.tests import TestCaseBase, document, revision, new_document_data
 
 
@@ -83,6 +85,29 @@ class DocumentTests(TestCaseBase):
         eq_(r.document.get_absolute_url(),
             doc('link[rel=canonical]').attr('href'))
 
+    def test_document_cached(self):
+        """The content is cached until the document is saved or its tags
+        change."""
+        r = revision(save=True, content='Some text.', is_approved=True)
+        d = r.document
+        self.client.get(d.get_absolute_url())
+
+        # Changes that skip the save signals aren't seen...
+        Document.uncached.filter(pk=d.pk).update(html='<p>Sneaky.</p>')
+        response = self.client.get(d.get_absolute_url())
+        eq_('Some text.', pq(response.content)('#doc-content').text())
+
+        # ...until the tags change...
+        d.tags.add('foo')
+        response = self.client.get(d.get_absolute_url())
+        eq_('Sneaky.', pq(response.content)('#doc-content').text())
+
+        # ...or a revision is approved:
+        revision(document=d, content='More text.', is_approved=True,
+                 save=True)
+        response = self.client.get(d.get_absolute_url())
+        eq_('More text.', pq(response.content)('#doc-content').text())
+
     def test_english_document_no_approved_content(self):
         """Load an English document with no approved content."""
         r = revision(save=True, content='Some text.', is_approved=False)
@@ -792,6 +817,56 @@ class ReviewRevisionTests(TestCaseBase):
         assert not r.is_approved
         delay.assert_called_with(r, r.document, comment)
 
+    @mock.patch.object(settings._wrapped, 'WIKI_REBUILD_ON_DEMAND', True)
+    @mock.patch.object(rebuild_dependents, 'delay')
+    @mock.patch.object(send_reviewed_notification, 'delay')
+    @mock.patch.object(Site.objects, 'get_current')
+    def test_approve_rebuilds_dependents(self, get_current, reviewed_delay,
+                                         rebuild_delay):
+        """Approving a revision re-renders the documents including it."""
+        get_current.return_value.domain = 'testserver'
+        cache.set(DEPENDENCIES_KNOWN_KEY, True)
+        post(self.client, 'wiki.review_revision',
+             {'approve': 'Approve Revision',
+              'significance': SIGNIFICANCES[0][0]},
+             args=[self.document.slug, self.revision.id])
+        rebuild_delay.assert_called_with(self.document.id)
+
+    @mock.patch.object(settings._wrapped, 'WIKI_REBUILD_ON_DEMAND', True)
+    @mock.patch('wiki.tasks.schedule_rebuild_kb')
+    @mock.patch.object(rebuild_dependents, 'delay')
+    @mock.patch.object(send_reviewed_notification, 'delay')
+    @mock.patch.object(Site.objects, 'get_current')
+    def test_approve_rebuilds_kb_until_dependencies_known(
+            self, get_current, reviewed_delay, rebuild_delay, rebuild_kb):
+        """Until a full rebuild has recorded what documents include,
+        approving a revision rebuilds the whole KB."""
+        get_current.return_value.domain = 'testserver'
+        cache.delete(DEPENDENCIES_KNOWN_KEY)
+        post(self.client, 'wiki.review_revision',
+             {'approve': 'Approve Revision',
+              'significance': SIGNIFICANCES[0][0]},
+             args=[self.document.slug, self.revision.id])
+        assert not rebuild_delay.called
+        assert rebuild_kb.called
+
+    @mock.patch.object(settings._wrapped, 'WIKI_REBUILD_ON_DEMAND', False)
+    @mock.patch('wiki.tasks.schedule_rebuild_kb')
+    @mock.patch.object(rebuild_dependents, 'delay')
+    @mock.patch.object(send_reviewed_notification, 'delay')
+    @mock.patch.object(Site.objects, 'get_current')
+    def test_approve_no_rebuild_unless_on_demand(
+            self, get_current, reviewed_delay, rebuild_delay, rebuild_kb):
+        """With on-demand rebuilds off, approving re-renders nothing."""
+        get_current.return_value.domain = 'testserver'
+        cache.set(DEPENDENCIES_KNOWN_KEY, True)
+        post(self.client, 'wiki.review_revision',
+             {'approve': 'Approve Revision',
+              'significance': SIGNIFICANCES[0][0]},
+             args=[self.document.slug, self.revision.id])
+        assert not rebuild_delay.called
+        assert not rebuild_kb.called
+
     def test_review_without_permission(self):
         """Make sure unauthorized users can't review revisions."""
         self.client.login(username='rrosario', password='testpass')
@@ -1392,6 +1467,22 @@ class HelpfulVoteTests(TestCaseBase):
         eq_(1, votes.count())
         assert votes[0].helpful
 
+    def test_vote_counts(self):
+        """Votes are counted on the document and its current revision, and
+        the form goes away once you've voted."""
+        d = self.document
+        self.client.login(username='rrosario', password='testpass')
+        response = self.client.get(d.get_absolute_url())
+        eq_(1, len(pq(response.content)('#helpful-vote')))
+        post(self.client, 'wiki.document_vote', {'not-helpful': 'No'},
+             args=[d.slug])
+        d = Document.uncached.get(pk=d.pk)
+        eq_((0, 1), (d.helpful_votes, d.unhelpful_votes))
+        rev = Revision.uncached.get(pk=d.current_revision_id)
+        eq_((0, 1), (rev.helpful_votes, rev.unhelpful_votes))
+        response = self.client.get(d.get_absolute_url())
+        eq_(0, len(pq(response.content)('#helpful-vote')))
+
 
 class SelectLocaleTests(TestCaseBase):
     """Test the locale selection page"""
@@ -1496,6 +1587,36 @@ class RevisionDeleteTestCase(TestCaseBase):
         d = Document.objects.get(pk=d.pk)
         eq_(prev_revision, d.current_revision)
 
+    def test_delete_current_redirect_revision(self):
+        """Deleting a current revision that redirects forgets the target."""
+        self.client.login(username='admin', password='testpass')
+        target = revision(is_approved=True, save=True).document
+        self.d.current_revision.reviewed = datetime.now() - timedelta(days=1)
+        self.d.current_revision.save()
+        r = revision(document=self.d, is_approved=True,
+                     reviewed=datetime.now(),
+                     content='REDIRECT [[%s]]' % target.title, save=True)
+        eq_(target.id, Document.uncached.get(pk=self.d.pk).redirect_to_id)
+
+        post(self.client, 'wiki.delete_revision', args=[self.d.slug, r.id])
+        eq_(None, Document.uncached.get(pk=self.d.pk).redirect_to_id)
+
+    def test_delete_current_revision_dependencies(self):
+        """Deleting the current revision records what the previous one
+        includes."""
+        self.client.login(username='admin', password='testpass')
+        revision(document=document(title='Inner', save=True),
+                 is_approved=True, save=True)
+        self.d.current_revision.reviewed = datetime.now() - timedelta(days=1)
+        self.d.current_revision.save()
+        r = revision(document=self.d, is_approved=True,
+                     reviewed=datetime.now(), content='[[Include:Inner]]',
+                     save=True)
+        eq_(1, self.d.dependencies.count())
+
+        post(self.client, 'wiki.delete_revision', args=[self.d.slug, r.id])
+        eq_(0, self.d.dependencies.count())
+
 
 class ApprovedWatchTests(TestCaseBase):
     """Tests for un/subscribing to revision approvals."""
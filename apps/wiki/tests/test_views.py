@@ -99,6 +99,33 @@ class ViewTests(TestCase):
         data = json.loads(resp.content)
         eq_('an article title', data['title'])
 
+    def test_bulk_json_view(self):
+        """Documents are found by title, slug and ID, in the request's
+        locale only."""
+        url = reverse('wiki.bulk_json', force_locale=True)
+        resp = self.client.get(url, {'title': ['an article title', 'nope'],
+                                     'slug': 'lorem-ipsum', 'id': [2, 6]})
+        eq_(200, resp.status_code)
+        data = json.loads(resp.content)
+        eq_([1, 5, 6], [d['id'] for d in data['documents']])
+        eq_('article-title', data['documents'][0]['slug'])
+
+        resp = self.client.get(url)
+        eq_(400, resp.status_code)
+
+    def test_bulk_json_view_not_modified(self):
+        """Clients with the current ETag get a 304."""
+        url = reverse('wiki.bulk_json', force_locale=True)
+        resp = self.client.get(url, {'slug': 'lorem-ipsum'})
+        assert resp['Last-Modified']
+        resp = self.client.get(url, {'slug': 'lorem-ipsum'},
+                               HTTP_IF_NONE_MATCH=resp['ETag'])
+        eq_(304, resp.status_code)
+
+        resp = self.client.get(url, {'slug': ['lorem-ipsum', 'article-title']},
+                               HTTP_IF_NONE_MATCH=resp['ETag'])
+        eq_(200, resp.status_code)
+
 
 class DocumentEditingTests(TestCase):
     """Tests for the document-editing view"""
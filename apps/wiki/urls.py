@@ -76,6 +76,7 @@ urlpatterns = patterns('wiki.views',
         name='wiki.approved_unwatch'),
 
     url(r'^/json$', 'json_view', name='wiki.json'),
+    url(r'^/json/bulk$', 'bulk_json_view', name='wiki.bulk_json'),
 
     url(r'^/new$', 'new_document', name='wiki.new_document'),
     url(r'^/all$', 'list_documents', name='wiki.all_documents'),
@@ -1,13 +1,20 @@
 from datetime import datetime
+import hashlib
 import json
 import logging
+import operator
 from string import ascii_letters
+import time
 
 from django.conf import settings
+from django.core.cache import cache
 from django.core.exceptions import PermissionDenied
+from django.db.models import Q
 from django.http import (HttpResponse, HttpResponseRedirect,
-                         Http404, HttpResponseBadRequest)
+                         Http404, HttpResponseBadRequest,
+                         HttpResponseNotModified)
 from django.shortcuts import get_object_or_404
+from django.utils.http import http_date
 from django.views.decorators.http import (require_GET, require_POST,
                                           require_http_methods)
 
@@ -20,17 +27,18 @@ from tower import ugettext as _
 from access.decorators import permission_required, login_required
 from sumo.helpers import urlparams
 from sumo.urlresolvers import reverse
-from sumo.utils import paginate, smart_int, get_next_url
-from wiki import DOCUMENTS_PER_PAGE
+from sumo.utils import keyset_paginate, smart_int, get_next_url
+from wiki import BULK_JSON_MAX_LOOKUPS, DOCUMENTS_PER_PAGE
 from wiki.events import (EditDocumentEvent, ReviewableRevisionInLocaleEvent,
                          ApproveRevisionInLocaleEvent)
 from wiki.forms import DocumentForm, RevisionForm, ReviewForm
 from wiki.models import (Document, Revision, HelpfulVote, CATEGORIES,
                          OPERATING_SYSTEMS, GROUPED_OPERATING_SYSTEMS,
                          FIREFOX_VERSIONS, GROUPED_FIREFOX_VERSIONS,
-                         get_current_or_latest_revision)
-from wiki.parser import wiki_to_html
-from wiki.tasks import send_reviewed_notification, schedule_rebuild_kb
+                         get_current_or_latest_revision, page_cache_key)
+from wiki.parser import cached_wiki_to_html
+from wiki.tasks import (send_reviewed_notification, schedule_rebuild_kb,
+                        rebuild_after_change)
 
 
 log = logging.getLogger('k.wiki')
@@ -75,6 +83,40 @@ SHOWFOR_DATA = {
 }
 
 
+def _document_fragments(request, doc, fallback_reason):
+    """Return the rendered related articles, content and contributors of a
+    document's page, and its related articles as (URL, title) pairs.
+
+    They're cached until the document is saved, its tags change or its
+    related documents are recalculated. Pages falling back to a parent's
+    content would also go stale when the parent changes, so they aren't
+    cached.
+
+    """
+    cacheable = fallback_reason in (None, 'no_translation')
+    if cacheable:
+        key = page_cache_key(doc, request.locale, request.MOBILE)
+        fragments = cache.get(key)
+        if fragments is not None:
+            return fragments
+
+    related = [(d.get_absolute_url(), d.title) for d in
+               doc.related_documents.order_by('-related_to__in_common')[0:5]]
+    contributors = doc.contributors.all()
+
+    macros = jingo.env.get_template('wiki/includes/document_macros.html')
+    macros = macros.module
+    fragments = {
+        'related': related,
+        'related_articles': unicode(macros.related_articles(related)),
+        'content': unicode(macros.document_content(doc, fallback_reason,
+                                                   request, settings)),
+        'contributors': unicode(macros.contributor_list(contributors))}
+    if cacheable:
+        cache.set(key, fragments, settings.WIKI_PAGE_CACHE_TIMEOUT)
+    return fragments
+
+
 @require_GET
 @mobile_template('wiki/{mobile/}document.html')
 def document(request, document_slug, template=None):
@@ -130,15 +172,8 @@ def document(request, document_slug, template=None):
         except Document.DoesNotExist:
             pass
 
-    related = doc.related_documents.order_by('-related_to__in_common')[0:5]
-
-    # Get the contributors. (To avoid this query, we could render the
-    # the contributors right into the Document's html field.)
-    contributors = set([r.creator for r in doc.revisions.filter(
-                            is_approved=True).select_related('creator')])
-
     data = {'document': doc, 'redirected_from': redirected_from,
-            'related': related, 'contributors': contributors,
+            'fragments': _document_fragments(request, doc, fallback_reason),
             'fallback_reason': fallback_reason,
             'is_aoa_referral': request.GET.get('ref') == 'aoa'}
     data.update(SHOWFOR_DATA)
@@ -173,7 +208,7 @@ def list_documents(request, category=None, tag=None):
         tagobj = get_object_or_404(Tag, slug=tag)
         docs = docs.filter(tags__name__in=[tagobj.name])
 
-    docs = paginate(request, docs, per_page=DOCUMENTS_PER_PAGE)
+    docs = keyset_paginate(request, docs, per_page=DOCUMENTS_PER_PAGE)
     return jingo.render(request, 'wiki/list_documents.html',
                         {'documents': docs,
                          'category': category,
@@ -290,7 +325,7 @@ def preview_revision(request):
     """Create an HTML fragment preview of the posted wiki syntax."""
     wiki_content = request.POST.get('content', '')
     # TODO: Get doc ID from JSON.
-    data = {'content': wiki_to_html(wiki_content, request.locale)}
+    data = {'content': cached_wiki_to_html(wiki_content, request.locale)}
     data.update(SHOWFOR_DATA)
     return jingo.render(request, 'wiki/preview.html', data)
 
@@ -319,6 +354,7 @@ def review_revision(request, document_slug, revision_id):
         form = ReviewForm(request.POST)
         if form.is_valid() and not rev.reviewed:
             # Don't allow revisions to be reviewed twice
+            was_live = bool(doc.current_revision_id)
             rev.is_approved = 'approve' in request.POST
             rev.reviewer = request.user
             rev.reviewed = datetime.now()
@@ -334,8 +370,14 @@ def review_revision(request, document_slug, revision_id):
             # If approved, send approved notification
             ApproveRevisionInLocaleEvent(rev).fire(exclude=rev.creator)
 
-            # Schedule KB rebuild?
-            schedule_rebuild_kb()
+            # Re-render the documents that include this one. A document's
+            # first approved revision can replace "does not exist" messages
+            # anywhere in the KB, though, so that takes a full rebuild.
+            if rev.is_approved:
+                if was_live:
+                    rebuild_after_change(doc.id)
+                else:
+                    schedule_rebuild_kb()
 
             return HttpResponseRedirect(reverse('wiki.document_revisions',
                                                 args=[document_slug]))
@@ -560,6 +602,18 @@ def unwatch_approved(request):
     return HttpResponseRedirect(_get_next_url_fallback_localization(request))
 
 
+def _document_json(document):
+    """Return the basic info of a document with a current revision."""
+    return {
+        'id': document.id,
+        'locale': document.locale,
+        'slug': document.slug,
+        'title': document.title,
+        'summary': document.current_revision.summary,
+        'url': document.get_absolute_url(),
+    }
+
+
 @require_GET
 def json_view(request):
     """Return some basic document info in a JSON blob."""
@@ -572,17 +626,59 @@ def json_view(request):
         return HttpResponseBadRequest()
 
     document = get_object_or_404(Document, **kwargs)
-    data = json.dumps({
-        'id': document.id,
-        'locale': document.locale,
-        'slug': document.slug,
-        'title': document.title,
-        'summary': document.current_revision.summary,
-        'url': document.get_absolute_url(),
-    })
+    data = json.dumps(_document_json(document))
     return HttpResponse(data, mimetype='application/json')
 
 
+@require_GET
+def bulk_json_view(request):
+    """Return the basic info of many documents in a JSON blob.
+
+    Documents are looked up by any number of title, slug and id parameters,
+    in one query. Those not found are left out.
+
+    The ETag changes with the documents' current revisions, titles and
+    slugs, and Last-Modified is when the newest current revision was
+    reviewed, so clients can revalidate cheaply.
+
+    """
+    titles = request.GET.getlist('title')
+    slugs = request.GET.getlist('slug')
+    ids = [i for i in (smart_int(i) for i in request.GET.getlist('id')) if i]
+    count = len(titles) + len(slugs) + len(ids)
+    if not count or count > BULK_JSON_MAX_LOOKUPS:
+        return HttpResponseBadRequest()
+
+    lookups = [Q(**{field: values}) for field, values in
+               [('title__in', titles), ('slug__in', slugs), ('id__in', ids)]
+               if values]
+    documents = list(Document.objects
+        .filter(reduce(operator.or_, lookups), locale=request.locale,
+                current_revision__isnull=False)
+        .select_related('current_revision').order_by('id'))
+
+    etag = '"%s"' % hashlib.md5(repr(
+        [(d.id, d.current_revision_id, d.title, d.slug) for d in documents]
+    )).hexdigest()
+    modified = max([d.current_revision.reviewed or d.current_revision.created
+                    for d in documents] or [None])
+    last_modified = (http_date(time.mktime(modified.timetuple()))
+                     if modified else None)
+
+    if (request.META.get('HTTP_IF_NONE_MATCH') == etag or
+        (last_modified and 'HTTP_IF_NONE_MATCH' not in request.META and
+         request.META.get('HTTP_IF_MODIFIED_SINCE') == last_modified)):
+        response = HttpResponseNotModified()
+    else:
+        data = json.dumps({'documents': [_document_json(d)
+                                         for d in documents]})
+        response = HttpResponse(data, mimetype='application/json')
+    response['ETag'] = etag
+    if last_modified:
+        response['Last-Modified'] = last_modified
+    return response
+
+
 @require_POST
 def helpful_vote(request, document_slug):
     """Vote for Helpful/Not Helpful document"""
@@ -591,7 +687,8 @@ def helpful_vote(request, document_slug):
 
     if not document.has_voted(request):
         ua = request.META.get('HTTP_USER_AGENT', '')[:1000]  # 1000 max_length
-        vote = HelpfulVote(document=document, user_agent=ua)
+        vote = HelpfulVote(document=document, user_agent=ua,
+                           revision_id=document.current_revision_id)
 
         if 'helpful' in request.POST:
             vote.helpful = True
@@ -642,8 +739,16 @@ def delete_revision(request, document_slug, revision_id):
             document.current_revision = revs[1]
         else:
             document.current_revision = None
-        document.html = document.content_parsed or ''
+        if document.current_revision:
+            # Not content_parsed: that may be cached from before the
+            # documents this one includes last changed.
+            document.html, dependencies = document.current_revision.render()
+        else:
+            document.html, dependencies = '', []
+        document.redirect_to = document.find_redirect_target()
         document.save()
+        document.set_dependencies(dependencies)
+        rebuild_after_change(document.id)
 
     revision.delete()
 
@@ -44,6 +44,11 @@ setup_environ(settings)
 # Import for side-effect: configures our logging handlers.
 import log_settings
 
+# Every process, from mod_wsgi to cron and celery, starts here, so this is
+# where signal handlers that aren't tied to importing a module get connected.
+from search import autocomplete
+autocomplete.register()
+
 
 if __name__ == "__main__":
     execute_manager(settings)
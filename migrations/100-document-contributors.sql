@@ -0,0 +1,15 @@
+-- Creators of the approved revisions of each document.
+CREATE TABLE `wiki_document_contributors` (
+    `id` integer AUTO_INCREMENT NOT NULL PRIMARY KEY,
+    `document_id` integer NOT NULL,
+    `user_id` integer NOT NULL,
+    UNIQUE (`document_id`, `user_id`)
+) ENGINE=InnoDB CHARACTER SET utf8 COLLATE utf8_general_ci;
+ALTER TABLE `wiki_document_contributors` ADD CONSTRAINT `document_id_refs_id_4c5d2f8a` FOREIGN KEY (`document_id`) REFERENCES `wiki_document` (`id`);
+ALTER TABLE `wiki_document_contributors` ADD CONSTRAINT `user_id_refs_id_4c5d2f8a` FOREIGN KEY (`user_id`) REFERENCES `auth_user` (`id`);
+CREATE INDEX `wiki_document_contributors_f4226d13` ON `wiki_document_contributors` (`document_id`);
+CREATE INDEX `wiki_document_contributors_fbfc09f1` ON `wiki_document_contributors` (`user_id`);
+
+INSERT INTO `wiki_document_contributors` (`document_id`, `user_id`)
+    SELECT DISTINCT `document_id`, `creator_id` FROM `wiki_revision`
+    WHERE `is_approved` = 1;
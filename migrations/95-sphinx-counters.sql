@@ -0,0 +1,5 @@
+CREATE TABLE `search_sphinxcounter` (
+    `source` varchar(50) NOT NULL PRIMARY KEY,
+    `main_mark` datetime NOT NULL,
+    `delta_mark` datetime NOT NULL
+) ENGINE=InnoDB CHARACTER SET utf8 COLLATE utf8_general_ci;
@@ -0,0 +1,10 @@
+CREATE TABLE `wiki_documentdependency` (
+    `id` integer AUTO_INCREMENT NOT NULL PRIMARY KEY,
+    `document_id` integer NOT NULL,
+    `depends_on_id` integer NOT NULL,
+    UNIQUE (`document_id`, `depends_on_id`)
+) ENGINE=InnoDB CHARACTER SET utf8 COLLATE utf8_general_ci;
+ALTER TABLE `wiki_documentdependency` ADD CONSTRAINT `document_id_refs_id_7e3b5c1d` FOREIGN KEY (`document_id`) REFERENCES `wiki_document` (`id`);
+ALTER TABLE `wiki_documentdependency` ADD CONSTRAINT `depends_on_id_refs_id_7e3b5c1d` FOREIGN KEY (`depends_on_id`) REFERENCES `wiki_document` (`id`);
+CREATE INDEX `wiki_documentdependency_f4226d13` ON `wiki_documentdependency` (`document_id`);
+CREATE INDEX `wiki_documentdependency_a1ba7b2d` ON `wiki_documentdependency` (`depends_on_id`);
@@ -0,0 +1,5 @@
+-- The document a redirect points to. Filled in for existing redirects by the
+-- next KB rebuild; until then they're followed by parsing their HTML.
+ALTER TABLE `wiki_document` ADD `redirect_to_id` integer NULL;
+ALTER TABLE `wiki_document` ADD CONSTRAINT `redirect_to_id_refs_id_4c8f2a1e` FOREIGN KEY (`redirect_to_id`) REFERENCES `wiki_document` (`id`);
+CREATE INDEX `wiki_document_redirect_to_id` ON `wiki_document` (`redirect_to_id`);
@@ -0,0 +1,24 @@
+-- Documents whose related documents need recalculating.
+CREATE TABLE `wiki_relateddocumentchange` (
+    `document_id` integer NOT NULL PRIMARY KEY,
+    `version` integer NOT NULL
+) ENGINE=InnoDB CHARACTER SET utf8 COLLATE utf8_general_ci;
+
+-- Related documents are now upserted, and full rebuilds swap in a copy of
+-- the table made with CREATE TABLE ... LIKE, which has no foreign keys.
+-- The table came from syncdb, not a migration, so look its foreign keys'
+-- names up rather than trusting the ones in scripts/schema.sql.
+SELECT CONCAT('ALTER TABLE `wiki_relateddocument` DROP FOREIGN KEY `',
+              GROUP_CONCAT(`CONSTRAINT_NAME`
+                           SEPARATOR '`, DROP FOREIGN KEY `'), '`')
+    INTO @drop_foreign_keys
+    FROM `information_schema`.`TABLE_CONSTRAINTS`
+    WHERE `CONSTRAINT_SCHEMA` = DATABASE() AND
+        `TABLE_NAME` = 'wiki_relateddocument' AND
+        `CONSTRAINT_TYPE` = 'FOREIGN KEY';
+SET @drop_foreign_keys = IFNULL(@drop_foreign_keys, 'DO 0');
+PREPARE drop_foreign_keys FROM @drop_foreign_keys;
+EXECUTE drop_foreign_keys;
+DEALLOCATE PREPARE drop_foreign_keys;
+
+ALTER TABLE `wiki_relateddocument` ADD UNIQUE (`document_id`, `related_id`);
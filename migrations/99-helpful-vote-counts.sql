@@ -0,0 +1,18 @@
+-- Counts of helpful and unhelpful votes per document and revision.
+ALTER TABLE `wiki_document`
+    ADD `helpful_votes` integer NOT NULL DEFAULT 0,
+    ADD `unhelpful_votes` integer NOT NULL DEFAULT 0;
+ALTER TABLE `wiki_revision`
+    ADD `helpful_votes` integer NOT NULL DEFAULT 0,
+    ADD `unhelpful_votes` integer NOT NULL DEFAULT 0;
+
+-- The revision a vote was cast on. Unknown for earlier votes.
+ALTER TABLE `wiki_helpfulvote` ADD `revision_id` integer NULL;
+ALTER TABLE `wiki_helpfulvote` ADD CONSTRAINT `revision_id_refs_id_6f3b2e1c` FOREIGN KEY (`revision_id`) REFERENCES `wiki_revision` (`id`);
+CREATE INDEX `wiki_helpfulvote_revision_id` ON `wiki_helpfulvote` (`revision_id`);
+
+UPDATE `wiki_document` d SET
+    `helpful_votes` = (SELECT COUNT(*) FROM `wiki_helpfulvote` v
+                       WHERE v.`document_id` = d.`id` AND v.`helpful` = 1),
+    `unhelpful_votes` = (SELECT COUNT(*) FROM `wiki_helpfulvote` v
+                         WHERE v.`document_id` = d.`id` AND v.`helpful` = 0);
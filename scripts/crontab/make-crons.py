@@ -53,8 +53,8 @@ HOME = /tmp
 * * * * * $CRON collect_tweets
 * * * * * $CRON get_queue_status
 
-# Every 2 hours.
-1 */2 * * * $CRON calculate_related_documents
+# Every 10 minutes.
+*/10 * * * * $CRON calculate_related_documents
 
 # Every 6 hours.
 0 */6 * * * $DJANGO update_product_details -q > /dev/null
@@ -68,6 +68,9 @@ HOME = /tmp
 # Twice per week.
 05 01 * * 1,4 $CRON update_weekly_votes
 
+# Once per week.
+35 02 * * 0 $CRON rebuild_related_documents
+
 MAILTO=root
 """
 
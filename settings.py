@@ -44,6 +44,9 @@ SLAVE_DATABASES = []
 #CACHE_BACKEND = 'caching.backends.memcached://localhost:11211'
 #CACHE_PREFIX = 'sumo:'
 
+# Seconds to cache the counts of keyset-paginated lists.
+PAGINATOR_COUNT_CACHE_TIMEOUT = 60 * 10
+
 # Addresses email comes from
 DEFAULT_FROM_EMAIL = 'notifications@support.mozilla.com'
 SERVER_EMAIL = 'server-error@support.mozilla.com'
@@ -462,6 +465,15 @@ TEST_SPHINXQL_PORT = 3418
 
 SEARCH_MAX_RESULTS = 1000
 SEARCH_RESULTS_PER_PAGE = 10
+# How long to wait for each index when querying several at once, in seconds.
+SEARCH_INDEX_TIMEOUT = 2
+# Idle persistent connections to searchd to keep per process and server.
+# Set to 0 to open a new connection for every query.
+SEARCH_POOL_SIZE = 5
+# Send search timings and error counts to this statsd server, if set.
+STATSD_HOST = None
+STATSD_PORT = 8125
+STATSD_PREFIX = 'sumo.search'
 
 # Search default settings
 # comma-separated tuple of included category IDs. Negative IDs are excluded.
@@ -559,6 +571,20 @@ CELERY_EAGER_PROPAGATES_EXCEPTIONS = True  # Explode loudly during tests.
 # Wiki rebuild settings
 WIKI_REBUILD_TOKEN = 'sumo:wiki:full-rebuild'
 WIKI_REBUILD_ON_DEMAND = False
+# Documents each rebuild task renders. Chunks are spread over all celery
+# workers, so smaller chunks finish sooner on more processes.
+WIKI_REBUILD_CHUNK_SIZE = 50
+# Seconds to cache the HTML of revisions and previews, by a hash of the
+# markup. Changes to any document invalidate it sooner.
+WIKI_PARSED_CACHE_TIMEOUT = 60 * 60
+# Seconds to cache the diff of two revisions, which never changes.
+WIKI_DIFF_CACHE_TIMEOUT = 60 * 60 * 24 * 7
+# Seconds to cache the IDs of the documents each visitor voted on.
+WIKI_VOTED_CACHE_TIMEOUT = 60 * 60 * 24
+# Seconds to cache the rendered content, related articles and contributors of
+# document pages. Saves, tag changes and related document updates invalidate
+# them sooner; renamed users only show up after this.
+WIKI_PAGE_CACHE_TIMEOUT = 60 * 60 * 24
 
 # Anonymous user cookie
 ANONYMOUS_COOKIE_NAME = 'SUMO_ANONID'